@@ -1,27 +1,80 @@
+import os
+
 from flask import Flask
 from flask_socketio import SocketIO
-from chat.routes import init_rooms, bp
+from chat import metrics
+from chat.retention import RetentionTrimmer, default_policy
+from chat.routes import init_rooms, bp, chat_api, redis
 from chat.socket import (
     handle_connect,
     handle_disconnect,
     on_join,
     on_leave,
     handle_message,
+    handle_messages,
+    on_history,
+    start_fanout,
+    start_presence,
+    start_stream_delivery,
+    user_sessions,
 )
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "secret!"
 app.register_blueprint(bp)
 
-socketio = SocketIO(app)
+# With a message queue (e.g. redis://redis:6379/0) broadcasts reach clients
+# connected to any worker or node, not only the ones of this process.
+socketio = SocketIO(app, message_queue=os.environ.get("SOCKETIO_MESSAGE_QUEUE"))
+
+handlers = {
+    "connect": handle_connect,
+    "disconnect": handle_disconnect,
+    "join": on_join,
+    "leave": on_leave,
+    "message": handle_message,
+    "messages": handle_messages,
+    "history": on_history,
+}
+for event, handler in handlers.items():
+    socketio.on_event(event, metrics.instrument_handler(event, handler))
+
 
-socketio.on_event("connect", handle_connect)
-socketio.on_event("disconnect", handle_disconnect)
-socketio.on_event("join", on_join)
-socketio.on_event("leave", on_leave)
-socketio.on_event("message", handle_message)
+metrics.register_collector(metrics.RoomSessionsCollector(user_sessions.counts))
+metrics.register_collector(metrics.CacheCollector(chat_api.cache_stats))
+
+# With CHAT_FANOUT_MS set, broadcasts to a room less than that many
+# milliseconds apart are sent to its clients as one "message_batch" event of at
+# most CHAT_FANOUT_MAX_PENDING messages. Clients must handle that event, so by
+# default every message is sent on its own as a "message" event.
+if float(os.environ.get("CHAT_FANOUT_MS", 0)) > 0:
+    start_fanout(
+        socketio,
+        window=float(os.environ["CHAT_FANOUT_MS"]) / 1000,
+        max_pending=int(os.environ.get("CHAT_FANOUT_MAX_PENDING", 500)),
+    )
 
 init_rooms()
+chat_api.cache.listen()
+start_presence(socketio)
+
+# With CHAT_STORAGE=stream, CHAT_STREAM_DELIVERY=1 makes every worker push new
+# messages from the room streams to its own clients, instead of using a message
+# queue: it refuses to start with SOCKETIO_MESSAGE_QUEUE set.
+if os.environ.get("CHAT_STREAM_DELIVERY") == "1":
+    start_stream_delivery(socketio)
+
+# With CHAT_RETENTION_INTERVAL every worker trims the rooms to their retention
+# policies every that many seconds (see chat.retention).
+if int(os.environ.get("CHAT_RETENTION_INTERVAL", 0)) > 0:
+    RetentionTrimmer(
+        redis,
+        chat_api.store,
+        chat_api.archive,
+        default=default_policy(),
+        interval=int(os.environ["CHAT_RETENTION_INTERVAL"]),
+        index=chat_api.index,
+    ).start()
 
 if __name__ == "__main__":
     socketio.run(app, host="0.0.0.0", debug=True)
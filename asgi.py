@@ -0,0 +1,485 @@
+"""The chat server on asyncio: python-socketio and Starlette under uvicorn.
+
+An alternative to app.py that needs neither eventlet nor Flask:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5002 --workers 4
+
+It serves the same REST routes and Socket.IO events to the same clients,
+from the same Redis database, through chat.aio.AsyncChatAPI. Set
+SOCKETIO_MESSAGE_QUEUE when running several workers, so that broadcasts reach
+the clients of every worker. A Socket.IO client that long-polls must keep
+reaching the same worker, so with several workers clients either connect
+with the websocket transport only or go through a proxy pinning them to one
+worker each, as nginx.conf does for the web replicas.
+
+Messages are kept in sorted sets (CHAT_STORAGE=zset); features not listed
+in chat.aio are only served by app.py.
+"""
+import asyncio
+import hashlib
+import json
+import os
+
+import socketio
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from chat import metrics
+from chat.aio import AsyncChatAPI
+from chat.api import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, page_etag
+from chat.codec import available_encodings
+from chat.compression import MIN_SIZE
+from chat.connection import async_redis_from_env, redis_from_env
+from chat.errors import ChatAPIError
+from chat.logger import logger
+from chat.presence import PresenceTracker, summarize
+from chat.rooms import DEFAULT_ROOMS, MAX_ROOMS_PAGE_SIZE, ROOMS_PAGE_SIZE
+
+# Number of messages sent to a client when it joins a room.
+JOIN_BACKFILL = 50
+
+# Number of messages written per chunk of a streamed history response.
+STREAM_CHUNK = 50
+
+# Most messages a client can send with one ``messages`` event.
+MAX_SEND_BATCH = 100
+
+if os.environ.get("CHAT_STORAGE", "zset") != "zset":
+    raise RuntimeError("The ASGI server requires CHAT_STORAGE=zset")
+
+# One pool of at most REDIS_MAX_CONNECTIONS connections per worker, shared by
+# every request and socket event, configured like app.py's (see
+# chat.connection).
+redis = async_redis_from_env()
+# Indexes the messages for the search served by app.py with CHAT_SEARCH=1, see
+# chat.routes.
+chat_api = AsyncChatAPI(
+    redis,
+    encoding=os.environ.get("CHAT_ENCODING", "json"),
+    search=os.environ.get("CHAT_SEARCH") == "1",
+)
+
+# Joins and leaves are announced like app.py does (see chat.presence), by a
+# tracker running on threads with a blocking client of its own.
+presence = PresenceTracker(redis_from_env())
+
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    client_manager=socketio.AsyncRedisManager(os.environ["SOCKETIO_MESSAGE_QUEUE"])
+    if os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+    else None,
+)
+
+
+def _error(e):
+    return JSONResponse({"error": str(e)}, status_code=e.get_status_code())
+
+
+def _token(request):
+    return request.headers.get("Authorization", "").replace("Bearer ", "")
+
+
+async def _credentials(request):
+    try:
+        body = await request.json()
+        return body["username"], body["password"]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# ----------------------------------------------------------------------
+# REST routes, see chat.routes
+# ----------------------------------------------------------------------
+
+
+async def get_metrics(request):
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+
+async def register(request):
+    credentials = await _credentials(request)
+    if credentials is None:
+        return JSONResponse({"error": "Invalid request"}, status_code=400)
+    try:
+        await chat_api.register_user(*credentials)
+        logger.info("Registered user %s", credentials[0])
+        return JSONResponse({"success": True}, status_code=201)
+    except ChatAPIError as e:
+        logger.error("Error registering user: %s", e)
+        return _error(e)
+
+
+async def login(request):
+    credentials = await _credentials(request)
+    if credentials is None:
+        return JSONResponse({"error": "Invalid request"}, status_code=400)
+    try:
+        token = await chat_api.login_user(*credentials)
+        logger.info("User %s logged in", credentials[0])
+        return JSONResponse({"token": token})
+    except ChatAPIError as e:
+        logger.error("Error logging in: %s", e)
+        return _error(e)
+
+
+async def logout(request):
+    try:
+        username = await chat_api.verify_token(_token(request))
+        await chat_api.logout_user(_token(request))
+        logger.info("User %s logged out", username)
+        return JSONResponse({"success": True})
+    except ChatAPIError as e:
+        logger.error("Error logging out: %s", e)
+        return _error(e)
+
+
+async def get_rooms(request):
+    sort = request.query_params.get("sort", "id")
+    try:
+        limit = int(request.query_params.get("limit", ROOMS_PAGE_SIZE))
+        if not 0 < limit <= MAX_ROOMS_PAGE_SIZE:
+            raise ValueError("limit out of range")
+    except ValueError as e:
+        logger.error("Invalid room list query: %s", e)
+        return JSONResponse({"error": "Invalid query parameters"}, status_code=400)
+    try:
+        page = await chat_api.get_rooms_page(
+            sort, request.query_params.get("cursor"), limit
+        )
+    except ChatAPIError as e:
+        logger.error("Error getting chat rooms: %s", e)
+        return JSONResponse(
+            {"error": "Error getting chat rooms"}, status_code=e.get_status_code()
+        )
+    response = JSONResponse(page["rooms"])
+    headers = _validators(hashlib.sha1(response.body).hexdigest())
+    if page["next_cursor"] is not None:
+        next_url = request.url.include_query_params(
+            sort=sort, cursor=page["next_cursor"], limit=limit
+        )
+        headers["Link"] = '<%s>; rel="next"' % next_url
+    if _not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return response
+
+
+def _validators(etag):
+    return {"ETag": 'W/"%s"' % etag, "Cache-Control": "no-cache"}
+
+
+def _not_modified(request, headers):
+    """Return whether the client has the version of the ETag in ``headers``."""
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or headers["ETag"].removeprefix("W/") in tags
+
+
+async def create_room(request):
+    try:
+        topic = (await request.json())["topic"]
+    except (KeyError, TypeError, ValueError):
+        return JSONResponse({"error": "Invalid request"}, status_code=400)
+    try:
+        username = await chat_api.verify_token(_token(request))
+        room = await chat_api.create_room(topic, username)
+        logger.info("User %s created room %s", username, room["id"])
+        return JSONResponse(room, status_code=201)
+    except ChatAPIError as e:
+        logger.error("Error creating room: %s", e)
+        return _error(e)
+
+
+async def delete_room(request):
+    room_id = request.path_params["room_id"]
+    try:
+        username = await chat_api.verify_token(_token(request))
+        await chat_api.delete_room(room_id, username)
+        logger.info("User %s deleted room %s", username, room_id)
+        return JSONResponse({"success": True})
+    except ChatAPIError as e:
+        logger.error("Error deleting room: %s", e)
+        return _error(e)
+
+
+async def join_room(request):
+    room_id = request.path_params["room_id"]
+    user_id = request.path_params["user_id"]
+    try:
+        if await chat_api.verify_token(_token(request)) != user_id:
+            raise ChatAPIError("Unauthorized", 401)
+        await chat_api.join_room(room_id, user_id)
+        logger.info("User %s joined room %s", user_id, room_id)
+        return JSONResponse({"success": True}, status_code=201)
+    except ChatAPIError as e:
+        logger.error("Error joining room: %s", e)
+        return JSONResponse(
+            {"error": "Error joining room"}, status_code=e.get_status_code()
+        )
+
+
+async def send_message(request):
+    room_id = request.path_params["room_id"]
+    try:
+        body = await request.json()
+        sender_id = body["sender_id"]
+        message = body["message"]
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error("Error getting message from request body: %s", e)
+        return JSONResponse({"error": "Invalid request body format"}, status_code=400)
+    try:
+        if await chat_api.verify_token(_token(request)) != sender_id:
+            raise ChatAPIError("Unauthorized", 401)
+        message_id = await chat_api.send_message(
+            room_id,
+            sender_id,
+            message,
+            idempotency_key=request.headers.get("Idempotency-Key"),
+        )
+        logger.info("Got message from: %s to room: %s", sender_id, room_id)
+        return JSONResponse({"id": message_id})
+    except ChatAPIError as e:
+        logger.error("Error adding message to room: %s", e)
+        return JSONResponse(
+            {"error": "Error sending message"}, status_code=e.get_status_code()
+        )
+
+
+async def get_messages(request: Request):
+    room_id = request.path_params["room_id"]
+    before = request.query_params.get("before")
+    after = request.query_params.get(
+        "after", request.query_params.get("timestamp")
+    )
+    try:
+        limit = int(request.query_params.get("limit", DEFAULT_PAGE_SIZE))
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError("limit out of range")
+    except ValueError as e:
+        logger.error("Invalid history query: %s", e)
+        return JSONResponse({"error": "Invalid query parameters"}, status_code=400)
+    try:
+        page = await chat_api.get_messages_page_raw(room_id, before, after, limit)
+        logger.info("Got %d messages from room: %s", len(page["messages"]), room_id)
+    except ChatAPIError as e:
+        logger.error("Error getting messages from room: %s", e)
+        return JSONResponse(
+            {"error": "Error getting messages from room"},
+            status_code=e.get_status_code(),
+        )
+    headers = _validators(page_etag(page))
+    if _not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(
+        _stream_page(page), media_type="application/json", headers=headers
+    )
+
+
+async def _stream_page(page):
+    """Yield a page of JSON encoded messages as a JSON object, in chunks."""
+    messages = page["messages"]
+    yield b'{"messages": ['
+    for start in range(0, len(messages), STREAM_CHUNK):
+        chunk = b", ".join(messages[start:start + STREAM_CHUNK])
+        yield chunk if start == 0 else b", " + chunk
+    yield b'], "next_cursor": %s}' % json.dumps(page["next_cursor"]).encode("utf-8")
+
+
+async def init_rooms():
+    """Register the default chat rooms, unless they already are."""
+    await chat_api.ensure_rooms(DEFAULT_ROOMS)
+    logger.info("Initialized chat rooms")
+
+
+async def start_presence():
+    """Announce who joins and leaves each room, see chat.socket.start_presence."""
+    loop = asyncio.get_running_loop()
+
+    def notify(room_id, joined, left):
+        asyncio.run_coroutine_threadsafe(_announce(room_id, joined, left), loop)
+
+    presence.start(notify)
+
+
+async def _announce(room_id, joined, left):
+    await sio.emit(
+        "presence", {"room": room_id, "joined": joined, "left": left}, to=room_id
+    )
+    for usernames, action in ((joined, "entered"), (left, "left")):
+        if usernames:
+            await sio.send(summarize(usernames, action), to=room_id)
+
+
+# ----------------------------------------------------------------------
+# Socket.IO events, see chat.socket
+# ----------------------------------------------------------------------
+
+
+@sio.event
+async def connect(sid, environ):
+    logger.info("Client connected")
+    await sio.emit("connected", {"data": "Connected"}, to=sid)
+
+
+@sio.event
+async def disconnect(sid):
+    await asyncio.to_thread(presence.leave, sid)
+    logger.info("Client disconnected")
+
+
+@sio.event
+async def join(sid, data):
+    username = data["username"]
+    room = str(data["room"])
+    previous = await sio.get_session(sid)
+    if previous.get("room") is not None:
+        await sio.leave_room(sid, previous["room"])
+    await sio.enter_room(sid, room)
+    # Every connection lives in one worker, so its session stays in memory.
+    await sio.save_session(sid, {"username": username, "room": room})
+    # Announced with the others of the same second, see start_presence.
+    await asyncio.to_thread(presence.join, sid, room, username)
+    since = data.get("since")
+    try:
+        if data.get("last_id") is not None:
+            since = chat_api.store.cursor({"id": data["last_id"], "timestamp": since})
+        payload = await _page_payload(data, room, after=since, limit=JOIN_BACKFILL)
+        payload["direction"] = "after" if since is not None else "before"
+        await sio.emit("batch", payload, to=sid)
+    except (ChatAPIError, TypeError, ValueError) as e:
+        await sio.emit("error", {"data": str(e)}, to=sid)
+
+
+@sio.event
+async def leave(sid, data):
+    room = str(data["room"])
+    await sio.leave_room(sid, room)
+    await sio.save_session(sid, {})
+    await asyncio.to_thread(presence.leave, sid)
+
+
+@sio.event
+async def message(sid, data):
+    """Store and broadcast a message, and acknowledge it with its id."""
+    room = str(data["room_id"])
+    username = data["username"]
+    text = data["message"]
+    try:
+        msg = chat_api.new_message(username, text)
+        keys = [data.get("idempotency_key")]
+        duplicates = await chat_api.store_messages(room, [msg], keys)
+    except ChatAPIError as e:
+        await sio.emit("error", {"data": str(e)}, to=sid)
+        return None
+    # A retry of a message already stored is only acknowledged.
+    if not duplicates:
+        await _broadcast(room, msg)
+    return {"id": msg.id}
+
+
+@sio.event
+async def messages(sid, data):
+    """Store and broadcast several messages, see chat.socket.handle_messages."""
+    room = str(data["room_id"])
+    username = data["username"]
+    texts = data["messages"]
+    if not isinstance(texts, list) or len(texts) > MAX_SEND_BATCH:
+        error = "Send at most %d messages at once" % MAX_SEND_BATCH
+        await sio.emit("error", {"data": error}, to=sid)
+        return None
+    messages = []
+    try:
+        for text in texts:
+            messages.append(chat_api.new_message(username, text))
+    except ChatAPIError as e:
+        await sio.emit("error", {"data": str(e)}, to=sid)
+    if not messages:
+        return {"ids": [None] * len(texts)}
+    try:
+        await chat_api.store_messages(room, messages)
+    except ChatAPIError as e:
+        await sio.emit("error", {"data": str(e)}, to=sid)
+        return {"ids": [None] * len(texts)}
+    for msg in messages:
+        await _broadcast(room, msg)
+    ids = [msg.id for msg in messages]
+    return {"ids": ids + [None] * (len(texts) - len(ids))}
+
+
+async def _broadcast(room, msg):
+    """Send a stored message to its room, see chat.socket.broadcast."""
+    meta = {"id": msg.id, "timestamp": msg.timestamp}
+    await sio.emit("message", (msg.sender_id + ": " + msg.message, meta), to=room)
+
+
+@sio.event
+async def history(sid, data):
+    """Send a page of older (``before``) or newer (``after``) messages."""
+    room = str(data["room"])
+    direction = "after" if data.get("after") is not None else "before"
+    try:
+        payload = await _page_payload(
+            data,
+            room,
+            before=data.get("before"),
+            after=data.get("after"),
+            limit=data.get("limit", JOIN_BACKFILL),
+        )
+    except (ChatAPIError, TypeError, ValueError) as e:
+        payload = {"error": str(e)}
+    payload["direction"] = direction
+    await sio.emit("history", payload, to=sid)
+
+
+async def _page_payload(data, room, **page):
+    """Return a page of history encoded as the client asked, see chat.socket."""
+    encoding = data.get("encoding")
+    if encoding in available_encodings():
+        page = await chat_api.get_messages_page_encoded(
+            room, encoding=encoding, **page
+        )
+        return {
+            "data": page["data"],
+            "encoding": encoding,
+            "next_cursor": page["next_cursor"],
+        }
+    page = await chat_api.get_messages_page_raw(room, **page)
+    return {
+        "data": [json.loads(raw) for raw in page["messages"]],
+        "next_cursor": page["next_cursor"],
+    }
+
+
+rest = Starlette(
+    routes=[
+        Route("/metrics", get_metrics, methods=["GET"]),
+        Route("/register", register, methods=["POST"]),
+        Route("/login", login, methods=["POST"]),
+        Route("/logout", logout, methods=["POST"]),
+        Route("/rooms", get_rooms, methods=["GET"]),
+        Route("/rooms", create_room, methods=["POST"]),
+        Route("/rooms/{room_id}", delete_room, methods=["DELETE"]),
+        Route("/rooms/{room_id}/users/{user_id}", join_room, methods=["POST"]),
+        Route("/rooms/{room_id}/messages", send_message, methods=["POST"]),
+        Route("/rooms/{room_id}/messages", get_messages, methods=["GET"]),
+    ],
+    on_startup=[init_rooms, start_presence],
+    # Unlike app.py, gzip only, and compressed again for every request.
+    middleware=[
+        Middleware(
+            GZipMiddleware,
+            minimum_size=int(os.environ.get("CHAT_COMPRESS_MIN_BYTES", MIN_SIZE)),
+        )
+    ]
+    if os.environ.get("CHAT_COMPRESS", "1") != "0"
+    else [],
+)
+
+app = socketio.ASGIApp(sio, other_asgi_app=rest)
@@ -0,0 +1,172 @@
+"""Run many headless chat clients in one process against a server.
+
+Usage:
+    python benchmarks/bench_clients.py [--url http://localhost:5002]
+        [--clients 1000] [--rooms 3] [--senders 50] [--messages 20]
+        [--batch-ms 0] [--asgi] [--output results.json]
+
+Every client is a client/chat_client.py ChatClient on one asyncio loop. They
+all join, then --senders of them send --messages messages each, batched
+within --batch-ms milliseconds when it is set. Without --url the server is
+started in-process like bench_load.py does. The result is a JSON object with
+the connect time, the send-to-receive latency percentiles, the throughput
+and the memory each client takes in this process.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+import requests
+
+from bench_load import TIMEOUT, rss, start_server
+from common import percentile
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client")
+)
+
+from chat_client import ChatClient  # noqa: E402
+
+
+class Deliveries:
+    """Record when each message was sent and when each client received it."""
+
+    def __init__(self):
+        self.expected = None
+        self.sent = {}
+        self.latencies = []
+        self.done = asyncio.Event()
+
+    def receive(self, item):
+        sent = self.sent.get(item["message"].rpartition(" ")[2])
+        if sent is None:
+            return
+        self.latencies.append(time.perf_counter() - sent)
+        if self.expected is not None and len(self.latencies) >= self.expected:
+            self.done.set()
+
+
+async def run(args, rooms, run_id):
+    senders = range(min(args.senders, args.clients))
+    deliveries = Deliveries()
+    clients = [
+        ChatClient(
+            args.url,
+            "b%d_%s" % (n, run_id),
+            rooms[n % len(rooms)],
+            on_message=deliveries.receive,
+            buffer_size=args.buffer,
+            send_window=args.batch_ms / 1000,
+            reconnection=False,
+        )
+        for n in range(args.clients)
+    ]
+
+    rss_before = rss(os.getpid())
+    start = time.perf_counter()
+    # Connect a few hundred at a time, like clients arriving.
+    connect_errors = 0
+    for first in range(0, len(clients), 200):
+        batch = clients[first:first + 200]
+        results = await asyncio.gather(
+            *(c.connect() for c in batch), return_exceptions=True
+        )
+        connect_errors += sum(isinstance(r, Exception) for r in results)
+    connected = time.perf_counter() - start
+    # Clients that failed to connect receive nothing.
+    members = {}
+    for client in clients:
+        if client.sio.connected:
+            members[client.room] = members.get(client.room, 0) + 1
+    expected = sum(
+        members.get(rooms[n % len(rooms)], 0) * args.messages for n in senders
+    )
+    deliveries.expected = expected
+    rss_after = rss(os.getpid())
+
+    def send(n, i):
+        key = "%d-%d" % (n, i)
+        deliveries.sent[key] = time.perf_counter()
+        return clients[n].send("bench " + key)
+
+    start = time.perf_counter()
+    # The sends of a client do not wait for the previous one's ack.
+    sends = [send(n, i) for i in range(args.messages) for n in senders]
+    ids = await asyncio.gather(*sends)
+    try:
+        await asyncio.wait_for(deliveries.done.wait(), TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    drained = time.perf_counter() - start
+    await asyncio.gather(*(c.close() for c in clients))
+
+    sent = len(senders) * args.messages
+    result = {
+        "clients": len(clients),
+        "senders": len(senders),
+        "rooms": len(rooms),
+        "batch_ms": args.batch_ms,
+        "messages_sent": sent,
+        "messages_stored": sum(message_id is not None for message_id in ids),
+        "deliveries_expected": expected,
+        "deliveries": len(deliveries.latencies),
+        "connect_errors": connect_errors,
+        "connect_seconds": round(connected, 3),
+        "messages_per_sec": round(sent / drained, 1),
+        "deliveries_per_sec": round(len(deliveries.latencies) / drained, 1),
+        "delivery_p50_ms": _ms(percentile(deliveries.latencies, 50)),
+        "delivery_p99_ms": _ms(percentile(deliveries.latencies, 99)),
+        "client_memory_bytes": None,
+    }
+    if rss_before is not None and rss_after is not None:
+        result["client_memory_bytes"] = (rss_after - rss_before) // len(clients)
+    return result
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url")
+    parser.add_argument("--port", type=int, default=5098)
+    parser.add_argument("--redis-url")
+    parser.add_argument("--rtt-ms", type=float, default=0.5)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=3)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--batch-ms", type=float, default=0)
+    parser.add_argument("--buffer", type=int, default=100)
+    parser.add_argument("--asgi", action="store_true")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    server = None
+    if args.url is None:
+        args.url = "http://127.0.0.1:%d" % args.port
+        server = start_server(args)
+    try:
+        rooms = [room["id"] for room in requests.get(args.url + "/rooms").json()]
+        rooms = sorted(rooms)[: args.rooms]
+        result = asyncio.run(run(args, rooms, uuid.uuid4().hex[:6]))
+        result["stack"] = "asgi" if args.asgi else "app"
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
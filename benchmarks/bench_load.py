@@ -0,0 +1,357 @@
+"""Load-test the REST and Socket.IO paths of a running or in-process server.
+
+Usage:
+    python benchmarks/bench_load.py [--url http://localhost:5002]
+        [--redis-url redis://localhost:6379/15] [--rtt-ms 0.5]
+        [--clients 50] [--rooms 3] [--rest-senders 5] [--messages 20]
+        [--history 100,1000] [--asgi] [--output results.json]
+
+Without --url the server is started in-process (benchmarks/serve.py) against
+--redis-url, or fakeredis with a simulated round-trip time. With --url it
+targets a running server, e.g. the docker-compose stack; pass --server-pid to
+measure its memory, and use rooms whose history is empty. --asgi starts the
+asyncio server (asgi.py) instead of the eventlet one (app.py), to compare
+them.
+
+Socket clients behave like chat_client.py: each joins one of the rooms and
+the socket and REST senders send --messages messages each. The result is a
+single JSON object with the socket send-to-receive latency percentiles, the
+REST send latency, messages per second, join time as the history grows and
+memory per connection. Compare the files of two releases to spot regressions.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import requests
+import socketio
+
+from common import percentile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds to wait for the server to start, a join to be answered, or the
+# last message to be delivered.
+TIMEOUT = 30
+
+
+class Deliveries:
+    """Record when each message was sent and when each client received it."""
+
+    def __init__(self):
+        self.sent = {}
+        self.latencies = []
+        self.received = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def send(self, key):
+        self.sent[key] = time.perf_counter()
+
+    def receive(self, text, meta=None):
+        now = time.perf_counter()
+        key = text.rpartition(" ")[2]
+        with self.lock:
+            sent = self.sent.get(key)
+            if sent is None:
+                return
+            self.latencies.append(now - sent)
+            self.received += 1
+            self.changed.notify_all()
+
+    def receive_batch(self, data):
+        for text in data["messages"]:
+            self.receive(text)
+
+    def wait(self, expected, timeout=TIMEOUT):
+        with self.lock:
+            return self.changed.wait_for(lambda: self.received >= expected, timeout)
+
+
+class BenchClient:
+    """A socket client that joins a room like chat_client.py does."""
+
+    def __init__(self, url, username, room, deliveries=None):
+        self.url = url
+        self.username = username
+        self.room = room
+        self.joined = threading.Event()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("batch", self._on_batch)
+        if deliveries is not None:
+            self.sio.on("message", deliveries.receive)
+            self.sio.on("message_batch", deliveries.receive_batch)
+
+    def _on_batch(self, data):
+        self.joined.set()
+
+    def join(self):
+        """Connect, join the room and return the seconds until the backfill."""
+        self.sio.connect(self.url, transports=["websocket"])
+        start = time.perf_counter()
+        self.sio.emit("join", {"username": self.username, "room": self.room})
+        if not self.joined.wait(TIMEOUT):
+            raise RuntimeError("%s got no backfill" % self.username)
+        return time.perf_counter() - start
+
+    def send(self, message):
+        self.sio.emit(
+            "message",
+            {"username": self.username, "message": message, "room_id": self.room},
+        )
+
+    def close(self):
+        self.sio.disconnect()
+
+
+class RestSender:
+    """A user sending messages through POST /rooms/<room_id>/messages."""
+
+    def __init__(self, url, username, room):
+        self.url = url
+        self.username = username
+        self.room = room
+        self.session = requests.Session()
+        self.latencies = []
+        credentials = {"username": username, "password": "benchmark"}
+        self.session.post(url + "/register", json=credentials)
+        response = self.session.post(url + "/login", json=credentials)
+        response.raise_for_status()
+        self.session.headers["Authorization"] = "Bearer " + response.json()["token"]
+
+    def send(self, message):
+        start = time.perf_counter()
+        response = self.session.post(
+            "%s/rooms/%s/messages" % (self.url, self.room),
+            json={"sender_id": self.username, "message": message},
+        )
+        response.raise_for_status()
+        self.latencies.append(time.perf_counter() - start)
+
+
+def start_server(args):
+    """Start benchmarks/serve.py and return its process once it answers."""
+    command = [
+        sys.executable,
+        os.path.join(BENCH_DIR, "serve.py"),
+        "--port",
+        str(args.port),
+        "--rtt-ms",
+        str(args.rtt_ms),
+        "--rooms",
+        # One more room for the backfill benchmark.
+        str(args.rooms + 1),
+    ]
+    if args.redis_url:
+        command += ["--redis-url", args.redis_url]
+    if args.asgi:
+        command.append("--asgi")
+    server = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            requests.get(args.url + "/rooms").raise_for_status()
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The server did not start, run benchmarks/serve.py to see why")
+
+
+def rss(pid):
+    """Return the resident memory of process ``pid`` in bytes, or None."""
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, TypeError):
+        pass
+    return None
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target, args=(n,)) for n in range(count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def bench_fanout(args, rooms, run_id):
+    """Connect the socket clients, send messages and time their delivery."""
+    deliveries = Deliveries()
+    clients = [
+        BenchClient(args.url, "c%d_%s" % (n, run_id), rooms[n % len(rooms)], deliveries)
+        for n in range(args.clients)
+    ]
+    rss_before = rss(args.server_pid)
+    join_times = [None] * len(clients)
+
+    def join(n):
+        join_times[n] = clients[n].join()
+
+    run_threads(join, len(clients))
+    rss_after = rss(args.server_pid)
+
+    senders = [
+        RestSender(args.url, "r%d_%s" % (n, run_id), rooms[n % len(rooms)])
+        for n in range(args.rest_senders)
+    ]
+    members = {}
+    for client in clients:
+        members[client.room] = members.get(client.room, 0) + 1
+    everyone = [(client, "socket") for client in clients]
+    everyone += [(sender, "rest") for sender in senders]
+    # Messages sent through the REST API are stored but not pushed to the
+    # sockets.
+    expected = sum(members[client.room] * args.messages for client in clients)
+
+    def send(n):
+        sender, kind = everyone[n]
+        for i in range(args.messages):
+            key = "%s-%d-%d" % (kind, n, i)
+            deliveries.send(key)
+            sender.send("bench " + key)
+
+    start = time.perf_counter()
+    elapsed = run_threads(send, len(everyone))
+    delivered = deliveries.wait(expected)
+    drained = time.perf_counter() - start
+    for client in clients:
+        client.close()
+
+    sent = len(everyone) * args.messages
+    rest_latencies = [latency for sender in senders for latency in sender.latencies]
+    result = {
+        "clients": len(clients),
+        "rest_senders": len(senders),
+        "rooms": len(rooms),
+        "messages_sent": sent,
+        "deliveries_expected": expected,
+        "deliveries": deliveries.received,
+        "complete": delivered,
+        "send_seconds": round(elapsed, 4),
+        "messages_per_sec": round(sent / elapsed, 1),
+        "deliveries_per_sec": round(deliveries.received / drained, 1),
+        "delivery_p50_ms": _ms(percentile(deliveries.latencies, 50)),
+        "delivery_p99_ms": _ms(percentile(deliveries.latencies, 99)),
+        "rest_send_p50_ms": _ms(percentile(rest_latencies, 50)),
+        "rest_send_p99_ms": _ms(percentile(rest_latencies, 99)),
+        "join_p50_ms": _ms(percentile(join_times, 50)),
+        "join_p99_ms": _ms(percentile(join_times, 99)),
+        "memory_per_connection_bytes": None,
+    }
+    if rss_before is not None and rss_after is not None:
+        result["memory_per_connection_bytes"] = (rss_after - rss_before) // len(
+            clients
+        )
+    return result
+
+
+def bench_backfill(args, room, run_id):
+    """Time joining ``room`` while its history grows to each --history size."""
+    sender = RestSender(args.url, "h_%s" % run_id, room)
+    results = []
+    stored = 0
+    for size in args.history:
+        for i in range(stored, size):
+            sender.send("history %d" % i)
+        stored = max(stored, size)
+        join_times = []
+        for n in range(args.joins):
+            client = BenchClient(args.url, "j%d_%s" % (n, run_id), room)
+            join_times.append(client.join())
+            client.close()
+        results.append(
+            {
+                "history": stored,
+                "join_p50_ms": _ms(percentile(join_times, 50)),
+                "join_p99_ms": _ms(percentile(join_times, 99)),
+            }
+        )
+    return results
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCH_DIR,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--server-pid", type=int)
+    parser.add_argument("--redis-url")
+    parser.add_argument("--rtt-ms", type=float, default=0.5)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--rooms", type=int, default=3)
+    parser.add_argument("--rest-senders", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument(
+        "--history",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[100, 1000],
+    )
+    parser.add_argument("--joins", type=int, default=10)
+    parser.add_argument("--asgi", action="store_true")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    server = None
+    if args.url is None:
+        args.url = "http://127.0.0.1:%d" % args.port
+        server = start_server(args)
+        args.server_pid = server.pid
+    try:
+        rooms = [room["id"] for room in requests.get(args.url + "/rooms").json()]
+        rooms = sorted(rooms)[: args.rooms + 1]
+        if len(rooms) < 2:
+            raise RuntimeError("The benchmark needs at least two rooms")
+        # The last room is kept for the backfill benchmark.
+        fanout_rooms, backfill_room = rooms[:-1], rooms[-1]
+        run_id = uuid.uuid4().hex[:6]
+        result = {
+            "revision": _revision(),
+            "time": time.time(),
+            "server": "in-process" if server else args.url,
+            "stack": "asgi" if args.asgi else "app",
+            "rtt_ms": args.rtt_ms if server and not args.redis_url else None,
+            "fanout": bench_fanout(args, fanout_rooms, run_id),
+            "backfill": bench_backfill(args, backfill_room, run_id),
+        }
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
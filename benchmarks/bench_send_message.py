@@ -0,0 +1,99 @@
+"""Compare the direct send_message path with the batching writer.
+
+Usage:
+    python benchmarks/bench_send_message.py [--redis-url redis://localhost:6379/15]
+        [--rtt-ms 0.5] [--senders 50] [--messages 40] [--rooms 4]
+
+Without --redis-url the benchmark runs against fakeredis with a simulated
+round-trip time. Results are printed as JSON, one object per mode.
+"""
+import argparse
+import json
+import threading
+import time
+
+from common import make_redis, percentile
+
+from chat.api import ChatAPI
+from chat.batching import MessageBatcher
+
+
+def run_direct(chat_api, senders, messages, rooms):
+    latencies = []
+
+    def sender(n):
+        for i in range(messages):
+            start = time.perf_counter()
+            chat_api.send_message(n % rooms, "sender%d" % n, "message %d" % i)
+            latencies.append(time.perf_counter() - start)
+
+    return _run_senders(sender, senders), latencies
+
+
+def run_batched(chat_api, senders, messages, rooms, window, max_batch):
+    batcher = MessageBatcher(chat_api, window=window, max_batch=max_batch)
+    batcher.start()
+    latencies = []
+
+    def sender(n):
+        for i in range(messages):
+            start = time.perf_counter()
+            done = threading.Event()
+            batcher.submit(
+                n % rooms, "sender%d" % n, "message %d" % i, lambda m, e, d: done.set()
+            )
+            done.wait()
+            latencies.append(time.perf_counter() - start)
+
+    return _run_senders(sender, senders), latencies
+
+
+def _run_senders(target, senders):
+    threads = [threading.Thread(target=target, args=(n,)) for n in range(senders)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def report(mode, elapsed, latencies):
+    return {
+        "mode": mode,
+        "messages": len(latencies),
+        "seconds": round(elapsed, 4),
+        "messages_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-url")
+    parser.add_argument("--rtt-ms", type=float, default=0.5)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--window-ms", type=float, default=2.0)
+    parser.add_argument("--max-batch", type=int, default=100)
+    args = parser.parse_args()
+
+    redis = make_redis(args.redis_url, args.rtt_ms)
+    chat_api = ChatAPI(redis)
+    elapsed, latencies = run_direct(chat_api, args.senders, args.messages, args.rooms)
+    print(json.dumps(report("direct", elapsed, latencies)))
+    elapsed, latencies = run_batched(
+        chat_api,
+        args.senders,
+        args.messages,
+        args.rooms,
+        args.window_ms / 1000,
+        args.max_batch,
+    )
+    print(json.dumps(report("batched", elapsed, latencies)))
+
+
+if __name__ == "__main__":
+    main()
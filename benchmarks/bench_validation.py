@@ -0,0 +1,62 @@
+"""Time the validation and encoding of a sent message.
+
+Usage:
+    python benchmarks/bench_validation.py [--number 100000] [--users 100]
+
+Compares building the User and Message models, setting the id and encoding
+the message dict with json.dumps, as ChatAPI did, with chat.models.new_message,
+set_id and the pydantic-core encoder of chat.codec. Results are printed as
+JSON, in microseconds per message.
+"""
+import argparse
+import json
+import time
+import timeit
+
+import common  # noqa: F401 - puts the repository on sys.path
+
+from chat.codec import encode_json, get_model_encoder
+from chat.models import Message, User, new_message, set_id
+
+
+def models_path(sender_id, text):
+    user = User(name=sender_id)
+    msg = Message(sender_id=user.name, timestamp=time.time(), message=text)
+    msg.id = 1
+    return encode_json(msg.model_dump())
+
+
+def fast_path(sender_id, text, encode=get_model_encoder("json")):
+    msg = new_message(sender_id, text, time.time())
+    set_id(msg, 1)
+    return encode(msg)
+
+
+def bench(path, senders, number):
+    texts = ["message %d" % i for i in range(100)]
+    calls = [(senders[i % len(senders)], texts[i % len(texts)]) for i in range(1000)]
+
+    def run():
+        for sender_id, text in calls:
+            path(sender_id, text)
+
+    return timeit.timeit(run, number=number // len(calls)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    senders = ["user%d" % n for n in range(args.users)]
+    results = {
+        "models_us": round(bench(models_path, senders, args.number), 3),
+        "fast_us": round(bench(fast_path, senders, args.number), 3),
+    }
+    results["speedup"] = round(results["models_us"] / results["fast_us"], 2)
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
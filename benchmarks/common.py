@@ -0,0 +1,125 @@
+"""Helpers shared by the benchmarks."""
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+class LatencyRedis:
+    """Proxy a Redis client, adding a fixed round-trip time to every command.
+
+    A pipeline costs a single round-trip, like it does against a real server.
+    """
+
+    def __init__(self, redis, rtt):
+        self._redis = redis
+        self._rtt = rtt
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args, **kwargs):
+        time.sleep(self._rtt)
+        with self._lock:
+            return method(*args, **kwargs)
+
+    def pipeline(self, *args, **kwargs):
+        return _LatencyPipeline(self, self._redis.pipeline(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self._redis, name)
+        if not callable(attr):
+            return attr
+        return lambda *args, **kwargs: self._call(attr, *args, **kwargs)
+
+
+class _LatencyPipeline:
+    def __init__(self, owner, pipe):
+        self._owner = owner
+        self._pipe = pipe
+
+    def execute(self, *args, **kwargs):
+        return self._owner._call(self._pipe.execute, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+
+def make_redis(url=None, rtt_ms=0.0):
+    """Connect to ``url``, or create an in-process fake Redis.
+
+    The fake needs the ``fakeredis`` package. ``rtt_ms`` adds a simulated
+    network round-trip to every command sent to the fake.
+    """
+    if url:
+        from redis import Redis
+
+        return Redis.from_url(url)
+    import fakeredis
+
+    redis = fakeredis.FakeRedis()
+    return LatencyRedis(redis, rtt_ms / 1000) if rtt_ms else redis
+
+
+class AsyncLatencyRedis:
+    """Like LatencyRedis, for a ``redis.asyncio`` client."""
+
+    def __init__(self, redis, rtt):
+        self._redis = redis
+        self._rtt = rtt
+
+    def pipeline(self, *args, **kwargs):
+        return _AsyncLatencyPipeline(self._rtt, self._redis.pipeline(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self._redis, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(self._rtt)
+            return await attr(*args, **kwargs)
+
+        return call
+
+
+class _AsyncLatencyPipeline:
+    def __init__(self, rtt, pipe):
+        self._rtt = rtt
+        self._pipe = pipe
+
+    async def __aenter__(self):
+        await self._pipe.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self._pipe.__aexit__(*exc_info)
+
+    async def execute(self, *args, **kwargs):
+        await asyncio.sleep(self._rtt)
+        return await self._pipe.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+
+def make_async_redis(url=None, rtt_ms=0.0):
+    """Like make_redis, returning a ``redis.asyncio`` client."""
+    if url:
+        from redis.asyncio import Redis
+
+        return Redis.from_url(url)
+    from fakeredis.aioredis import FakeRedis
+
+    redis = FakeRedis()
+    return AsyncLatencyRedis(redis, rtt_ms / 1000) if rtt_ms else redis
+
+
+def percentile(values, pct):
+    """Return the ``pct`` percentile of ``values`` (nearest rank)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
@@ -0,0 +1,72 @@
+"""Run the chat server in-process for the load benchmark.
+
+Usage:
+    python benchmarks/serve.py [--port 5002] [--redis-url redis://localhost:6379/15]
+        [--rtt-ms 0.0] [--rooms 3] [--asgi]
+
+The server uses ``--redis-url``, or fakeredis with a simulated round-trip
+time, instead of the ``redis`` host of docker-compose. ``--rooms`` creates
+more rooms than the three the server starts with. ``--asgi`` runs asgi.py
+under uvicorn instead of app.py.
+"""
+import argparse
+
+from common import make_async_redis, make_redis
+
+from chat import connection
+from chat.models import ChatRoom
+
+
+def extra_rooms(count):
+    """Return the rooms added to the three default ones, up to ``count``."""
+    return [
+        ChatRoom(id=room_id, topic="room%d" % room_id)
+        for room_id in range(4, count + 1)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5002)
+    parser.add_argument("--redis-url")
+    parser.add_argument("--rtt-ms", type=float, default=0.0)
+    parser.add_argument("--rooms", type=int, default=3)
+    parser.add_argument("--asgi", action="store_true")
+    args = parser.parse_args()
+    if args.asgi:
+        serve_asgi(args)
+        return
+
+    redis = make_redis(args.redis_url, args.rtt_ms)
+    # chat.routes connects to Redis when it is imported.
+    connection.redis_from_env = lambda *args, **kwargs: redis
+
+    from app import app, socketio
+    from chat.routes import chat_api
+
+    chat_api.rooms.ensure(extra_rooms(args.rooms))
+    chat_api.invalidate_rooms()
+
+    socketio.run(app, host=args.host, port=args.port, allow_unsafe_werkzeug=True)
+
+
+def serve_asgi(args):
+    import redis.asyncio as redis_asyncio
+    import uvicorn
+
+    redis = make_async_redis(args.redis_url, args.rtt_ms)
+    # asgi connects to Redis when it is imported.
+    redis_asyncio.Redis = lambda *args, **kwargs: redis
+
+    import asgi
+
+    async def add_rooms():
+        await asgi.chat_api.ensure_rooms(extra_rooms(args.rooms))
+
+    asgi.rest.router.on_startup.append(add_rooms)
+    uvicorn.run(asgi.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""Asyncio version of the chat API, used by the ASGI server (asgi.py).
+
+AsyncChatAPI keeps the semantics of ChatAPI: the same validation, Redis keys,
+scripts, errors and message encodings, so that both servers can share a
+database and serve the same clients. It covers the requests served by
+asgi.py with the messages kept in sorted sets. The messages it stores are
+indexed for search and added to the history cached by the eventlet workers,
+but the stream storage, archive, search queries, presence queries, rate
+limits and history cache are only available on the eventlet server.
+"""
+import time
+import uuid
+
+from pydantic import ValidationError
+from redis.exceptions import RedisError
+
+from .api import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, TOKEN_TTL
+from .cache import INVALIDATION_CHANNEL, history_append
+from .codec import available_encodings, pack_list, to_json, to_msgpack
+from .errors import ChatAPIError
+from .logger import logger
+from .models import ChatRoom, new_message, validate_username
+from .passwords import hash_password, run_blocking_async, verify_password
+from .rooms import (
+    CREATE_ROOM_SCRIPT,
+    MAX_ROOMS_PAGE_SIZE,
+    MEMBER_SCRIPT,
+    ROOMS_PAGE_SIZE,
+    RoomRegistry,
+)
+from .search import SearchIndex
+from .storage import ZSET_APPEND_SCRIPT, ZSetMessageStore
+
+
+class AsyncChatAPI:
+    """Internal Chat API for asyncio, on a ``redis.asyncio`` client.
+
+    The client keeps a pool of connections shared by every request, and the
+    requests needing several commands send them in one pipeline.
+    """
+
+    def __init__(self, redis, encoding="json", search=False):
+        self.redis = redis
+        # Only used for their keys, cursors, encoders, parsers and queued
+        # commands, never to reach Redis.
+        self.store = ZSetMessageStore(None, encoding)
+        self.rooms = RoomRegistry(None)
+        self.index = SearchIndex(None) if search else None
+        self._append = redis.register_script(ZSET_APPEND_SCRIPT)
+        self._create_room = redis.register_script(CREATE_ROOM_SCRIPT)
+        self._member = redis.register_script(MEMBER_SCRIPT)
+
+    # ------------------------------------------------------------------
+    # User Authentication helpers
+    # ------------------------------------------------------------------
+
+    async def register_user(self, username: str, password: str):
+        """Register a new user, see ChatAPI.register_user."""
+        try:
+            name = validate_username(username)
+            if await self.redis.hexists("users", name):
+                raise ChatAPIError("User already exists", 400)
+            hashed = await run_blocking_async(hash_password, password)
+            if not await self.redis.hsetnx("users", name, hashed):
+                raise ChatAPIError("User already exists", 400)
+        except (RedisError, ValidationError) as e:
+            raise ChatAPIError("Error registering user", 422) from e
+
+    async def login_user(self, username: str, password: str) -> str:
+        """Authenticate a user and return a token, see ChatAPI.login_user."""
+        try:
+            name = validate_username(username)
+            stored = await self.redis.hget("users", name)
+            if not stored:
+                raise ChatAPIError("Invalid credentials", 401)
+            valid, needs_rehash = await run_blocking_async(
+                verify_password, password, stored.decode("utf-8")
+            )
+            if not valid:
+                raise ChatAPIError("Invalid credentials", 401)
+            token = str(uuid.uuid4())
+            async with self.redis.pipeline(transaction=False) as pipe:
+                if needs_rehash:
+                    pipe.hset(
+                        "users",
+                        name,
+                        await run_blocking_async(hash_password, password),
+                    )
+                pipe.set("token:%s" % token, name, ex=TOKEN_TTL)
+                await pipe.execute()
+            return token
+        except (RedisError, ValidationError) as e:
+            raise ChatAPIError("Error logging in", 401) from e
+
+    async def logout_user(self, token: str):
+        """Revoke an authentication token."""
+        try:
+            await self.redis.delete("token:%s" % token)
+        except RedisError as e:
+            raise ChatAPIError("Error logging out") from e
+
+    async def verify_token(self, token: str) -> str:
+        """Return the username for an authentication token.
+
+        Unlike ChatAPI, tokens are not cached, so a revoked token is refused
+        at once.
+        """
+        try:
+            name = await self.redis.get("token:%s" % token)
+        except RedisError as e:
+            raise ChatAPIError("Unauthorized", 401) from e
+        if not name:
+            raise ChatAPIError("Unauthorized", 401)
+        return name.decode("utf-8")
+
+    async def get_rooms(self):
+        """Get all chat rooms, in id order."""
+        rooms = []
+        cursor = None
+        while True:
+            page = await self.get_rooms_page(cursor=cursor, limit=MAX_ROOMS_PAGE_SIZE)
+            rooms += page["rooms"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return rooms
+
+    async def get_rooms_page(self, sort="id", cursor=None, limit=ROOMS_PAGE_SIZE):
+        """Get a page of chat rooms, see ChatAPI.get_rooms_page.
+
+        Pages are not cached.
+        """
+        try:
+            start = self.rooms.parse_cursor(sort, cursor)
+            command, args, kwargs = self.rooms.range_args(sort, start, limit)
+            ids = await getattr(self.redis, command)(*args, **kwargs)
+            infos = []
+            if ids:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for room_id in ids[:limit]:
+                        pipe.hgetall(self.rooms.info_key(room_id.decode("utf-8")))
+                    infos = await pipe.execute()
+        except ValueError as e:
+            raise ChatAPIError("Invalid room list query", 400) from e
+        except RedisError as e:
+            raise ChatAPIError("Error getting chat rooms") from e
+        return self.rooms.make_page(sort, start, limit, ids, infos)
+
+    async def create_room(self, topic, owner):
+        """Create a chat room, see ChatAPI.create_room."""
+        try:
+            keys, args = self.rooms.create_args(topic, owner)
+            room_id = await self._create_room(keys=keys, args=args)
+        except ValidationError as e:
+            raise ChatAPIError("Invalid room topic", 422) from e
+        except RedisError as e:
+            raise ChatAPIError("Error creating room") from e
+        return ChatRoom(id=room_id, topic=args[0]).model_dump()
+
+    async def delete_room(self, room_id, user_id):
+        """Delete a chat room created by ``user_id``, see ChatAPI.delete_room."""
+        try:
+            info = await self.redis.hgetall(self.rooms.info_key(room_id))
+            if not info:
+                raise ChatAPIError("Room does not exist", 404)
+            if info.get(b"owner") != user_id.encode("utf-8"):
+                raise ChatAPIError("Forbidden", 403)
+            async with self.redis.pipeline() as pipe:
+                self.rooms.queue_delete(pipe, room_id)
+                await pipe.execute()
+        except RedisError as e:
+            raise ChatAPIError("Error deleting room") from e
+
+    async def ensure_rooms(self, rooms):
+        """Register the rooms not registered yet, see RoomRegistry.ensure."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for room in rooms:
+                pipe.exists(self.rooms.info_key(room.id))
+                pipe.scard(self.rooms.users_key(room.id))
+            missing = self.rooms.missing(rooms, await pipe.execute())
+        if missing:
+            async with self.redis.pipeline() as pipe:
+                for room, members in missing:
+                    self.rooms.queue_create(pipe, room, members=members)
+                await pipe.execute()
+        return [room.id for room, _ in missing]
+
+    async def join_room(self, room_id, user_id):
+        """Join a chat room."""
+        try:
+            name = validate_username(user_id)
+            keys, args = self.rooms.member_args(room_id, name, True)
+            reply = await self._member(keys=keys, args=args)
+            if self.rooms.member_changed(reply) is None:
+                raise ChatAPIError("Room does not exist", 404)
+        except (RedisError, ValidationError) as e:
+            raise ChatAPIError("Error joining room", 422) from e
+
+    async def leave_room(self, room_id, user_id):
+        """Leave a chat room."""
+        try:
+            name = validate_username(user_id)
+            keys, args = self.rooms.member_args(room_id, name, False)
+            reply = await self._member(keys=keys, args=args)
+            if self.rooms.member_changed(reply) is None:
+                raise ChatAPIError("Room does not exist")
+        except (RedisError, ValidationError) as e:
+            raise ChatAPIError("Error leaving room") from e
+
+    # ------------------------------------------------------------------
+    # Messages
+    # ------------------------------------------------------------------
+
+    def new_message(self, sender_id, message):
+        """Validate and timestamp a message without storing it."""
+        try:
+            return new_message(sender_id, message, time.time())
+        except ValidationError as e:
+            raise ChatAPIError("Error sending message", 422) from e
+
+    async def send_message(self, room_id, sender_id, message, idempotency_key=None):
+        """Send a message to a chat room, see ChatAPI.send_message.
+
+        Returns:
+            The message id.
+
+        """
+        msg = self.new_message(sender_id, message)
+        await self.store_messages(room_id, [msg], [idempotency_key])
+        return msg.id
+
+    async def store_messages(self, room_id, messages, idempotency_keys=None):
+        """Store validated messages of a room in one round trip.
+
+        Like ChatAPI.store_messages, their ids are set once they are stored,
+        and they are then indexed for search and added to the history cached
+        by the eventlet workers, with one more pipelined round trip.
+
+        Returns:
+            The indexes of the messages that were already stored with their
+            idempotency key. Those get the id of the stored message.
+
+        """
+        keys, args = self.store.append_args(room_id, messages, idempotency_keys)
+        try:
+            reply = await self._append(keys=keys, args=args)
+        except RedisError as e:
+            raise ChatAPIError("Error sending message", 422) from e
+        duplicates = self.store.set_ids(messages, reply)
+        stored = [msg for n, msg in enumerate(messages) if n not in duplicates]
+        if stored:
+            await self._after_store(str(room_id), stored)
+        return duplicates
+
+    async def _after_store(self, room_id, messages):
+        """Announce stored messages, see ChatAPI._store_batch."""
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                store = self.store
+                dumps = [msg.model_dump() for msg in messages]
+                items = [
+                    (store.encode(msg), store.position(dump), store.cursor(dump))
+                    for msg, dump in zip(messages, dumps)
+                ]
+                pipe.publish(INVALIDATION_CHANNEL, history_append(room_id, items))
+                if self.index is not None:
+                    self.index.queue_add(pipe, room_id, dumps)
+                self.rooms.queue_touch(pipe, room_id, messages[-1].timestamp)
+                await pipe.execute()
+        except RedisError:
+            # The messages are stored, only caches, search and the activity
+            # order of the room list are out of date.
+            logger.exception("Error announcing messages of room %s", room_id)
+
+    async def get_messages_page_raw(
+        self,
+        room_id,
+        before=None,
+        after=None,
+        limit=DEFAULT_PAGE_SIZE,
+        encoding="json",
+    ):
+        """Get a page of encoded messages, see ChatAPI.get_messages_page_raw."""
+        if encoding not in available_encodings():
+            raise ChatAPIError("Unsupported encoding", 400)
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        try:
+            raws, next_cursor = await self._run_steps(
+                self.store.page_steps(room_id, before, after, limit)
+            )
+        except (TypeError, ValueError) as e:
+            raise ChatAPIError("Invalid cursor", 400) from e
+        except RedisError as e:
+            raise ChatAPIError("Error getting messages", 422) from e
+
+        try:
+            convert = to_msgpack if encoding == "msgpack" else to_json
+            raws = [convert(raw) for raw in raws]
+        except ValueError as e:
+            raise ChatAPIError("Error getting messages", 422) from e
+        return {"messages": raws, "next_cursor": next_cursor}
+
+    async def _run_steps(self, steps):
+        """Run a generator of pipelined commands, see chat.storage.run_steps."""
+        try:
+            commands = next(steps)
+            while True:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for command, args, kwargs in commands:
+                        getattr(pipe, command)(*args, **kwargs)
+                    replies = await pipe.execute()
+                commands = steps.send(replies)
+        except StopIteration as e:
+            return e.value
+
+    async def get_messages_page_encoded(
+        self,
+        room_id,
+        before=None,
+        after=None,
+        limit=DEFAULT_PAGE_SIZE,
+        encoding="msgpack",
+    ):
+        """Get a page of messages as a single encoded payload."""
+        page = await self.get_messages_page_raw(
+            room_id, before, after, limit, encoding
+        )
+        if encoding == "msgpack":
+            data = pack_list(page["messages"])
+        else:
+            data = b"[" + b", ".join(page["messages"]) + b"]"
+        return {"data": data, "next_cursor": page["next_cursor"]}
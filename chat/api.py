@@ -1,22 +1,108 @@
+import hashlib
 import json
+import os
 try:
     from redis import RedisError
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from redis.exceptions import TimeoutError as RedisTimeoutError
 except Exception:  # pragma: no cover - redis might not be installed
     class RedisError(Exception):
         pass
+
+    class RedisConnectionError(RedisError):
+        pass
+
+    class RedisTimeoutError(RedisError):
+        pass
 from pydantic import ValidationError
 import time
 import uuid
-import hashlib
-from .errors import ChatAPIError
-from .models import Message, ChatRoom, User
+from .cache import ChatCache, MISSING
+from .codec import (
+    available_encodings,
+    decode,
+    get_encoder,
+    pack_list,
+    to_json,
+    to_msgpack,
+)
+from .errors import ChatAPIError, RateLimitedError
+from .logger import logger
+from .models import new_message, validate_username
+from .passwords import hash_password, run_blocking, verify_password
+from .retention import ARCHIVED_KEY
+from .rooms import MAX_ROOMS_PAGE_SIZE, ROOMS_PAGE_SIZE, RoomRegistry
+from .storage import STREAM_CLOCK_SKEW_MS, ZSetMessageStore
+
+# Default and maximum number of messages returned by a history page.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Seconds an authentication token stays valid.
+TOKEN_TTL = int(os.environ.get("CHAT_TOKEN_TTL", 24 * 60 * 60))
+
+
+def page_etag(page):
+    """Return the ETag of a page of encoded messages, hashed from its content.
+
+    A version read apart from the page, such as the id of the newest message,
+    could tag a page missing that message, and the clients revalidating it
+    would not see the message until the next one.
+    """
+    digest = hashlib.sha1()
+    for raw in page["messages"]:
+        digest.update(b"%d:" % len(raw))
+        digest.update(raw)
+    digest.update(json.dumps(page["next_cursor"]).encode("utf-8"))
+    return digest.hexdigest()
 
 
 class ChatAPI:
     """Internal Chat API."""
 
-    def __init__(self, redis):
+    def __init__(
+        self,
+        redis,
+        cache=None,
+        store=None,
+        archive=None,
+        index=None,
+        presence=None,
+        limiter=None,
+        replica=None,
+        rooms=None,
+    ):
         self.redis = redis
+        # Read-only queries that can lag behind the primary go to the replica.
+        self.replica = replica if replica is not None else redis
+        self.cache = cache if cache is not None else ChatCache(redis)
+        self.store = store if store is not None else ZSetMessageStore(redis)
+        self.rooms = (
+            rooms if rooms is not None else RoomRegistry(redis, replica=self.replica)
+        )
+        self.archive = archive
+        # Rooms known to have archived messages: archives are never removed.
+        self._archived_rooms = set()
+        self.index = index
+        self.presence = presence
+        self.limiter = limiter
+
+    def cache_stats(self):
+        """Return the hit/miss counters of the per-process caches."""
+        return self.cache.stats()
+
+    def invalidate_rooms(self):
+        """Drop the cached room list and room ids in every worker."""
+        self.cache.invalidate("rooms")
+        self.cache.invalidate("room_ids")
+
+    def _room_exists(self, room_id):
+        key = str(room_id)
+        exists = self.cache.room_ids.get(key)
+        if exists is MISSING:
+            exists = bool(self.redis.sismember("rooms_ids", room_id))
+            self.cache.room_ids.set(key, exists)
+        return exists
 
     # ------------------------------------------------------------------
     # User Authentication helpers
@@ -33,42 +119,68 @@ class ChatAPI:
             ChatAPIError: If the user already exists or data is invalid
         """
         try:
-            user = User(name=username)
-            if self.redis.hexists("users", user.name):
+            name = validate_username(username)
+            if self.redis.hexists("users", name):
+                raise ChatAPIError("User already exists", 400)
+            hashed = run_blocking(hash_password, password)
+            if not self.redis.hsetnx("users", name, hashed):
                 raise ChatAPIError("User already exists", 400)
-            hashed = hashlib.sha256(password.encode()).hexdigest()
-            self.redis.hset("users", user.name, hashed)
         except (RedisError, ValidationError) as e:
             raise ChatAPIError("Error registering user", 422) from e
 
     def login_user(self, username: str, password: str) -> str:
-        """Authenticate a user and return a token."""
+        """Authenticate a user and return a token valid for TOKEN_TTL seconds.
+
+        Password hashes from older versions are upgraded on success.
+        """
         try:
-            user = User(name=username)
-            stored = self.redis.hget("users", user.name)
+            name = validate_username(username)
+            stored = self.redis.hget("users", name)
             if not stored:
                 raise ChatAPIError("Invalid credentials", 401)
-            hashed = hashlib.sha256(password.encode()).hexdigest()
-            if stored.decode("utf-8") != hashed:
+            valid, needs_rehash = run_blocking(
+                verify_password, password, stored.decode("utf-8")
+            )
+            if not valid:
                 raise ChatAPIError("Invalid credentials", 401)
+            if needs_rehash:
+                self.redis.hset("users", name, run_blocking(hash_password, password))
             token = str(uuid.uuid4())
-            self.redis.hset("tokens", token, user.name)
+            self.redis.set("token:%s" % token, name, ex=TOKEN_TTL)
             return token
         except (RedisError, ValidationError) as e:
             raise ChatAPIError("Error logging in", 401) from e
 
+    def logout_user(self, token: str):
+        """Revoke an authentication token in every worker."""
+        try:
+            self.redis.delete("token:%s" % token)
+        except RedisError as e:
+            raise ChatAPIError("Error logging out") from e
+        self.cache.invalidate("tokens", token)
+
     def verify_token(self, token: str) -> str:
-        """Return the username for an authentication token."""
+        """Return the username for an authentication token.
+
+        Tokens are cached per process for at most the cache TTL, so a token
+        may be accepted for that long after it expired or was revoked in a
+        worker that missed the invalidation.
+        """
+        name = self.cache.tokens.get(token)
+        if name is not MISSING:
+            return name
         try:
-            name = self.redis.hget("tokens", token)
+            name = self.redis.get("token:%s" % token)
             if not name:
                 raise ChatAPIError("Unauthorized", 401)
-            return name.decode("utf-8")
+            name = name.decode("utf-8")
+            self.cache.tokens.set(token, name)
+            return name
         except RedisError as e:
             raise ChatAPIError("Unauthorized", 401) from e
 
     def get_rooms(self):
-        """Get all chat rooms.
+        """Get all chat rooms, in id order.
 
         Returns:
             An object containing the chat rooms.
@@ -77,12 +189,98 @@ class ChatAPI:
             ChatAPIError: An error occurred while getting the chat rooms.
 
         """
+        rooms = []
+        cursor = None
+        while True:
+            page = self.get_rooms_page(cursor=cursor, limit=MAX_ROOMS_PAGE_SIZE)
+            rooms += page["rooms"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return rooms
+
+    def get_rooms_page(self, sort="id", cursor=None, limit=ROOMS_PAGE_SIZE):
+        """Get a page of chat rooms.
+
+        Pages in id order are cached in every worker until a room is created
+        or deleted. The activity and member orders are read from Redis each
+        time.
+
+        Args:
+            sort: "id", "activity" (latest message first) or "members"
+                (most members first)
+            cursor: the ``next_cursor`` of the previous page, if any
+            limit: int, page size
+
+        Returns:
+            An object containing the rooms and the cursor of the next page,
+            None on the last one.
+
+        Raises:
+            ChatAPIError: The order or the cursor is invalid, or an error
+                occurred while getting the chat rooms.
+
+        """
+        key = "%s:%s" % (cursor, limit)
+        if sort == "id":
+            page = self.cache.rooms.get(key)
+            if page is not MISSING:
+                return page
         try:
-            rooms = self.redis.smembers("rooms")
-            rooms_decoded = [json.loads(room.decode("utf-8")) for room in rooms]
-            return rooms_decoded
-        except (RedisError, json.JSONDecodeError) as e:
+            page = self.rooms.page(sort, cursor, limit)
+        except ValueError as e:
+            raise ChatAPIError("Invalid room list query", 400) from e
+        except RedisError as e:
             raise ChatAPIError("Error getting chat rooms") from e
+        if sort == "id":
+            self.cache.rooms.set(key, page)
+        return page
+
+    def create_room(self, topic, owner):
+        """Create a chat room.
+
+        Args:
+            topic: str
+            owner: str, the user allowed to delete it
+
+        Returns:
+            The room, with its id and topic.
+
+        Raises:
+            ChatAPIError: The topic is invalid or an error occurred while
+                creating the room.
+
+        """
+        try:
+            room = self.rooms.create(topic, owner=owner)
+        except ValidationError as e:
+            raise ChatAPIError("Invalid room topic", 422) from e
+        except RedisError as e:
+            raise ChatAPIError("Error creating room") from e
+        self.invalidate_rooms()
+        return room
+
+    def delete_room(self, room_id, user_id):
+        """Delete a chat room created by ``user_id``.
+
+        Args:
+            room_id: str
+            user_id: str
+
+        Raises:
+            ChatAPIError: The room does not exist, was not created by
+                ``user_id`` or an error occurred while deleting it.
+
+        """
+        try:
+            room = self.rooms.get(room_id)
+            if room is None:
+                raise ChatAPIError("Room does not exist", 404)
+            if room.get("owner") != user_id:
+                raise ChatAPIError("Forbidden", 403)
+            self.rooms.delete(room_id)
+        except RedisError as e:
+            raise ChatAPIError("Error deleting room") from e
+        self.invalidate_rooms()
 
     def join_room(self, room_id, user_id):
         """Join a chat room.
@@ -96,11 +294,11 @@ class ChatAPI:
 
         """
         try:
-            if not self.redis.sismember("rooms_ids", room_id):
+            name = validate_username(user_id)
+            # The script checks that the room exists, atomically with the
+            # join, so a room deleted meanwhile does not get members back.
+            if self.rooms.add_member(room_id, name) is None:
                 raise ChatAPIError("Room does not exist", 404)
-
-            user = User(name=user_id)  # Validate user_id
-            self.redis.sadd("room:%s:users" % room_id, user.name)
         except (RedisError, ValidationError) as e:
             raise ChatAPIError("Error joining room", 422) from e
 
@@ -116,40 +314,208 @@ class ChatAPI:
 
         """
         try:
-            if not self.redis.sismember("rooms_ids", room_id):
+            name = validate_username(user_id)
+            if self.rooms.remove_member(room_id, name) is None:
                 raise ChatAPIError("Room does not exist")
-
-            user = User(name=user_id)  # Validate user_id
-            self.redis.srem("room:%s:users" % room_id, user.name)
         except (RedisError, ValidationError) as e:
             raise ChatAPIError("Error leaving room") from e
 
-    def send_message(self, room_id, sender_id, message):
+    def get_presence(self, room_id):
+        """Get the users online in a chat room.
+
+        Args:
+            room_id: str
+
+        Returns:
+            An object containing the online users, most recently seen first,
+            with the time of their last heartbeat.
+
+        Raises:
+            ChatAPIError: Presence is disabled, the room does not exist or an
+                error occurred while reading it.
+
+        """
+        if self.presence is None:
+            raise ChatAPIError("Presence is disabled", 404)
+        try:
+            if not self._room_exists(room_id):
+                raise ChatAPIError("Room does not exist", 404)
+            online = self.presence.online(room_id)
+        except RedisError as e:
+            raise ChatAPIError("Error getting room presence", 422) from e
+        return {"online": online, "count": len(online)}
+
+    def check_rate(self, room_id, sender_id, client_ip=None):
+        """Count a message against the rate limits of its sender, room and IP.
+
+        Args:
+            room_id: str
+            sender_id: str, the key of the sender's bucket: the username of
+                an authenticated sender, otherwise one for its connection.
+            client_ip: str, optional
+
+        Raises:
+            RateLimitedError: One of the limits is exceeded.
+
+        """
+        if self.limiter is None:
+            return
+        try:
+            wait = self.limiter.hit(user=sender_id, room=room_id, ip=client_ip)
+        except (RedisConnectionError, RedisTimeoutError):
+            # Keep the chat usable, without limits, while Redis is down. Other
+            # errors are bugs, which must not turn the limits off unnoticed.
+            logger.exception("Error checking the rate limits")
+            return
+        if wait > 0:
+            raise RateLimitedError(wait)
+
+    def send_message(
+        self,
+        room_id,
+        sender_id,
+        message,
+        idempotency_key=None,
+        client_ip=None,
+        rate_key=None,
+    ):
         """Send a message to a chat room.
 
+        Every message gets an id from the message store that increases
+        monotonically within a room. A client retrying a send can pass the
+        same ``idempotency_key``: the message is then stored only once, and
+        the retry gets the id of the stored message. The key is checked by
+        the same script that stores the message, in one round trip.
+
         Args:
             room_id: str
             sender_id: str
             message: str
+            idempotency_key: str, optional
+            client_ip: str, optional. Rate limited per IP when given.
+            rate_key: str, optional. Rate limited per ``rate_key`` instead of
+                per ``sender_id``, for senders that are not authenticated.
 
         Returns:
-            An object containing the message id.
+            The message id.
 
         Raises:
+            RateLimitedError: The sender, the room or the IP sent too many
+                messages.
             ChatAPIError: An error occurred while sending the message.
 
+        """
+        self.check_rate(room_id, rate_key or sender_id, client_ip)
+        msg = self.new_message(sender_id, message)
+        keys = None
+        if idempotency_key is not None:
+            keys = {room_id: [idempotency_key]}
+        errors, _ = self._store_batch({room_id: [msg]}, keys)
+        if errors[room_id] is not None:
+            raise errors[room_id]
+        return msg.id
+
+    def new_message(self, sender_id, message):
+        """Validate and timestamp a message without storing it.
+
+        Args:
+            sender_id: str
+            message: str
+
+        Returns:
+            The validated Message, without an id yet.
+
+        Raises:
+            ChatAPIError: The sender or the message is invalid.
+
         """
         try:
-            user = User(name=sender_id)
-            ts = time.time()
-            msg = Message(sender_id=user.name, timestamp=ts, message=message)
-            message_id = self.redis.zadd(
-                "room:%s" % room_id, {json.dumps(msg.dict()): ts}, nx=True
-            )
-        except (ValidationError, RedisError, json.JSONDecodeError) as e:
+            return new_message(sender_id, message, time.time())
+        except ValidationError as e:
             raise ChatAPIError("Error sending message", 422) from e
 
-        return message_id
+    def store_messages(self, batch, idempotency_keys=None):
+        """Store messages for several rooms with pipelined writes.
+
+        Args:
+            batch: dict mapping a room id to a list of Messages, as returned
+                by new_message, in the order they were sent. Their ids are
+                set once they are stored.
+            idempotency_keys: optional dict mapping a room id to the
+                idempotency key of each of its messages, or None. See
+                send_message.
+
+        Returns:
+            A dict mapping each room id to None if its messages were stored,
+            or to the ChatAPIError explaining why they were not, and the set
+            of the ``(room_id, index)`` of the messages that were already
+            stored with their idempotency key. Those get the id of the
+            stored message.
+
+        """
+        return self._store_batch(batch, idempotency_keys)
+
+    def _store_batch(self, batch, idempotency_keys):
+        try:
+            errors, duplicates = self.store.append_many(batch, idempotency_keys)
+        except RedisError as e:
+            errors, duplicates = dict.fromkeys(batch, e), set()
+        stored = {}
+        for room_id, error in errors.items():
+            if error is not None:
+                continue
+            messages = [
+                msg
+                for index, msg in enumerate(batch[room_id])
+                if (room_id, index) not in duplicates
+            ]
+            if messages:
+                stored[room_id] = messages
+        if stored:
+            self._after_store(stored)
+        errors = {
+            room_id: None
+            if error is None
+            else ChatAPIError("Error sending message", 422, error)
+            for room_id, error in errors.items()
+        }
+        return errors, duplicates
+
+    def _after_store(self, stored):
+        """Cache, announce, index and record the activity of stored messages.
+
+        Everything but the local cache update goes in one pipeline.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for room_id, messages in stored.items():
+            self._cache_messages(pipe, room_id, messages)
+            if self.index is not None:
+                self.index.queue_add(
+                    pipe, room_id, [msg.model_dump() for msg in messages]
+                )
+            self.rooms.queue_touch(pipe, room_id, messages[-1].timestamp)
+        try:
+            pipe.execute()
+        except RedisError:
+            # The messages are stored, only the caches of the other workers,
+            # search and the activity order of the room list are out of date.
+            logger.exception("Error announcing messages of %s", list(stored))
+        if self.index is not None and self.store.maxlen:
+            for room_id, messages in stored.items():
+                self._prune_index(room_id, messages[-1].timestamp)
+
+    def _prune_index(self, room_id, now):
+        """Drop from the search index the messages a capped store trimmed."""
+        if not self.index.prune_due(room_id, now):
+            return
+        try:
+            oldest = self.store.oldest(room_id, 1)
+            if oldest:
+                # Skewed clocks can store a message before older ones.
+                before = oldest[0][1]["timestamp"] - STREAM_CLOCK_SKEW_MS / 1000
+                self.index.prune(room_id, before)
+        except RedisError:
+            logger.exception("Error pruning the search index of %s", room_id)
 
     def get_messages(self, room_id):
         """Get all messages from a chat room.
@@ -165,10 +531,300 @@ class ChatAPI:
 
         """
         try:
-            messages = self.redis.zrange("room:%s" % room_id, 0, -1)
-            messages_decoded = [
-                json.loads(message.decode("utf-8")) for message in messages
-            ]
-            return messages_decoded
+            return self.store.all(room_id)
         except (RedisError, json.JSONDecodeError) as e:
             raise ChatAPIError("Error getting messages", 422) from e
+
+    def get_messages_page(
+        self, room_id, before=None, after=None, limit=DEFAULT_PAGE_SIZE
+    ):
+        """Get a page of messages from a chat room.
+
+        Messages are selected by cursors, both exclusive: message timestamps,
+        or the cursors returned by a previous page. With ``after`` the page
+        holds the oldest messages newer than the cursor, otherwise it holds
+        the newest messages older than ``before`` (or the newest messages of
+        the room if no cursor is given). Either way the page is returned in
+        chronological order and its cost does not depend on the room size.
+
+        With an archive, pages reaching past the oldest message of the store
+        continue with the archived messages, and their cursors are then
+        timestamps.
+
+        Args:
+            room_id: str
+            before: cursor, optional
+            after: cursor, optional
+            limit: int
+
+        Returns:
+            An object containing the messages and the cursor for the next
+            page in the same direction, or None if there are no more messages.
+
+        Raises:
+            ChatAPIError: An error occurred while getting the messages, or a
+                cursor is invalid.
+
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        raws, archived, next_cursor = self._page(room_id, before, after, limit)
+        try:
+            messages = [decode(raw) for raw in raws]
+        except ValueError as e:
+            raise ChatAPIError("Error getting messages", 422) from e
+        if archived:
+            messages, next_cursor = self._merge_archived(
+                messages, archived, after, limit
+            )
+        return {"messages": messages, "next_cursor": next_cursor}
+
+    def get_messages_page_raw(
+        self,
+        room_id,
+        before=None,
+        after=None,
+        limit=DEFAULT_PAGE_SIZE,
+        encoding="json",
+    ):
+        """Get a page of messages encoded, without decoding them if possible.
+
+        The page is selected like by get_messages_page, but its messages are
+        returned encoded as ``encoding`` (see chat.codec). Messages already
+        stored in that encoding are returned as they are stored, so serving
+        them costs no decoding and re-encoding.
+
+        Args:
+            room_id: str
+            before: cursor, optional
+            after: cursor, optional
+            limit: int
+            encoding: str, "json" or "msgpack"
+
+        Returns:
+            An object containing the encoded messages and the cursor for the
+            next page in the same direction, or None if there are no more
+            messages.
+
+        Raises:
+            ChatAPIError: The encoding is not supported, an error occurred
+                while getting the messages, or a cursor is invalid.
+
+        """
+        if encoding not in available_encodings():
+            raise ChatAPIError("Unsupported encoding", 400)
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        raws, archived, next_cursor = self._page(room_id, before, after, limit)
+        try:
+            if archived:
+                messages, next_cursor = self._merge_archived(
+                    [decode(raw) for raw in raws], archived, after, limit
+                )
+                encode = get_encoder(encoding)
+                raws = [encode(message) for message in messages]
+            else:
+                convert = to_msgpack if encoding == "msgpack" else to_json
+                raws = [convert(raw) for raw in raws]
+        except ValueError as e:
+            raise ChatAPIError("Error getting messages", 422) from e
+        return {"messages": raws, "next_cursor": next_cursor}
+
+    def get_messages_page_encoded(
+        self,
+        room_id,
+        before=None,
+        after=None,
+        limit=DEFAULT_PAGE_SIZE,
+        encoding="msgpack",
+    ):
+        """Get a page of messages as a single encoded payload.
+
+        Like get_messages_page_raw, with the messages joined into one JSON
+        or msgpack array.
+
+        Returns:
+            An object containing the payload and the cursor for the next
+            page.
+
+        """
+        page = self.get_messages_page_raw(room_id, before, after, limit, encoding)
+        if encoding == "msgpack":
+            data = pack_list(page["messages"])
+        else:
+            data = b"[" + b", ".join(page["messages"]) + b"]"
+        return {"data": data, "next_cursor": page["next_cursor"]}
+
+    def search_messages(
+        self,
+        room_id,
+        query,
+        sender=None,
+        since=None,
+        until=None,
+        limit=DEFAULT_PAGE_SIZE,
+    ):
+        """Search the messages of a chat room.
+
+        A message matches if it holds every word of ``query``.
+
+        Args:
+            room_id: str
+            query: str
+            sender: str, optional
+            since: timestamp, optional
+            until: cursor, optional
+            limit: int
+
+        Returns:
+            An object containing the matching messages, newest first, and
+            the ``until`` cursor of the next page, or None if there are no
+            more messages.
+
+        Raises:
+            ChatAPIError: Search is disabled, the query is invalid or an
+                error occurred while searching.
+
+        """
+        if self.index is None:
+            raise ChatAPIError("Search is disabled", 404)
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        try:
+            messages, next_cursor = self.index.search(
+                room_id,
+                query or "",
+                sender=sender,
+                since=self._cursor_timestamp(since),
+                until=self._search_cursor(until),
+                limit=limit,
+            )
+        except (TypeError, ValueError) as e:
+            raise ChatAPIError("Invalid search query", 400) from e
+        except (RedisError, json.JSONDecodeError) as e:
+            raise ChatAPIError("Error searching messages", 422) from e
+        return {"messages": messages, "next_cursor": next_cursor}
+
+    def _cursor_timestamp(self, cursor):
+        if cursor is None:
+            return None
+        cursor = self.store.parse_cursor(cursor)
+        if isinstance(cursor, str):
+            # A stream id starts with the milliseconds it was stored at.
+            return int(cursor.split("-")[0]) / 1000
+        if isinstance(cursor, tuple):
+            return cursor[0]
+        return cursor
+
+    def _search_cursor(self, cursor):
+        if isinstance(cursor, str) and ":" in cursor:
+            return self.index.parse_cursor(cursor)
+        return self._cursor_timestamp(cursor)
+
+    def _page(self, room_id, before, after, limit):
+        """Return the stored messages of a page, as stored, the archived
+        messages completing it and the cursor of the next page."""
+        try:
+            page = MISSING
+            if self.cache.history is not None and before is None:
+                page = self._cached_page(room_id, after, limit)
+            if page is MISSING:
+                page = self.store.page_raw(room_id, before, after, limit)
+            raws, next_cursor = page
+        except (TypeError, ValueError) as e:
+            raise ChatAPIError("Invalid cursor", 400) from e
+        except RedisError as e:
+            raise ChatAPIError("Error getting messages", 422) from e
+        if self.archive is None:
+            return raws, [], next_cursor
+        try:
+            if not self._has_archive(room_id):
+                archived = []
+            elif after is not None:
+                archived = self.archive.page(
+                    room_id, after=self._cursor_timestamp(after), limit=limit
+                )
+            elif len(raws) < limit:
+                older = (
+                    decode(raws[0])["timestamp"]
+                    if raws
+                    else self._cursor_timestamp(before)
+                )
+                archived = self.archive.page(
+                    room_id, before=older, limit=limit - len(raws)
+                )
+            else:
+                archived = []
+        except (OSError, EOFError, ValueError, RedisError) as e:
+            raise ChatAPIError("Error getting archived messages") from e
+        return raws, archived, next_cursor
+
+    def _has_archive(self, room_id):
+        """Return whether messages of a room were archived, without listing
+        the archive of rooms that never were."""
+        room_id = str(room_id)
+        if room_id in self._archived_rooms:
+            return True
+        if not self.redis.sismember(ARCHIVED_KEY, room_id):
+            return False
+        self._archived_rooms.add(room_id)
+        return True
+
+    def _cached_page(self, room_id, after, limit):
+        """Return a page from the history cache, or MISSING.
+
+        The newest messages of a room are cached when its latest page is
+        read, and pages of newer messages are served from them too.
+        """
+        history = self.cache.history
+        room_id = str(room_id)
+        position = None
+        if after is not None:
+            position = self.store.cursor_position(after)
+            if position is None:
+                return MISSING
+        page = history.page(room_id, position, limit)
+        if page is not MISSING or after is not None:
+            return page
+        generation = history.generation(room_id)
+        # Filled from the primary, as a replica might not have the newest
+        # messages yet and they would be missing until the next send.
+        raws, _ = self.store.page_raw(room_id, limit=history.window, primary=True)
+        items = self._history_items(raws)
+        history.fill(room_id, generation, items, complete=len(raws) < history.window)
+        selected = items[-limit:]
+        next_cursor = selected[0][2] if len(selected) == limit else None
+        return [raw for raw, _, _ in selected], next_cursor
+
+    def _history_items(self, raws):
+        items = []
+        for raw in raws:
+            message = decode(raw)
+            items.append(
+                (raw, self.store.position(message), self.store.cursor(message))
+            )
+        return items
+
+    def _cache_messages(self, pipe, room_id, messages):
+        """Add messages stored by this worker to the history cache.
+
+        The other workers are told on ``pipe`` to add them too.
+        """
+        if self.cache.history is None:
+            return
+        room_id = str(room_id)
+        raws = [self.store.encode(msg) for msg in messages]
+        items = self._history_items(raws)
+        self.cache.history.append(room_id, items)
+        self.cache.queue_append(pipe, room_id, items)
+
+    @staticmethod
+    def _merge_archived(messages, archived, after, limit):
+        """Complete a page of the store with archived messages."""
+        if after is None:
+            messages = archived + messages
+        else:
+            newest = archived[-1]["timestamp"]
+            messages = archived + [m for m in messages if m["timestamp"] > newest]
+            messages = messages[:limit]
+        next_cursor = None
+        if len(messages) == limit:
+            next_cursor = messages[-1 if after is not None else 0]["timestamp"]
+        return messages, next_cursor
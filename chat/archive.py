@@ -0,0 +1,119 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+
+# Segment files are named after the timestamps of their first and last
+# messages, zero-padded so that they sort chronologically.
+SEGMENT_RE = re.compile(r"^(\d+\.\d+)_(\d+\.\d+)_\w+\.jsonl\.gz$")
+
+
+class SegmentArchive:
+    """Messages trimmed from the hot store, in gzip JSONL segment files.
+
+    Each room has a directory of segments holding messages in chronological
+    order. Segments are written once and never modified, so several workers
+    can read them while another one archives. Every node serving history
+    must see the same directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _room_dir(self, room_id):
+        return os.path.join(self.directory, "room-%s" % room_id)
+
+    def rooms(self):
+        """Return the ids of the rooms with an archive directory."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [name[len("room-"):] for name in names if name.startswith("room-")]
+
+    def segments(self, room_id):
+        """Return ``(first, last, path)`` of every segment, oldest first."""
+        room_dir = self._room_dir(room_id)
+        try:
+            names = os.listdir(room_dir)
+        except FileNotFoundError:
+            return []
+        segments = []
+        for name in names:
+            match = SEGMENT_RE.match(name)
+            if match:
+                first, last = float(match.group(1)), float(match.group(2))
+                segments.append((first, last, os.path.join(room_dir, name)))
+        segments.sort()
+        return segments
+
+    def write(self, room_id, messages):
+        """Write ``messages``, oldest first, to a new segment of ``room_id``."""
+        if not messages:
+            return None
+        room_dir = self._room_dir(room_id)
+        os.makedirs(room_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=room_dir, suffix=".tmp")
+        name = "%017.6f_%017.6f_%s.jsonl.gz" % (
+            messages[0]["timestamp"],
+            messages[-1]["timestamp"],
+            os.path.basename(tmp_path)[3:-4],
+        )
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(
+                fileobj=raw, mode="wb"
+            ) as f:
+                for message in messages:
+                    f.write(json.dumps(message).encode("utf-8") + b"\n")
+            path = os.path.join(room_dir, name)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return path
+
+    @staticmethod
+    def _read(path):
+        with gzip.open(path, "rb") as f:
+            return [json.loads(line) for line in f]
+
+    def page(self, room_id, before=None, after=None, limit=50):
+        """Return up to ``limit`` archived messages between two timestamps.
+
+        Both cursors are exclusive. With ``after`` the oldest matching
+        messages are returned, otherwise the newest ones. Messages are
+        always in chronological order.
+        """
+        segments = [
+            (first, last, path)
+            for first, last, path in self.segments(room_id)
+            if (before is None or first < before) and (after is None or last > after)
+        ]
+        if after is None:
+            segments.reverse()
+        messages = []
+        seen = set()
+        for _, _, path in segments:
+            batch = [
+                message
+                for message in self._read(path)
+                if (before is None or message["timestamp"] < before)
+                and (after is None or message["timestamp"] > after)
+            ]
+            if after is None:
+                batch.reverse()
+            for message in batch:
+                # A trim interrupted after writing its segment archives the
+                # same messages again on the next run.
+                key = (message.get("id"), message["timestamp"])
+                if key not in seen:
+                    seen.add(key)
+                    messages.append(message)
+            if len(messages) >= limit:
+                break
+        messages.sort(key=lambda message: message["timestamp"], reverse=after is None)
+        messages = messages[:limit]
+        if after is None:
+            messages.reverse()
+        return messages
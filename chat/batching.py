@@ -0,0 +1,119 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from .errors import ChatAPIError
+from .logger import logger
+
+
+class MessageBatcher:
+    """Gather sent messages and store them with one pipelined write.
+
+    Messages are validated when they are submitted, then queued. A background
+    thread waits up to ``window`` seconds after the first queued message, or
+    until ``max_batch`` messages are queued, and stores them all with
+    ChatAPI.store_messages. Messages of a room are stored and acknowledged in
+    the order they were submitted. Messages sent with an idempotency key are
+    batched too: the script storing them skips the keys already used.
+    """
+
+    def __init__(self, chat_api, window=0.005, max_batch=100):
+        self.chat_api = chat_api
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def submit(
+        self,
+        room_id,
+        sender_id,
+        message,
+        callback,
+        client_ip=None,
+        idempotency_key=None,
+        rate_key=None,
+    ):
+        """Queue a message for storage.
+
+        Args:
+            room_id: str
+            sender_id: str
+            message: str
+            callback: called from the writer thread as
+                ``callback(msg, error, duplicate)`` once the message is stored
+                (error is None) or failed to be. ``duplicate`` is True if it
+                was stored before with the same idempotency key, ``msg.id``
+                is then the id of the stored message.
+            client_ip: str, optional. Rate limited per IP when given.
+            idempotency_key: str, optional. See ChatAPI.send_message.
+            rate_key: str, optional. See ChatAPI.send_message.
+
+        Returns:
+            The validated Message.
+
+        Raises:
+            ChatAPIError: The sender or the message is invalid, or too many
+                messages were sent.
+
+        """
+        self.chat_api.check_rate(room_id, rate_key or sender_id, client_ip)
+        msg = self.chat_api.new_message(sender_id, message)
+        self._queue.put((room_id, msg, idempotency_key, callback))
+        return msg
+
+    def flush(self):
+        """Store everything queued so far from the calling thread."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        rooms = OrderedDict()
+        keys = {}
+        indexes = []
+        for room_id, msg, key, _ in batch:
+            messages = rooms.setdefault(room_id, [])
+            indexes.append(len(messages))
+            messages.append(msg)
+            keys.setdefault(room_id, []).append(key)
+        keys = {
+            room_id: room_keys
+            for room_id, room_keys in keys.items()
+            if any(key is not None for key in room_keys)
+        }
+        try:
+            errors, duplicates = self.chat_api.store_messages(rooms, keys or None)
+        except ChatAPIError as e:
+            errors, duplicates = dict.fromkeys(rooms, e), set()
+        for (room_id, msg, _, callback), index in zip(batch, indexes):
+            try:
+                callback(msg, errors[room_id], (room_id, index) in duplicates)
+            except Exception:
+                # A failing callback must not stop the writer thread.
+                logger.exception("Error acknowledging message to room %s", room_id)
@@ -0,0 +1,382 @@
+import base64
+import bisect
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    from redis import RedisError
+except Exception:  # pragma: no cover - redis might not be installed
+    class RedisError(Exception):
+        pass
+
+# Channel used to tell every worker to drop a cached entry.
+INVALIDATION_CHANNEL = "chat:cache-invalidate"
+
+# Returned by TTLCache.get when a key is not cached, since None, False and
+# empty lists are all valid cached values.
+MISSING = object()
+
+
+def invalidation(cache, key=None, origin=None):
+    """Return the message published on INVALIDATION_CHANNEL to drop an entry.
+
+    Workers drop the entry unless they published the message, as told by
+    ``origin``.
+    """
+    return json.dumps({"cache": cache, "key": key, "origin": origin})
+
+
+def history_append(room_id, items, origin=None):
+    """Return the message published on INVALIDATION_CHANNEL for new messages.
+
+    Instead of dropping the room, the workers caching it add the
+    ``(raw, position, cursor)`` items of the messages, see HistoryCache.append.
+    """
+    return json.dumps(
+        {
+            "cache": "history",
+            "key": room_id,
+            "origin": origin,
+            "append": [
+                [base64.b64encode(raw).decode("ascii"), position, cursor]
+                for raw, position, cursor in items
+            ],
+        }
+    )
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries expire after a fixed TTL."""
+
+    def __init__(self, maxsize=1024, ttl=60.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value for ``key`` or MISSING."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            value, expires = entry
+            if expires <= self._clock():
+                del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, self._clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """Drop ``key``, or every entry if no key is given."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._data),
+            }
+
+
+# Bytes counted for each cached message on top of its encoded size.
+MESSAGE_OVERHEAD = 100
+
+
+class _RoomHistory:
+    def __init__(self, items, complete, expires):
+        # (raw, position, cursor) of the newest messages, oldest first.
+        self.items = items
+        self.positions = [position for _, position, _ in items]
+        # Whether the items are every message of the room.
+        self.complete = complete
+        self.expires = expires
+        self.size = sum(len(raw) + MESSAGE_OVERHEAD for raw, _, _ in items)
+
+
+def _holds(entry, position):
+    index = bisect.bisect_left(entry.positions, position)
+    return index < len(entry.positions) and entry.positions[index] == position
+
+
+class HistoryCache:
+    """The newest messages of recently read rooms, encoded as stored.
+
+    Each room keeps up to ``window`` messages as ``(raw, position, cursor)``
+    items: the stored bytes, a key ordering the messages like the store does
+    and the cursor pointing at the message. Rooms are evicted least recently
+    used first once the cached messages take more than ``max_bytes``.
+
+    A fill only succeeds if the room's generation did not change since it
+    was read, so a page read from Redis before a concurrent write cannot
+    hide that write.
+    """
+
+    def __init__(
+        self, max_bytes=64 * 1024 * 1024, window=200, ttl=60.0, clock=time.monotonic
+    ):
+        self.max_bytes = max_bytes
+        self.window = window
+        self.ttl = ttl
+        self._clock = clock
+        self._rooms = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def generation(self, room_id):
+        """Return the generation to pass to fill() after reading a room."""
+        with self._lock:
+            return self._generations.get(room_id, 0)
+
+    def _bump(self, room_id):
+        self._generations[room_id] = self._generations.get(room_id, 0) + 1
+
+    def _drop(self, room_id):
+        entry = self._rooms.pop(room_id, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def _store(self, room_id, entry):
+        self._drop(room_id)
+        self._rooms[room_id] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes and self._rooms:
+            _, evicted = self._rooms.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+
+    def fill(self, room_id, generation, items, complete):
+        """Cache the newest ``items`` of a room read at ``generation``."""
+        with self._lock:
+            if self._generations.get(room_id, 0) != generation:
+                return False
+            items = items[-self.window:]
+            entry = _RoomHistory(items, complete, self._clock() + self.ttl)
+            self._store(room_id, entry)
+            return True
+
+    def append(self, room_id, items):
+        """Add newly stored messages to a cached room.
+
+        Messages already cached are skipped, e.g. when a room read from
+        Redis already held the messages that another worker announces.
+        """
+        with self._lock:
+            self._bump(room_id)
+            entry = self._rooms.get(room_id)
+            if entry is None:
+                return
+            if entry.positions:
+                items = [
+                    item
+                    for item in items
+                    if item[1] > entry.positions[-1] or not _holds(entry, item[1])
+                ]
+                if not items:
+                    return
+                if items[0][1] <= entry.positions[-1]:
+                    # Stored concurrently with a newer message, reload the room.
+                    self._drop(room_id)
+                    return
+            kept = entry.items + items
+            self._store(
+                room_id,
+                _RoomHistory(
+                    kept[-self.window:],
+                    entry.complete and len(kept) <= self.window,
+                    entry.expires,
+                ),
+            )
+
+    def page(self, room_id, after=None, limit=50):
+        """Return the raw messages and next cursor of a page, or MISSING.
+
+        Without ``after`` the page holds the newest messages, otherwise the
+        oldest ones positioned after it.
+        """
+        with self._lock:
+            entry = self._rooms.get(room_id)
+            if entry is not None and entry.expires <= self._clock():
+                self._drop(room_id)
+                entry = None
+            if entry is None or not self._covers(entry, after, limit):
+                self.misses += 1
+                return MISSING
+            self._rooms.move_to_end(room_id)
+            self.hits += 1
+            if after is None:
+                selected = entry.items[-limit:]
+                edge = 0
+            else:
+                start = bisect.bisect_right(entry.positions, after)
+                selected = entry.items[start:start + limit]
+                edge = -1
+            next_cursor = selected[edge][2] if len(selected) == limit else None
+            return [raw for raw, _, _ in selected], next_cursor
+
+    @staticmethod
+    def _covers(entry, after, limit):
+        if entry.complete:
+            return True
+        if after is None:
+            return limit <= len(entry.items)
+        return bool(entry.positions) and after >= entry.positions[0]
+
+    def invalidate(self, key=None):
+        """Drop room ``key``, or every room if no key is given."""
+        with self._lock:
+            if key is None:
+                for room_id in list(self._generations):
+                    self._bump(room_id)
+                self._rooms.clear()
+                self.bytes = 0
+            else:
+                self._bump(key)
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._rooms),
+                "bytes": self.bytes,
+            }
+
+
+class ChatCache:
+    """Per-process caches in front of the hot Redis lookups of ChatAPI.
+
+    Every worker keeps its own copy, so changes are announced on a Redis
+    pub/sub channel and each worker drops the affected entries, or adds the
+    new messages to the history it caches. The TTL bounds how stale an entry
+    can get if an announcement is missed.
+    """
+
+    def __init__(self, redis, maxsize=4096, ttl=60.0, history_bytes=64 * 1024 * 1024):
+        self.redis = redis
+        # Token -> username, only for valid tokens.
+        self.tokens = TTLCache(maxsize, ttl)
+        # Room id -> whether the room exists.
+        self.room_ids = TTLCache(maxsize, ttl)
+        # Pages of the room list in id order, by cursor and page size.
+        self.rooms = TTLCache(64, ttl)
+        self.caches = {
+            "tokens": self.tokens,
+            "room_ids": self.room_ids,
+            "rooms": self.rooms,
+        }
+        # Compressed response bodies, by a key naming their content.
+        self.compressed = TTLCache(256, ttl)
+        self.caches["compressed"] = self.compressed
+        # Room id -> the newest messages, disabled if history_bytes is 0.
+        self.history = None
+        if history_bytes:
+            self.history = HistoryCache(history_bytes, ttl=ttl)
+            self.caches["history"] = self.history
+        # Identifies the invalidations published by this process.
+        self.origin = uuid.uuid4().hex
+        self._listener = None
+
+    def invalidate(self, cache, key=None, local=True):
+        """Drop an entry here and ask every other worker to do the same.
+
+        With ``local=False`` the entry is only dropped by the other workers,
+        for changes that were already applied to this process' cache.
+        """
+        if local:
+            self.caches[cache].invalidate(key)
+        try:
+            self.redis.publish(
+                INVALIDATION_CHANNEL,
+                invalidation(cache, key, self.origin),
+            )
+        except RedisError:
+            # The other workers will catch up once the entry expires.
+            pass
+
+    def queue_append(self, pipe, room_id, items):
+        """Queue the announcement of messages stored in a room on ``pipe``.
+
+        The other workers add the ``(raw, position, cursor)`` items to the
+        room if they cache it, so that busy rooms stay cached everywhere.
+        """
+        pipe.publish(INVALIDATION_CHANNEL, history_append(room_id, items, self.origin))
+
+    def clear(self):
+        for cache in self.caches.values():
+            cache.invalidate()
+
+    def stats(self):
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    def listen(self):
+        """Start applying invalidations published by other workers."""
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Invalidations may have been missed while disconnected.
+                self.clear()
+                # Polled rather than listen()ed, so that the socket timeout
+                # of the client does not end quiet subscriptions.
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self._apply(message["data"])
+            except RedisError:
+                time.sleep(1)
+
+    def _apply(self, data):
+        try:
+            event = json.loads(data)
+            if event.get("origin") == self.origin:
+                return
+            if event.get("append") is not None and event["cache"] == "history":
+                if self.history is None:
+                    return
+                self.history.append(
+                    event["key"],
+                    [
+                        (base64.b64decode(raw), tuple(position), cursor)
+                        for raw, position, cursor in event["append"]
+                    ],
+                )
+            else:
+                self.caches[event["cache"]].invalidate(event["key"])
+        except (ValueError, KeyError, TypeError):
+            pass
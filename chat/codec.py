@@ -0,0 +1,138 @@
+"""Encodings of stored messages.
+
+Messages are stored either as JSON objects, as every version so far did, or
+as msgpack arrays of FIELDS, which do not repeat the keys. The encoding of a
+stored message is recognised from its first byte, so a room can hold both
+and the encoding of new messages can change at any time.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack might not be installed
+    msgpack = None
+
+# Order of the fields of a message packed as a msgpack array.
+FIELDS = ("id", "sender_id", "timestamp", "message")
+
+# First byte of a msgpack array of len(FIELDS) items.
+_MSGPACK_HEADER = 0x90 | len(FIELDS)
+
+
+def encode_json(message):
+    return json.dumps(message).encode("utf-8")
+
+
+def encode_msgpack(message):
+    return msgpack.packb([message.get(field) for field in FIELDS])
+
+
+ENCODERS = {"json": encode_json, "msgpack": encode_msgpack}
+
+
+def encode_model_json(msg, exclude=None):
+    # pydantic-core writes the JSON bytes directly: model_dump_json() would
+    # decode them to a str, and model_dump() with json.dumps is several times
+    # slower.
+    return msg.__pydantic_serializer__.to_json(msg, exclude=exclude)
+
+
+def encode_model_msgpack(msg, exclude=None):
+    return msgpack.packb(
+        [None if exclude and f in exclude else getattr(msg, f) for f in FIELDS]
+    )
+
+
+MODEL_ENCODERS = {"json": encode_model_json, "msgpack": encode_model_msgpack}
+
+
+def available_encodings():
+    """Return the names of the encodings usable in this process."""
+    return [name for name in ENCODERS if name != "msgpack" or msgpack is not None]
+
+
+def get_encoder(name="json"):
+    """Return the function encoding a message dict with encoding ``name``."""
+    if name not in ENCODERS:
+        raise ValueError("Unknown message encoding: %s" % name)
+    if name not in available_encodings():
+        raise RuntimeError("The %s encoding requires the %s package" % (name, name))
+    return ENCODERS[name]
+
+
+def get_model_encoder(name="json"):
+    """Return the function encoding a chat.models.Message with ``name``.
+
+    The function takes the message and optionally a set of fields to leave
+    out, and returns the same bytes as the encoder of get_encoder(name) for
+    the message dict, except that JSON is written without spaces and with
+    non-ASCII characters as UTF-8.
+    """
+    get_encoder(name)
+    return MODEL_ENCODERS[name]
+
+
+def is_msgpack(raw):
+    return isinstance(raw, bytes) and raw[0] == _MSGPACK_HEADER
+
+
+def decode(raw):
+    """Decode a stored message, whatever its encoding."""
+    if is_msgpack(raw):
+        return dict(zip(FIELDS, msgpack.unpackb(raw)))
+    return json.loads(raw.decode("utf-8") if isinstance(raw, bytes) else raw)
+
+
+def with_id(raw, message_id):
+    """Add ``message_id`` to a message stored without one.
+
+    The id is spliced into the encoded bytes, without decoding them.
+    """
+    if is_msgpack(raw):
+        # The id is the first item of the array, stored as nil.
+        return raw[:1] + msgpack.packb(message_id) + raw[2:]
+    return b'{"id": ' + json.dumps(message_id).encode("utf-8") + b", " + raw[1:]
+
+
+def split_id(raw):
+    """Split a message encoded without an id around the place of its id.
+
+    Lets a Redis script store the message once it has assigned its id.
+
+    Returns:
+        The bytes before and after the id, and whether the id is packed with
+        msgpack rather than written as a JSON number.
+
+    """
+    if is_msgpack(raw):
+        # The id is the first item of the array, stored as nil.
+        return raw[:1], raw[2:], True
+    head = b'{"id":'
+    if not raw.startswith(head + b"null"):
+        raise ValueError("Not a message encoded by get_model_encoder")
+    return head, raw[len(head) + 4:], False
+
+
+def to_json(raw):
+    """Return a stored message as a JSON object, re-encoding it if needed."""
+    if is_msgpack(raw):
+        return encode_json(decode(raw))
+    return raw if isinstance(raw, bytes) else raw.encode("utf-8")
+
+
+def to_msgpack(raw):
+    """Return a stored message as a msgpack array, re-encoding it if needed."""
+    return raw if is_msgpack(raw) else encode_msgpack(decode(raw))
+
+
+def pack_list(raws):
+    """Return a msgpack array of messages already encoded by to_msgpack."""
+    count = len(raws)
+    if count < 16:
+        header = bytes([0x90 | count])
+    elif count < 0x10000:
+        header = b"\xdc" + struct.pack(">H", count)
+    else:
+        header = b"\xdd" + struct.pack(">I", count)
+    return header + b"".join(raws)
@@ -0,0 +1,61 @@
+"""Compression of HTTP response bodies, negotiated with Accept-Encoding.
+
+Bodies are compressed with brotli when the client accepts it and the
+``brotli`` package is installed, otherwise with gzip. Small bodies are not
+worth compressing: the caller decides from MIN_SIZE.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli might not be installed
+    brotli = None
+
+# Bodies shorter than this many bytes are sent as they are by default.
+MIN_SIZE = 1024
+
+# Compression levels trading a little size for much less CPU than the
+# maximum levels.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def available_codings():
+    """Return the content codings this process can compress with, best first."""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate(accept_encoding):
+    """Return the coding to compress with for an Accept-Encoding header.
+
+    Returns:
+        "br", "gzip" or None if the client accepts neither.
+
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for coding in available_codings():
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def compress(body, coding):
+    """Return ``body`` compressed with a coding returned by negotiate()."""
+    if coding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # Without a timestamp the same body always compresses to the same bytes.
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
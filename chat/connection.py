@@ -0,0 +1,224 @@
+"""Redis clients configured from the environment, behind a circuit breaker.
+
+Every setting of a client is read from ``<PREFIX>_<NAME>`` variables, with
+the prefix ``REDIS`` for the primary and ``REDIS_REPLICA`` for a read
+replica:
+
+    HOST, PORT              where the server is (default redis:6379)
+    MAX_CONNECTIONS         connections kept per worker (default 50)
+    POOL_TIMEOUT            seconds to wait for a free connection (default 1)
+    CONNECT_TIMEOUT         seconds to connect (default 1)
+    SOCKET_TIMEOUT          seconds to wait for a reply (default 2)
+    HEALTH_CHECK_INTERVAL   seconds idle before a connection is checked with
+                            a PING before use (default 30, 0 disables)
+"""
+import functools
+import os
+import threading
+import time
+from queue import Empty, LifoQueue
+
+from redis import BlockingConnectionPool, Redis
+from redis.exceptions import ConnectionError, RedisError, TimeoutError
+
+from .errors import CircuitOpenError
+
+DEFAULTS = {
+    "HOST": "redis",
+    "PORT": 6379,
+    "MAX_CONNECTIONS": 50,
+    "POOL_TIMEOUT": 1.0,
+    "CONNECT_TIMEOUT": 1.0,
+    "SOCKET_TIMEOUT": 2.0,
+    "HEALTH_CHECK_INTERVAL": 30,
+}
+
+
+def redis_settings(prefix="REDIS", environ=os.environ):
+    """Return the client settings of ``prefix`` read from ``environ``."""
+    settings = {}
+    for name, default in DEFAULTS.items():
+        value = environ.get("%s_%s" % (prefix, name))
+        if value is None or value == "":
+            settings[name] = default
+        elif isinstance(default, str):
+            settings[name] = value
+        else:
+            settings[name] = type(default)(value)
+    return settings
+
+
+def redis_from_env(prefix="REDIS", environ=os.environ, **overrides):
+    """Return a Redis client configured by the ``prefix`` variables.
+
+    Its pool makes a request wait at most POOL_TIMEOUT seconds for a free
+    connection, rather than opening connections without bound when Redis
+    slows down, and then raises PoolTimeoutError. ``overrides`` replace
+    settings by their lowercase name, e.g. ``socket_timeout=None`` for a
+    client making blocking reads.
+    """
+    settings = redis_settings(prefix, environ)
+    settings.update({name.upper(): value for name, value in overrides.items()})
+    pool = BlockingConnectionPool(
+        host=settings["HOST"],
+        port=settings["PORT"],
+        max_connections=settings["MAX_CONNECTIONS"],
+        timeout=settings["POOL_TIMEOUT"],
+        socket_connect_timeout=settings["CONNECT_TIMEOUT"],
+        socket_timeout=settings["SOCKET_TIMEOUT"],
+        health_check_interval=settings["HEALTH_CHECK_INTERVAL"],
+        queue_class=_ConnectionQueue,
+    )
+    return Redis(connection_pool=pool)
+
+
+def async_redis_from_env(prefix="REDIS", environ=os.environ):
+    """Return a ``redis.asyncio`` client configured like redis_from_env().
+
+    Waiting POOL_TIMEOUT seconds in vain for a free connection raises a
+    ConnectionError; there is no circuit breaker.
+    """
+    from redis.asyncio import BlockingConnectionPool as AsyncPool
+    from redis.asyncio import Redis as AsyncRedis
+
+    settings = redis_settings(prefix, environ)
+    pool = AsyncPool(
+        host=settings["HOST"],
+        port=settings["PORT"],
+        max_connections=settings["MAX_CONNECTIONS"],
+        timeout=settings["POOL_TIMEOUT"],
+        socket_connect_timeout=settings["CONNECT_TIMEOUT"],
+        socket_timeout=settings["SOCKET_TIMEOUT"],
+        health_check_interval=settings["HEALTH_CHECK_INTERVAL"],
+    )
+    return AsyncRedis(connection_pool=pool)
+
+
+class PoolTimeoutError(ConnectionError):
+    """No connection of the pool became free within POOL_TIMEOUT seconds.
+
+    Redis itself may be fine: every connection of the worker is busy.
+    """
+
+
+class _ConnectionQueue(LifoQueue):
+    """The free connections of a pool, failing with PoolTimeoutError."""
+
+    def get(self, block=True, timeout=None):
+        try:
+            return super().get(block, timeout)
+        except Empty:
+            raise PoolTimeoutError("No connection available.") from None
+
+
+class CircuitBreaker:
+    """Stop calling Redis for a while after it failed repeatedly.
+
+    After ``threshold`` consecutive connection errors or timeouts the circuit
+    opens: calls fail at once with CircuitOpenError instead of each waiting
+    for its own timeout. ``reset_timeout`` seconds later a single call is let
+    through as a trial, which closes the circuit if it succeeds and opens it
+    again if it fails. Waiting too long for a free connection of the pool
+    (PoolTimeoutError) is not a failure: the worker is busy, but Redis may
+    well be fine.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=5.0, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.retry_after() > 0
+
+    def retry_after(self):
+        """Return the seconds until calls are let through again (0 if they are)."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            wait = self._opened_at + self.reset_timeout - self.clock()
+            if wait <= 0 and self._trial:
+                # A trial call is running: wait for its outcome.
+                return self.reset_timeout
+            return max(wait, 0)
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through now."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            wait = self._opened_at + self.reset_timeout - self.clock()
+            if wait > 0:
+                raise CircuitOpenError(wait)
+            if self._trial:
+                raise CircuitOpenError(self.reset_timeout)
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self._opened_at = self.clock()
+            self._trial = False
+
+    def call(self, func, *args, **kwargs):
+        """Call ``func`` through the breaker."""
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except PoolTimeoutError:
+            # Redis was not reached: let another call be the trial.
+            with self._lock:
+                self._trial = False
+            raise
+        except (ConnectionError, TimeoutError):
+            self.failure()
+            raise
+        except RedisError:
+            # Redis answered, if only with an error: it is reachable.
+            self.success()
+            raise
+        except BaseException:
+            # Interrupted before knowing: let another call be the trial.
+            with self._lock:
+                self._trial = False
+            raise
+        self.success()
+        return result
+
+
+def protect(redis, breaker):
+    """Send every command and pipeline of ``redis`` through ``breaker``."""
+    execute_command = redis.execute_command
+    pipeline = redis.pipeline
+
+    @functools.wraps(execute_command)
+    def protected_execute_command(*args, **options):
+        return breaker.call(execute_command, *args, **options)
+
+    @functools.wraps(pipeline)
+    def protected_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        @functools.wraps(execute)
+        def protected_execute(*args, **kwargs):
+            return breaker.call(execute, *args, **kwargs)
+
+        pipe.execute = protected_execute
+        return pipe
+
+    redis.execute_command = protected_execute_command
+    redis.pipeline = protected_pipeline
+    return redis
@@ -0,0 +1,64 @@
+import threading
+import time
+
+try:
+    from redis import RedisError
+except Exception:  # pragma: no cover - redis might not be installed
+    class RedisError(Exception):
+        pass
+
+from .logger import logger
+
+
+class StreamTailer:
+    """Push new messages to local clients by tailing the room streams.
+
+    Each worker runs one tailer, which waits on a blocking XREAD over the
+    streams of every room and hands each new message to ``deliver(room_id,
+    message)``. Messages then reach the clients of every worker in the order
+    they were stored, whichever worker received them, without going through
+    a Socket.IO message queue.
+    """
+
+    def __init__(self, redis, store, deliver, block_ms=5000, count=100):
+        self.redis = redis
+        self.store = store
+        self.deliver = deliver
+        self.block_ms = block_ms
+        self.count = count
+        self._last_ids = {}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _rooms(self):
+        return sorted(room.decode("utf-8") for room in self.redis.smembers("rooms_ids"))
+
+    def poll(self):
+        """Wait for new messages in any room and deliver them."""
+        for room_id in self._rooms():
+            if room_id not in self._last_ids:
+                # Only deliver messages stored after we started watching.
+                self._last_ids[room_id] = self.store.last_id(room_id)
+        rooms = {self.store.key(room_id): room_id for room_id in self._last_ids}
+        streams = {key: self._last_ids[room_id] for key, room_id in rooms.items()}
+        if not streams:
+            time.sleep(self.block_ms / 1000)
+            return
+        result = self.redis.xread(streams, count=self.count, block=self.block_ms)
+        for key, entries in result or []:
+            room_id = rooms[key.decode("utf-8")]
+            for entry_id, fields in entries:
+                self._last_ids[room_id] = self.store.decode_id(entry_id)
+                self.deliver(room_id, self.store.decode_entry(entry_id, fields))
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except RedisError:
+                logger.exception("Error reading room streams")
+                time.sleep(1)
@@ -1,3 +1,10 @@
+try:
+    from redis.exceptions import ConnectionError as RedisConnectionError
+except Exception:  # pragma: no cover - redis might not be installed
+    class RedisConnectionError(Exception):
+        pass
+
+
 class ChatAPIError(Exception):
     """An error occurred while interacting with the Policy API."""
 
@@ -14,4 +21,26 @@ class ChatAPIError(Exception):
         return super().__str__()
 
     def get_status_code(self):
+        # Whatever the call, it failed because Redis is known to be down.
+        cause = self.original_exception or self.__cause__
+        if isinstance(cause, CircuitOpenError):
+            return 503
         return self.status_code
+
+
+class RateLimitedError(ChatAPIError):
+    """Too many messages were sent, retry after ``retry_after`` seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(
+            "Too many messages, retry in %.1f seconds" % retry_after, 429
+        )
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(RedisConnectionError):
+    """Raised instead of calling Redis while the circuit is open."""
+
+    def __init__(self, retry_after):
+        super().__init__("Redis is unavailable, retry in %.1fs" % retry_after)
+        self.retry_after = retry_after
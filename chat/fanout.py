@@ -0,0 +1,147 @@
+import math
+import threading
+import time
+
+from .logger import logger
+from .metrics import BROADCAST_LATENCY
+
+# Seconds between two passes forgetting the rooms that sent nothing for a
+# window, which are sent to at once again anyway.
+PRUNE_INTERVAL = 1
+
+
+def send_message(socketio, room, text, meta=None):
+    """Emit one ``message`` event, with the ``meta`` of a stored message."""
+    if meta is None:
+        socketio.send(text, to=room)
+    else:
+        socketio.emit("message", text, meta, to=room)
+
+
+class _Pending:
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.messages = []
+        self.meta = []
+        self.dropped = 0
+
+
+class FanoutScheduler:
+    """Coalesce the messages broadcast to a room into micro-batches.
+
+    A message for a room that sent nothing in the last ``window`` seconds is
+    sent at once, so quiet rooms see no added latency. The messages that
+    follow within the window are queued and sent together when it ends, as a
+    single ``message_batch`` event, so a busy room costs every member one
+    frame per window rather than one per message. The batch lists the texts
+    in ``messages`` and, in ``meta``, the id and timestamp of each stored
+    message (None for notices), like the ``message`` events do.
+
+    At most ``max_pending`` messages are queued per room. When a room falls
+    further behind, its oldest queued messages are dropped and the batch
+    tells the clients how many they missed, so that they can fetch them from
+    the history. Join and leave summaries are only sent to quiet rooms.
+
+    Clients must handle ``message_batch`` besides ``message`` to see every
+    message, which is why app.py only batches with CHAT_FANOUT_MS set.
+    """
+
+    def __init__(self, socketio, window=0.005, max_pending=500):
+        self.socketio = socketio
+        self.window = window
+        self.max_pending = max_pending
+        self._pending = {}
+        self._last_sent = {}
+        self._pruned = time.monotonic()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def send(self, room, text, meta=None):
+        """Broadcast ``text`` to ``room``, now or with the next batch.
+
+        ``meta`` is the id and timestamp of a stored message, see
+        chat.socket.broadcast.
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._prune(now)
+            last_sent = self._last_sent.get(room, -math.inf)
+            pending = self._pending.get(room)
+            if pending is None and now - last_sent >= self.window:
+                self._last_sent[room] = now
+            else:
+                if pending is None:
+                    pending = self._pending[room] = _Pending(last_sent + self.window)
+                    self._cond.notify()
+                pending.messages.append(text)
+                pending.meta.append(meta)
+                if len(pending.messages) > self.max_pending:
+                    del pending.messages[0]
+                    del pending.meta[0]
+                    pending.dropped += 1
+                return
+        with BROADCAST_LATENCY.time():
+            send_message(self.socketio, room, text, meta)
+
+    def _prune(self, now):
+        """Forget the rooms that sent nothing for a window."""
+        if now - self._pruned < PRUNE_INTERVAL:
+            return
+        self._pruned = now
+        self._last_sent = {
+            room: last_sent
+            for room, last_sent in self._last_sent.items()
+            if now - last_sent < self.window or room in self._pending
+        }
+
+    def send_notice(self, room, text):
+        """Broadcast ``text`` unless the room is busy, e.g. a join summary."""
+        with self._cond:
+            if room in self._pending:
+                return
+        self.send(room, text)
+
+    def flush(self, now=None):
+        """Send the batches whose window ended."""
+        now = time.monotonic() if now is None else now
+        with self._cond:
+            due = [room for room, p in self._pending.items() if p.deadline <= now]
+            batches = [(room, self._pending.pop(room)) for room in due]
+            for room in due:
+                self._last_sent[room] = now
+        for room, pending in batches:
+            with BROADCAST_LATENCY.time():
+                if len(pending.messages) == 1 and not pending.dropped:
+                    send_message(
+                        self.socketio, room, pending.messages[0], pending.meta[0]
+                    )
+                else:
+                    self.socketio.emit(
+                        "message_batch",
+                        {
+                            "messages": pending.messages,
+                            "meta": pending.meta,
+                            "dropped": pending.dropped,
+                        },
+                        to=room,
+                    )
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = min(p.deadline for p in self._pending.values())
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+            try:
+                self.flush()
+            except Exception:
+                # Keep broadcasting to the other rooms whatever went wrong.
+                logger.exception("Error broadcasting batched messages")
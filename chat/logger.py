@@ -1,11 +1,157 @@
+"""Logging setup for the chat server.
+
+Records are handed to a queue and written by a background thread, so
+formatting and file I/O stay off the request path. Everything is configured
+from the environment:
+
+    LOG_LEVEL          level of the "chat" logger (default INFO)
+    LOG_FILE           log file, "{hostname}" is replaced by the host name
+                       (default /logs/app.log), empty to disable
+    LOG_FORMAT         "text" (default) or "json"
+    LOG_ASYNC          "0" to write from the calling thread instead
+    LOG_MAX_BYTES      rotate the file at this size (default 10 MB)
+    LOG_BACKUP_COUNT   rotated files to keep (default 5)
+    LOG_CONSOLE        "1" to also log to stderr
+
+and, per handler (FILE or CONSOLE):
+
+    LOG_<HANDLER>_LEVEL        minimum level written by the handler
+    LOG_<HANDLER>_SAMPLE_RATE  fraction of records below WARNING written
+"""
+import atexit
+import importlib
+import json
 import logging
+import logging.handlers
 import os
+import random
+import socket
+import sys
+
+DEFAULT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+def _native(name):
+    """Return module ``name`` as it was before eventlet monkey-patching.
+
+    The log writer must be a real OS thread: a green thread would block the
+    whole event loop while it writes to the file.
+    """
+    try:
+        from eventlet import patcher
+    except ImportError:  # pragma: no cover - eventlet might not be installed
+        return importlib.import_module(name)
+    return patcher.original(name)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records below WARNING."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the arguments into the message here; the formatter of
+        # the destination handler runs on the writer thread.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def start(self):
+        self._thread = _native("threading").Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+def _env(name, default=None):
+    return os.environ.get(name, default)
+
+
+def _configure(handler, name, formatter):
+    handler.setFormatter(formatter)
+    handler.setLevel(_env("LOG_%s_LEVEL" % name, "NOTSET").upper())
+    rate = float(_env("LOG_%s_SAMPLE_RATE" % name, 1.0))
+    if rate < 1.0:
+        handler.addFilter(SamplingFilter(rate))
+    return handler
+
+
+def _file_handler(formatter):
+    path = _env("LOG_FILE", os.path.join("/logs", "app.log"))
+    if not path:
+        return None
+    path = path.replace("{hostname}", socket.gethostname())
+    try:
+        handler = logging.handlers.RotatingFileHandler(
+            path,
+            maxBytes=int(_env("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+            backupCount=int(_env("LOG_BACKUP_COUNT", 5)),
+        )
+    except OSError:
+        # No log directory, e.g. outside the container.
+        return None
+    return _configure(handler, "FILE", formatter)
+
+
+def setup_logging():
+    """Configure and return the "chat" logger."""
+    chat_logger = logging.getLogger("chat")
+    chat_logger.setLevel(_env("LOG_LEVEL", "INFO").upper())
+    chat_logger.propagate = False
+
+    if _env("LOG_FORMAT", "text") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(DEFAULT_FORMAT)
+
+    handlers = []
+    file_handler = _file_handler(formatter)
+    if file_handler is not None:
+        handlers.append(file_handler)
+    if _env("LOG_CONSOLE") == "1" or not handlers:
+        handlers.append(
+            _configure(logging.StreamHandler(sys.stderr), "CONSOLE", formatter)
+        )
+
+    if _env("LOG_ASYNC", "1") == "1":
+        records = _native("queue").SimpleQueue()
+        chat_logger.addHandler(_QueueHandler(records))
+        listener = _QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        for handler in handlers:
+            chat_logger.addHandler(handler)
+    return chat_logger
 
-log_file = os.path.join("/logs", "app.log")
-logging.basicConfig(
-    filename=log_file,
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
 
-logger = logging.getLogger("chat")
+logger = setup_logging()
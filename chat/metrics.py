@@ -0,0 +1,290 @@
+"""Prometheus metrics for the chat server.
+
+The metrics are served by ``GET /metrics``. When several worker processes
+share a host, set PROMETHEUS_MULTIPROC_DIR to an empty directory writable by
+all of them so that every scrape reports the sum of the workers. Each node
+is scraped separately. Without the ``prometheus_client`` package every
+metric is a no-op and ``/metrics`` is empty.
+"""
+import functools
+import inspect
+import os
+import time
+from contextlib import nullcontext
+
+from .errors import ChatAPIError
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        REGISTRY,
+        CollectorRegistry,
+        Counter,
+        Histogram,
+        generate_latest,
+    )
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:  # pragma: no cover - prometheus_client might not be installed
+    Counter = Histogram = None
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+# Buckets for sub-millisecond Redis calls up to slow socket fan-outs.
+LATENCY_BUCKETS = (
+    0.0002, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5
+)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return nullcontext()
+
+
+def _metric(kind, name, documentation, labelnames=(), **kwargs):
+    if kind is None:
+        return _NoopMetric()
+    return kind(name, documentation, labelnames, **kwargs)
+
+
+API_LATENCY = _metric(
+    Histogram,
+    "chat_api_latency_seconds",
+    "Time spent in ChatAPI methods.",
+    ["method"],
+    buckets=LATENCY_BUCKETS,
+)
+API_ERRORS = _metric(
+    Counter,
+    "chat_api_errors_total",
+    "ChatAPI errors by status code.",
+    ["method", "status_code"],
+)
+REDIS_LATENCY = _metric(
+    Histogram,
+    "chat_redis_latency_seconds",
+    "Redis round-trip time by command (PIPELINE for pipelines).",
+    ["command"],
+    buckets=LATENCY_BUCKETS,
+)
+SOCKET_LATENCY = _metric(
+    Histogram,
+    "chat_socket_handler_latency_seconds",
+    "Time spent in Socket.IO event handlers.",
+    ["event"],
+    buckets=LATENCY_BUCKETS,
+)
+SOCKET_ERRORS = _metric(
+    Counter,
+    "chat_socket_handler_errors_total",
+    "Unhandled exceptions in Socket.IO event handlers.",
+    ["event"],
+)
+BROADCAST_LATENCY = _metric(
+    Histogram,
+    "chat_broadcast_latency_seconds",
+    "Time spent broadcasting an event to a room.",
+    buckets=LATENCY_BUCKETS,
+)
+MESSAGES = _metric(
+    Counter,
+    "chat_messages_total",
+    "Messages stored, by room. Use rate() for messages per second.",
+    ["room"],
+)
+
+# The room label of the messages sent to rooms missing from the registry.
+OTHER_ROOM = "other"
+
+
+def instrument_api(chat_api):
+    """Record latency and errors of every public method of ``chat_api``."""
+    for name in dir(chat_api):
+        method = getattr(chat_api, name)
+        if name.startswith("_") or not callable(method):
+            continue
+        setattr(chat_api, name, _timed_api_method(name, method, chat_api))
+    return chat_api
+
+
+def _room_label(chat_api, room_id):
+    """Return the ``room`` label of the messages sent to ``room_id``.
+
+    Room ids come from clients, and every label value is a new series: only
+    the rooms of the registry get their own, the others share OTHER_ROOM.
+    """
+    return str(room_id) if chat_api._room_exists(room_id) else OTHER_ROOM
+
+
+def _timed_api_method(name, method, chat_api):
+    latency = API_LATENCY.labels(name)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except ChatAPIError as e:
+            API_ERRORS.labels(name, str(e.get_status_code())).inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+        if name == "send_message":
+            room_id = args[0] if args else kwargs["room_id"]
+            MESSAGES.labels(_room_label(chat_api, room_id)).inc()
+        elif name == "store_messages":
+            batch = args[0] if args else kwargs["batch"]
+            errors, duplicates = result
+            for room_id, error in errors.items():
+                if error is None:
+                    stored = len(batch[room_id]) - sum(
+                        1 for room, _ in duplicates if room == room_id
+                    )
+                    MESSAGES.labels(_room_label(chat_api, room_id)).inc(stored)
+        return result
+
+    return wrapper
+
+
+def instrument_redis(redis):
+    """Record the round-trip time of every command sent through ``redis``."""
+    execute_command = redis.execute_command
+    pipeline = redis.pipeline
+
+    @functools.wraps(execute_command)
+    def timed_execute_command(*args, **options):
+        with REDIS_LATENCY.labels(str(args[0])).time():
+            return execute_command(*args, **options)
+
+    @functools.wraps(pipeline)
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        @functools.wraps(execute)
+        def timed_execute(*args, **kwargs):
+            with REDIS_LATENCY.labels("PIPELINE").time():
+                return execute(*args, **kwargs)
+
+        pipe.execute = timed_execute
+        return pipe
+
+    redis.execute_command = timed_execute_command
+    redis.pipeline = timed_pipeline
+    return redis
+
+
+def instrument_handler(event, handler):
+    """Record latency and unhandled exceptions of a Socket.IO handler."""
+    latency = SOCKET_LATENCY.labels(event)
+    takes_args = bool(inspect.signature(handler).parameters)
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        if args and not takes_args:
+            # Flask-SocketIO retries connect handlers without the auth
+            # argument when they do not accept it.
+            raise TypeError("%s handler takes no arguments" % event)
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            SOCKET_ERRORS.labels(event).inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+class RoomSessionsCollector:
+    """Report the number of sessions joined to each room at scrape time.
+
+    ``count_sessions`` returns a dict mapping room ids to session counts.
+    The counts are shared by all the workers, so they are read when scraped
+    rather than tracked by each process. Every worker and node reports the
+    same cluster-wide counts: aggregate them with max, never sum them.
+    """
+
+    def __init__(self, count_sessions):
+        self.count_sessions = count_sessions
+
+    def collect(self):
+        gauge = GaugeMetricFamily(
+            "chat_room_sessions",
+            "Socket sessions joined to a room, across the cluster.",
+            labels=["room"],
+        )
+        for room_id, count in self.count_sessions().items():
+            gauge.add_metric([str(room_id)], count)
+        yield gauge
+
+
+class CacheCollector:
+    """Report the counters of the per-process caches of this worker.
+
+    ``cache_stats`` returns the stats of each cache by name, as returned by
+    ChatAPI.cache_stats.
+    """
+
+    def __init__(self, cache_stats):
+        self.cache_stats = cache_stats
+
+    def collect(self):
+        families = {
+            "hits": CounterMetricFamily(
+                "chat_cache_hits", "Cache lookups that hit.", labels=["cache"]
+            ),
+            "misses": CounterMetricFamily(
+                "chat_cache_misses", "Cache lookups that missed.", labels=["cache"]
+            ),
+            "evictions": CounterMetricFamily(
+                "chat_cache_evictions", "Entries evicted.", labels=["cache"]
+            ),
+            "size": GaugeMetricFamily(
+                "chat_cache_entries", "Entries cached.", labels=["cache"]
+            ),
+            "bytes": GaugeMetricFamily(
+                "chat_cache_bytes", "Memory used by the cached entries.", ["cache"]
+            ),
+        }
+        for cache, stats in self.cache_stats().items():
+            for name, value in stats.items():
+                if name in families:
+                    families[name].add_metric([cache], value)
+        return iter(families.values())
+
+
+_collectors = []
+
+
+def register_collector(collector):
+    """Add a collector to the metrics served by /metrics."""
+    if Counter is not None:
+        _collectors.append(collector)
+
+
+def render():
+    """Return the body and content type of the /metrics response."""
+    if Counter is None:
+        return b"", CONTENT_TYPE_LATEST
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    body = generate_latest(registry)
+    for collector in _collectors:
+        extra = CollectorRegistry()
+        extra.register(collector)
+        body += generate_latest(extra)
+    return body, CONTENT_TYPE_LATEST
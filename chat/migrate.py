@@ -0,0 +1,228 @@
+"""Data migrations for the chat Redis database.
+
+Usage:
+    python -m chat.migrate streams [--room ID ...] [--batch N]
+    python -m chat.migrate tokens [--batch N]
+    python -m chat.migrate search [--room ID ...] [--batch N]
+    python -m chat.migrate rooms
+    python -m chat.migrate ids [--room ID ...] [--batch N]
+
+streams
+    Copy the messages of the ``room:<id>`` sorted sets into the
+    ``room:<id>:stream`` streams used by CHAT_STORAGE=stream. Entry ids are
+    derived from the message timestamps so timestamp cursors keep working. A
+    room whose stream already holds messages is skipped. The sorted sets are
+    left in place.
+
+tokens
+    Move the authentication tokens of the legacy ``tokens`` hash to the
+    expiring ``token:<token>`` keys read by current versions, then remove
+    them from the hash. Run it once every worker runs a current version; it
+    can be run again safely.
+
+search
+    Add the messages stored before the search index existed to it. It can be
+    run again safely. Run ids first: messages without an id are skipped.
+
+rooms
+    Register the rooms of the legacy ``rooms`` set of JSON objects in the
+    room registry (see chat.rooms), with the number of members they have.
+    Rooms already registered are left untouched, so it can be run again
+    safely. The legacy set is left in place.
+
+ids
+    Give an id to the messages of the ``room:<id>`` sorted sets stored
+    before messages had one, reserved from the ``room:<id>:last_id``
+    counter of new messages. Pages work without them, but can skip those
+    messages when they share their timestamp. It can be run again safely.
+"""
+import argparse
+import json
+import os
+import sys
+
+from .api import TOKEN_TTL
+from .codec import decode, with_id
+from .connection import redis_from_env
+from .models import ChatRoom
+from .rooms import RoomRegistry
+from .search import SearchIndex
+from .storage import StreamMessageStore, make_store
+
+
+def migrate_room_to_stream(redis, room_id, batch=1000):
+    """Copy the messages of a room's sorted set into its stream.
+
+    Returns:
+        The number of messages copied, or None if the stream was not empty.
+
+    """
+    store = StreamMessageStore(redis)
+    key = store.key(room_id)
+    if redis.xlen(key):
+        return None
+
+    copied = 0
+    last = (0, 0)
+    start = 0
+    while True:
+        members = redis.zrange("room:%s" % room_id, start, start + batch - 1)
+        if not members:
+            return copied
+        pipe = redis.pipeline(transaction=False)
+        for member in members:
+            message = decode(member)
+            message.pop("id", None)
+            ms = int(message["timestamp"] * 1000)
+            # Entry ids must increase strictly, messages stored within the
+            # same millisecond get increasing sequence numbers.
+            last = (ms, 0) if ms > last[0] else (last[0], last[1] + 1)
+            pipe.xadd(key, {"data": json.dumps(message)}, id="%d-%d" % last)
+        pipe.execute()
+        copied += len(members)
+        start += batch
+
+
+def assign_message_ids(redis, room_id, batch=1000):
+    """Give an id to the messages of a room's sorted set stored without one.
+
+    Each batch of messages is rewritten in a transaction, with ids reserved
+    from the counter of the store so that they never collide with the ids
+    of new messages.
+
+    Returns:
+        The number of messages given an id.
+
+    """
+    key = "room:%s" % room_id
+    assigned = 0
+    start = 0
+    while True:
+        members = redis.zrange(key, start, start + batch - 1, withscores=True)
+        if not members:
+            return assigned
+        legacy = [
+            (member, score) for member, score in members if "id" not in decode(member)
+        ]
+        if legacy:
+            last = redis.incrby("room:%s:last_id" % room_id, len(legacy))
+            pipe = redis.pipeline()
+            for offset, (member, score) in enumerate(legacy):
+                message_id = last - len(legacy) + 1 + offset
+                pipe.zrem(key, member)
+                pipe.zadd(key, {with_id(member, message_id): score})
+            pipe.execute()
+            assigned += len(legacy)
+        # Rewritten messages sort before the remaining ones of their
+        # timestamp, none of those moves into the batches already read.
+        start += batch
+
+
+def migrate_tokens(redis, batch=1000):
+    """Move the tokens of the legacy ``tokens`` hash to expiring keys.
+
+    Tokens already present as keys are left untouched.
+
+    Returns:
+        The number of tokens moved.
+
+    """
+    moved = 0
+    entries = []
+    for token, username in redis.hscan_iter("tokens", count=batch):
+        entries.append((token, username))
+        if len(entries) >= batch:
+            moved += _move_tokens(redis, entries)
+            entries = []
+    if entries:
+        moved += _move_tokens(redis, entries)
+    return moved
+
+
+def _move_tokens(redis, entries):
+    pipe = redis.pipeline(transaction=False)
+    for token, username in entries:
+        pipe.set("token:%s" % token.decode("utf-8"), username, ex=TOKEN_TTL, nx=True)
+    pipe.hdel("tokens", *[token for token, _ in entries])
+    pipe.execute()
+    return len(entries)
+
+
+def index_room(redis, store, room_id, batch=1000):
+    """Add every message of a room to the search index.
+
+    Returns:
+        The number of messages indexed.
+
+    """
+    index = SearchIndex(redis)
+    messages = [m for m in store.all(room_id) if m.get("id") is not None]
+    for start in range(0, len(messages), batch):
+        index.add(room_id, messages[start:start + batch])
+    return len(messages)
+
+
+def migrate_rooms(redis):
+    """Register the rooms of the legacy ``rooms`` set.
+
+    Returns:
+        The ids of the rooms registered.
+
+    """
+    rooms = [
+        ChatRoom.model_validate_json(room) for room in redis.smembers("rooms")
+    ]
+    return RoomRegistry(redis).ensure(sorted(rooms, key=lambda room: room.id))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chat data migrations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    streams = subparsers.add_parser(
+        "streams", help="copy room sorted sets into streams"
+    )
+    streams.add_argument("--room", action="append", help="room id (default: all)")
+    streams.add_argument("--batch", type=int, default=1000)
+    tokens = subparsers.add_parser(
+        "tokens", help="move legacy tokens to expiring keys"
+    )
+    tokens.add_argument("--batch", type=int, default=1000)
+    search = subparsers.add_parser("search", help="index the existing messages")
+    search.add_argument("--room", action="append", help="room id (default: all)")
+    search.add_argument("--batch", type=int, default=1000)
+    subparsers.add_parser("rooms", help="register the rooms of the legacy set")
+    ids = subparsers.add_parser("ids", help="give ids to the legacy messages")
+    ids.add_argument("--room", action="append", help="room id (default: all)")
+    ids.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    redis = redis_from_env()
+    if args.command in ("streams", "search", "ids"):
+        rooms = args.room or sorted(
+            room.decode("utf-8") for room in redis.smembers("rooms_ids")
+        )
+    if args.command == "streams":
+        for room_id in rooms:
+            copied = migrate_room_to_stream(redis, room_id, args.batch)
+            if copied is None:
+                print("room %s: stream not empty, skipped" % room_id)
+            else:
+                print("room %s: copied %d messages" % (room_id, copied))
+    elif args.command == "search":
+        store = make_store(redis, os.environ.get("CHAT_STORAGE", "zset"))
+        for room_id in rooms:
+            indexed = index_room(redis, store, room_id, args.batch)
+            print("room %s: indexed %d messages" % (room_id, indexed))
+    elif args.command == "tokens":
+        print("moved %d tokens" % migrate_tokens(redis, args.batch))
+    elif args.command == "rooms":
+        print("registered %d rooms" % len(migrate_rooms(redis)))
+    elif args.command == "ids":
+        for room_id in rooms:
+            assigned = assign_message_ids(redis, room_id, args.batch)
+            print("room %s: gave ids to %d messages" % (room_id, assigned))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
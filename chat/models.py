@@ -1,3 +1,7 @@
+import functools
+import re
+from typing import Optional, Union
+
 from pydantic import BaseModel, Field, constr
 
 MAX_MESSAGE_LEN = 144
@@ -6,16 +10,24 @@ MAX_SENDER_LEN = 16
 MIN_TOPIC_LEN = 3
 MAX_TOPIC_LEN = 24
 
+# Number of valid usernames remembered by validate_username.
+USERNAME_CACHE_SIZE = 4096
+
+# The pattern of User.name for re.fullmatch: "$" would also match before a
+# trailing newline, which the pattern of the model does not accept.
+_USERNAME = re.compile(r"[a-zA-Z0-9_-]+")
+
 
 class User(BaseModel):
     name: constr(
         min_length=MIN_SENDER_LEN,
         max_length=MAX_SENDER_LEN,
-        regex=r"^[a-zA-Z0-9_-]+$",
+        pattern=r"^[a-zA-Z0-9_-]+$",
     )
 
 
 class Message(BaseModel):
+    id: Optional[Union[int, str]] = None
     sender_id: str
     timestamp: float
     message: str = Field(min_length=1, max_length=MAX_MESSAGE_LEN)
@@ -26,5 +38,79 @@ class ChatRoom(BaseModel):
     topic: constr(
         min_length=MIN_TOPIC_LEN,
         max_length=MAX_TOPIC_LEN,
-        regex=r"^[a-zA-Z0-9_]+$",
+        pattern=r"^[a-zA-Z0-9_]+$",
     )
+
+
+def validate_username(name):
+    """Return ``name`` validated as ``User(name=name).name`` would be.
+
+    Strings are checked without building a User, and the valid ones are
+    remembered, so that the usernames of active users cost a dict lookup.
+    Anything else goes through the model.
+
+    Raises:
+        ValidationError: ``name`` is not a valid username.
+
+    """
+    if type(name) is str:
+        return _validate_username_str(name)
+    return User(name=name).name
+
+
+@functools.lru_cache(maxsize=USERNAME_CACHE_SIZE)
+def _validate_username_str(name):
+    if MIN_SENDER_LEN <= len(name) <= MAX_SENDER_LEN and _USERNAME.fullmatch(name):
+        return name
+    # Raises the ValidationError of the model, which is never cached.
+    return User(name=name).name
+
+
+def new_message(sender_id, message, timestamp):
+    """Return a validated Message, without an id.
+
+    Raises:
+        ValidationError: The sender or the message is invalid.
+
+    """
+    return Message.model_validate(
+        {
+            "sender_id": validate_username(sender_id),
+            "timestamp": timestamp,
+            "message": message,
+        }
+    )
+
+
+def _fast_set_id_works():
+    """Return whether writing the id to the instance dict is like setattr.
+
+    Checked once on import, so that a pydantic version keeping its fields
+    elsewhere makes set_id fall back to setattr rather than break silently.
+    """
+    fast = Message(sender_id="probe", timestamp=0.0, message="probe")
+    model = fast.model_copy()
+    try:
+        fast.__dict__["id"] = 1
+        fast.__pydantic_fields_set__.add("id")
+    except (AttributeError, TypeError):
+        return False
+    model.id = 1
+    return fast == model and fast.model_fields_set == model.model_fields_set
+
+
+_FAST_SET_ID = _fast_set_id_works()
+
+
+def set_id(msg, message_id):
+    """Set the id of a stored Message, like ``msg.id = message_id``.
+
+    Skips the checks of BaseModel.__setattr__, which a Message does not need
+    and which take longer than validating it, unless the model validates
+    assignments.
+    """
+    if not _FAST_SET_ID or msg.model_config.get("validate_assignment"):
+        msg.id = message_id
+        return
+    msg.__dict__["id"] = message_id
+    msg.__pydantic_fields_set__.add("id")
@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# PBKDF2 work factor for new password hashes. Existing hashes keep the
+# factor they were created with and are upgraded on the next login.
+ITERATIONS = int(os.environ.get("CHAT_PBKDF2_ITERATIONS", 260000))
+
+# Upper bound on the number of passwords hashed at the same time.
+HASH_WORKERS = int(os.environ.get("CHAT_HASH_WORKERS", 4))
+
+SALT_BYTES = 16
+
+_executor = None
+_tpool_slots = None
+
+
+def hash_password(password, iterations=None):
+    """Return a salted PBKDF2-SHA256 hash of ``password``.
+
+    The result is formatted as ``pbkdf2_sha256$<iterations>$<salt>$<hash>``.
+    """
+    iterations = iterations or ITERATIONS
+    salt = os.urandom(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return "pbkdf2_sha256$%d$%s$%s" % (
+        iterations,
+        base64.b64encode(salt).decode("ascii"),
+        base64.b64encode(digest).decode("ascii"),
+    )
+
+
+def verify_password(password, stored):
+    """Check ``password`` against a stored hash.
+
+    Unsalted SHA-256 hex digests written by older versions are accepted too.
+
+    Returns:
+        A tuple ``(valid, needs_rehash)``, where ``needs_rehash`` tells that
+        the stored hash should be replaced with hash_password(password).
+
+    """
+    if "$" not in stored:
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+    try:
+        algorithm, iterations, salt, expected = stored.split("$")
+        iterations = int(iterations)
+        salt = base64.b64decode(salt)
+        expected = base64.b64decode(expected)
+    except ValueError:
+        return False, False
+    if algorithm != "pbkdf2_sha256":
+        return False, False
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return hmac.compare_digest(digest, expected), iterations != ITERATIONS
+
+
+def run_blocking(func, *args):
+    """Run a CPU-bound function without stalling the event loop.
+
+    Under eventlet the call goes to its native thread pool, at most
+    HASH_WORKERS calls at a time, otherwise to a pool of HASH_WORKERS
+    threads. Either way the calling greenlet or thread waits for the result.
+    """
+    try:
+        from eventlet import patcher, tpool
+    except ImportError:  # pragma: no cover - eventlet might not be installed
+        patcher = None
+    if patcher is not None and patcher.is_monkey_patched("thread"):
+        # tpool is shared with the rest of the process and has more threads.
+        with _get_tpool_slots():
+            return tpool.execute(func, *args)
+    return _get_executor().submit(func, *args).result()
+
+
+async def run_blocking_async(func, *args):
+    """Like run_blocking, awaiting the result from an asyncio event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), func, *args)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=HASH_WORKERS, thread_name_prefix="chat-hash"
+        )
+    return _executor
+
+
+def _get_tpool_slots():
+    global _tpool_slots
+    if _tpool_slots is None:
+        from eventlet.semaphore import Semaphore
+
+        _tpool_slots = Semaphore(HASH_WORKERS)
+    return _tpool_slots
@@ -0,0 +1,226 @@
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from redis import RedisError
+except Exception:  # pragma: no cover - redis might not be installed
+    class RedisError(Exception):
+        pass
+
+from .logger import logger
+
+# A user is online in a room while its heartbeat is at most this many seconds
+# old. Every worker refreshes the heartbeats of its own sessions every
+# HEARTBEAT_INTERVAL seconds, so the users of a dead worker expire on their own.
+PRESENCE_TTL = 30
+HEARTBEAT_INTERVAL = 10
+
+# Seconds a user whose last session left stays online, so that reconnecting
+# within them is neither announced as a leave nor as a join.
+LEAVE_GRACE = 5
+
+# Joins and leaves are announced at most once per this many seconds per room.
+NOTIFY_INTERVAL = 1
+
+# Join and leave notifications name at most this many users, then count the
+# others.
+MAX_NAMES = 3
+
+# Removes the users of a room whose heartbeat is older than a cutoff, with
+# their session counts. A heartbeat refreshed before the script runs keeps
+# its user, as the score is checked in the same atomic step.
+# KEYS: the presence sorted set and the session counts hash of the room.
+# ARGV: the exclusive cutoff.
+# Returns the users removed.
+SWEEP_SCRIPT = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", "(" .. ARGV[1])
+for _, username in ipairs(expired) do
+    redis.call("ZREM", KEYS[1], username)
+    redis.call("HDEL", KEYS[2], username)
+end
+return expired
+"""
+
+# Counts one session less for a user, and once it has none left, makes its
+# heartbeat expire after the leave grace.
+# KEYS: the presence sorted set and the session counts hash of the room.
+# ARGV: the user and the heartbeat expiring after the grace.
+# Returns the sessions left.
+LEAVE_SCRIPT = """
+local sessions = redis.call("HINCRBY", KEYS[2], ARGV[1], -1)
+if sessions <= 0 then
+    redis.call("HDEL", KEYS[2], ARGV[1])
+    redis.call("ZADD", KEYS[1], "XX", ARGV[2], ARGV[1])
+end
+return sessions
+"""
+
+
+def summarize(usernames, action):
+    """Return one notification for several users, e.g. "a, b and 2 others"."""
+    names = ", ".join(usernames[:MAX_NAMES])
+    others = len(usernames) - MAX_NAMES
+    if others > 0:
+        names += " and %d other%s" % (others, "s" if others > 1 else "")
+    verb = "has" if len(usernames) == 1 else "have"
+    return "%s %s %s the room." % (names, verb, action)
+
+
+class PresenceTracker:
+    """Track the users online in each room with heartbeats kept in Redis.
+
+    The ``room:<id>:presence`` sorted set of a room maps every online user to
+    the time of its last heartbeat, and ``room:<id>:presence:conns`` counts
+    its sessions. Each worker refreshes the heartbeats of its own sessions
+    with one pipelined write per interval and sweeps the expired users out of
+    every room with SWEEP_SCRIPT; the worker whose sweep removes a user
+    announces it left.
+
+    Joins and leaves are gathered per room and handed to ``notify(room_id,
+    joined, left)`` once per NOTIFY_INTERVAL, so a mass reconnect makes one
+    notification per room rather than one per user. A user joining while
+    still online, e.g. reconnecting within LEAVE_GRACE seconds of leaving, is
+    not announced at all.
+    """
+
+    def __init__(
+        self,
+        redis,
+        ttl=PRESENCE_TTL,
+        interval=HEARTBEAT_INTERVAL,
+        grace=LEAVE_GRACE,
+        clock=time.time,
+    ):
+        self.redis = redis
+        self.ttl = ttl
+        self.interval = interval
+        self.grace = grace
+        self.clock = clock
+        self.notify = None
+        self._sessions = {}
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._sweep = redis.register_script(SWEEP_SCRIPT)
+        self._leave = redis.register_script(LEAVE_SCRIPT)
+
+    def key(self, room_id):
+        return "room:%s:presence" % room_id
+
+    def conns_key(self, room_id):
+        return "room:%s:presence:conns" % room_id
+
+    def join(self, sid, room_id, username):
+        """Record that session ``sid`` of ``username`` is in ``room_id``."""
+        previous = self._sessions.get(sid)
+        if previous == (room_id, username):
+            return
+        if previous is not None:
+            self.leave(sid)
+        self._sessions[sid] = (room_id, username)
+        # A transaction, so that a sweep cannot run between the two commands.
+        pipe = self.redis.pipeline()
+        pipe.hincrby(self.conns_key(room_id), username, 1)
+        pipe.zadd(self.key(room_id), {username: self.clock()})
+        _, added = pipe.execute()
+        if added:
+            self._queue(room_id, username, joined=True)
+
+    def leave(self, sid):
+        """Record that session ``sid`` left its room.
+
+        The user stays online for LEAVE_GRACE seconds after its last session
+        left, then the sweep removes it and announces it.
+        """
+        session = self._sessions.pop(sid, None)
+        if session is None:
+            return
+        room_id, username = session
+        self._leave(
+            keys=[self.key(room_id), self.conns_key(room_id)],
+            args=[username, repr(self.clock() - self.ttl + self.grace)],
+        )
+
+    def online(self, room_id):
+        """Return the users online in a room, most recently seen first."""
+        users = self.redis.zrevrangebyscore(
+            self.key(room_id), "+inf", self.clock() - self.ttl, withscores=True
+        )
+        return [
+            {"username": username.decode("utf-8"), "last_seen": last_seen}
+            for username, last_seen in users
+        ]
+
+    def heartbeat(self):
+        """Refresh the heartbeats of the sessions of this worker."""
+        rooms = {}
+        for room_id, username in list(self._sessions.values()):
+            rooms.setdefault(room_id, set()).add(username)
+        if not rooms:
+            return
+        now = self.clock()
+        pipe = self.redis.pipeline(transaction=False)
+        for room_id, usernames in rooms.items():
+            pipe.zadd(self.key(room_id), {username: now for username in usernames})
+        pipe.execute()
+
+    def sweep(self, rooms=None):
+        """Remove the users whose heartbeat expired and return them by room."""
+        if rooms is None:
+            rooms = sorted(
+                room.decode("utf-8") for room in self.redis.smembers("rooms_ids")
+            )
+        cutoff = repr(self.clock() - self.ttl)
+        pipe = self.redis.pipeline(transaction=False)
+        for room_id in rooms:
+            self._sweep(
+                keys=[self.key(room_id), self.conns_key(room_id)],
+                args=[cutoff],
+                client=pipe,
+            )
+        left = {}
+        for room_id, usernames in zip(rooms, pipe.execute()):
+            for username in usernames:
+                username = username.decode("utf-8")
+                left.setdefault(room_id, []).append(username)
+                self._queue(room_id, username, joined=False)
+        return left
+
+    def _queue(self, room_id, username, joined):
+        if self.notify is None:
+            return
+        with self._lock:
+            pending = self._pending.setdefault(room_id, OrderedDict())
+            # A join and a leave of the same user cancel out.
+            if pending.pop(username, joined) == joined:
+                pending[username] = joined
+
+    def flush(self):
+        """Send the joins and leaves gathered since the last flush."""
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        for room_id, changes in pending.items():
+            joined = [username for username, j in changes.items() if j]
+            left = [username for username, j in changes.items() if not j]
+            if joined or left:
+                self.notify(room_id, joined, left)
+
+    def start(self, notify):
+        self.notify = notify
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        next_heartbeat = 0
+        while True:
+            if time.monotonic() >= next_heartbeat:
+                next_heartbeat = time.monotonic() + self.interval
+                try:
+                    self.heartbeat()
+                    self.sweep()
+                except RedisError:
+                    logger.exception("Error updating presence")
+            self.flush()
+            time.sleep(NOTIFY_INTERVAL)
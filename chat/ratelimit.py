@@ -0,0 +1,117 @@
+"""Token-bucket limits on the messages sent per user, room and client IP.
+
+A limit is written ``COUNT/SECONDS``: ``20/10`` lets a bucket send bursts of
+up to 20 messages, refilled at 2 messages per second.
+"""
+import threading
+import time
+from collections import namedtuple
+
+Limit = namedtuple("Limit", ["rate", "burst"])
+
+# Known-empty buckets remembered by a worker before the expired ones are
+# dropped.
+MAX_BLOCKED = 10000
+
+# Takes a token from every bucket of KEYS if each of them has one, and
+# returns for each bucket the seconds until it has one again (0 if it had).
+# ARGV holds the current time, then the rate and burst of each bucket.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local waits = {}
+local allowed = true
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call("HMGET", key, "tokens", "ts")
+    local level = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    level = math.min(burst, level + elapsed * rate)
+    levels[i] = level
+    waits[i] = "0"
+    if level < 1 then
+        allowed = false
+        waits[i] = tostring((1 - level) / rate)
+    end
+end
+if allowed then
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[i * 2])
+        local burst = tonumber(ARGV[i * 2 + 1])
+        redis.call("HSET", key, "tokens", tostring(levels[i] - 1), "ts", ARGV[1])
+        redis.call("EXPIRE", key, math.ceil(burst / rate) + 1)
+    end
+end
+return waits
+"""
+
+
+def parse_limit(value):
+    """Return the Limit written ``COUNT/SECONDS``, or None if it is empty."""
+    if not value:
+        return None
+    count, _, seconds = value.partition("/")
+    count, seconds = int(count), float(seconds or 1)
+    if count <= 0 or seconds <= 0:
+        raise ValueError("Invalid rate limit: %s" % value)
+    return Limit(rate=count / seconds, burst=count)
+
+
+class RateLimiter:
+    """Limit the messages sent per user, per room and per client IP.
+
+    Every scope with a Limit has one token bucket per user, room or IP in
+    Redis. A message takes a token from each of its buckets, atomically with
+    one script call, or from none of them if one is empty. The worker then
+    remembers until when the empty bucket stays empty, and rejects the next
+    messages of a flood without calling Redis at all.
+    """
+
+    def __init__(self, redis, user=None, room=None, ip=None, clock=time.time):
+        self.limits = {"user": user, "room": room, "ip": ip}
+        self.clock = clock
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+        self._blocked = {}
+        self._lock = threading.Lock()
+
+    def key(self, scope, value):
+        return "ratelimit:%s:%s" % (scope, value)
+
+    def hit(self, user=None, room=None, ip=None):
+        """Count one message against the buckets of ``user``, ``room`` and ``ip``.
+
+        Returns:
+            0 if the message is allowed, otherwise the seconds to wait before
+            it would be.
+
+        """
+        buckets = [
+            (self.key(scope, value), self.limits[scope])
+            for scope, value in (("user", user), ("room", room), ("ip", ip))
+            if value is not None and self.limits[scope] is not None
+        ]
+        if not buckets:
+            return 0
+        now = self.clock()
+        with self._lock:
+            wait = max(self._blocked.get(key, now) - now for key, _ in buckets)
+        if wait > 0:
+            return wait
+
+        args = [repr(now)]
+        for _, limit in buckets:
+            args += [repr(limit.rate), limit.burst]
+        waits = [
+            float(wait)
+            for wait in self._script(keys=[key for key, _ in buckets], args=args)
+        ]
+        with self._lock:
+            for (key, _), wait in zip(buckets, waits):
+                if wait > 0:
+                    self._blocked[key] = now + wait
+            if len(self._blocked) > MAX_BLOCKED:
+                self._blocked = {
+                    key: until for key, until in self._blocked.items() if until > now
+                }
+        return max(waits)
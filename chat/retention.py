@@ -0,0 +1,219 @@
+"""Per-room message retention.
+
+Usage:
+    python -m chat.retention policy ROOM [--max-count N] [--max-age SECONDS]
+    python -m chat.retention trim [--room ID ...]
+
+policy
+    Set the retention policy of a room, or remove it when neither limit is
+    given. Rooms without a policy use CHAT_RETENTION_MAX_COUNT and
+    CHAT_RETENTION_MAX_AGE.
+
+trim
+    Trim the rooms once, archiving the trimmed messages to CHAT_ARCHIVE_DIR
+    when it is set.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from redis import RedisError
+except Exception:  # pragma: no cover - redis might not be installed
+    class RedisError(Exception):
+        pass
+
+from .logger import logger
+
+# Hash mapping a room id to its JSON retention policy.
+POLICIES_KEY = "retention"
+
+# Set of the ids of the rooms with archived messages, so that history pages
+# only read the archive of those rooms.
+ARCHIVED_KEY = "archived_rooms"
+
+# Seconds after which the trim lock of a room is released if its holder died.
+LOCK_TTL = 300
+
+
+def default_policy():
+    """Return the retention policy configured by the environment."""
+    policy = {}
+    if os.environ.get("CHAT_RETENTION_MAX_COUNT"):
+        policy["max_count"] = int(os.environ["CHAT_RETENTION_MAX_COUNT"])
+    if os.environ.get("CHAT_RETENTION_MAX_AGE"):
+        policy["max_age"] = float(os.environ["CHAT_RETENTION_MAX_AGE"])
+    return policy
+
+
+def set_policy(redis, room_id, max_count=None, max_age=None):
+    """Keep at most ``max_count`` messages of ``max_age`` seconds in a room."""
+    policy = {
+        key: value
+        for key, value in (("max_count", max_count), ("max_age", max_age))
+        if value is not None
+    }
+    if policy:
+        redis.hset(POLICIES_KEY, room_id, json.dumps(policy))
+    else:
+        redis.hdel(POLICIES_KEY, room_id)
+
+
+class RetentionTrimmer:
+    """Move the messages exceeding a room's retention policy to the archive.
+
+    A room's policy caps the number of messages (``max_count``) and/or their
+    age in seconds (``max_age``). Messages are trimmed oldest first, in
+    batches: each batch is written to the archive before it is removed from
+    the store, so a crash can archive messages twice but never loses them.
+    Without an archive the trimmed messages are dropped. Trimmed messages
+    are removed from the search ``index``. Every worker can run a trimmer; a
+    lock in Redis lets only one of them trim a room at a time.
+    """
+
+    def __init__(
+        self,
+        redis,
+        store,
+        archive=None,
+        default=None,
+        interval=60,
+        batch=1000,
+        index=None,
+    ):
+        self.redis = redis
+        self.store = store
+        self.archive = archive
+        self.index = index
+        self.default = default or {}
+        self.interval = interval
+        self.batch = batch
+        self._marked = False
+        self._thread = None
+
+    def policy(self, room_id):
+        """Return the retention policy of a room."""
+        policy = self.redis.hget(POLICIES_KEY, room_id)
+        return json.loads(policy) if policy else self.default
+
+    def trim_room(self, room_id, now=None):
+        """Apply the retention policy of a room and return the trimmed count."""
+        policy = self.policy(room_id)
+        max_count = policy.get("max_count")
+        max_age = policy.get("max_age")
+        if max_count is None and max_age is None:
+            return 0
+        lock = "room:%s:trim_lock" % room_id
+        token = str(uuid.uuid4())
+        if not self.redis.set(lock, token, nx=True, ex=LOCK_TTL):
+            return 0
+        try:
+            excess = 0
+            if max_count is not None:
+                excess = max(0, self.store.count(room_id) - max_count)
+            cutoff = None
+            if max_age is not None:
+                cutoff = (now if now is not None else time.time()) - max_age
+            trimmed = 0
+            while True:
+                entries = self.store.oldest(room_id, self.batch)
+                expired = []
+                for handle, message in entries:
+                    if trimmed + len(expired) < excess or (
+                        cutoff is not None and message["timestamp"] < cutoff
+                    ):
+                        expired.append((handle, message))
+                    else:
+                        break
+                if not expired:
+                    break
+                if self.archive is not None:
+                    self.archive.write(room_id, [message for _, message in expired])
+                    self.redis.sadd(ARCHIVED_KEY, room_id)
+                self.store.remove(room_id, [handle for handle, _ in expired])
+                if self.index is not None:
+                    self.index.remove(room_id, [message for _, message in expired])
+                trimmed += len(expired)
+                if len(expired) < self.batch:
+                    break
+            return trimmed
+        finally:
+            if self.redis.get(lock) == token.encode("utf-8"):
+                self.redis.delete(lock)
+
+    def trim(self, rooms=None):
+        """Trim ``rooms`` (default: every room) and return the trimmed counts."""
+        if self.archive is not None and not self._marked:
+            # Mark the rooms archived before ARCHIVED_KEY existed.
+            archived = self.archive.rooms()
+            if archived:
+                self.redis.sadd(ARCHIVED_KEY, *archived)
+            self._marked = True
+        if rooms is None:
+            rooms = sorted(
+                room.decode("utf-8") for room in self.redis.smembers("rooms_ids")
+            )
+        trimmed = {}
+        for room_id in rooms:
+            trimmed[room_id] = self.trim_room(room_id)
+            if trimmed[room_id]:
+                logger.info(
+                    "Trimmed %d messages from room %s", trimmed[room_id], room_id
+                )
+        return trimmed
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.trim()
+            except (RedisError, OSError):
+                logger.exception("Error trimming rooms")
+            time.sleep(self.interval)
+
+
+def main(argv=None):
+    from .archive import SegmentArchive
+    from .connection import redis_from_env
+    from .search import SearchIndex
+    from .storage import make_store
+
+    parser = argparse.ArgumentParser(description="Chat message retention")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    policy = subparsers.add_parser("policy", help="set the policy of a room")
+    policy.add_argument("room")
+    policy.add_argument("--max-count", type=int)
+    policy.add_argument("--max-age", type=float, help="seconds")
+    trim = subparsers.add_parser("trim", help="trim the rooms once")
+    trim.add_argument("--room", action="append", help="room id (default: all)")
+    args = parser.parse_args(argv)
+
+    redis = redis_from_env()
+    if args.command == "policy":
+        set_policy(redis, args.room, args.max_count, args.max_age)
+    elif args.command == "trim":
+        archive_dir = os.environ.get("CHAT_ARCHIVE_DIR")
+        trimmer = RetentionTrimmer(
+            redis,
+            make_store(redis, os.environ.get("CHAT_STORAGE", "zset")),
+            SegmentArchive(archive_dir) if archive_dir else None,
+            default=default_policy(),
+            index=SearchIndex(redis)
+            if os.environ.get("CHAT_SEARCH") == "1"
+            else None,
+        )
+        for room_id, count in trimmer.trim(args.room).items():
+            print("room %s: trimmed %d messages" % (room_id, count))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
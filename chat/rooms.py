@@ -0,0 +1,328 @@
+"""The room registry: a hash per room and sorted indexes to list them.
+
+Every room has a ``room:<id>:info`` hash holding its id, topic, owner and
+creation time, and is indexed by three sorted sets: ``rooms:by_id`` by id,
+``rooms:by_activity`` by the time of its latest message and
+``rooms:by_members`` by the number of users who joined it. ``rooms_ids``
+stays the set of room ids, which the existence checks and the background
+jobs read. A room and its index entries are created and deleted together in
+one MULTI/EXEC transaction or script, and a member joins or leaves a room
+together with its count in ``rooms:by_members``, so a crash or a concurrent
+delete cannot leave them apart.
+"""
+import threading
+import time
+
+from .models import ChatRoom
+
+# Default and maximum number of rooms returned by a page of the room list.
+ROOMS_PAGE_SIZE = 100
+MAX_ROOMS_PAGE_SIZE = 500
+
+# The orders in which rooms can be listed, and the sorted set of each.
+SORTS = {
+    "id": "rooms:by_id",
+    "activity": "rooms:by_activity",
+    "members": "rooms:by_members",
+}
+
+# A worker updates the activity of a room at most once per this many seconds,
+# rather than on every message.
+ACTIVITY_INTERVAL = 10
+
+# Assigns the next free room id and registers the room under it.
+# KEYS: the id counter, the set of room ids, then the id, activity and
+# members indexes.
+# ARGV: the topic, the creation time and the owner ("" for none).
+# Returns the id of the room.
+CREATE_ROOM_SCRIPT = """
+local room_id = redis.call("INCR", KEYS[1])
+-- Skip the ids taken by the rooms registered with a fixed id.
+while redis.call("SISMEMBER", KEYS[2], room_id) == 1 do
+    room_id = redis.call("INCR", KEYS[1])
+end
+local info = "room:" .. room_id .. ":info"
+redis.call("HSET", info, "id", room_id, "topic", ARGV[1], "created", ARGV[2])
+if ARGV[3] ~= "" then
+    redis.call("HSET", info, "owner", ARGV[3])
+end
+redis.call("ZADD", KEYS[3], room_id, room_id)
+redis.call("ZADD", KEYS[4], ARGV[2], room_id)
+redis.call("ZADD", KEYS[5], 0, room_id)
+redis.call("SADD", KEYS[2], room_id)
+return room_id
+"""
+
+# Adds a user to the members of a room, or removes it, and updates the count
+# of members in the index.
+# KEYS: the members of the room, the members index and the set of room ids.
+# ARGV: the room id, the user name and "1" to add it or "-1" to remove it.
+# Returns 1 if the members changed, 0 if not and -1 if the room does not
+# exist.
+MEMBER_SCRIPT = """
+if redis.call("SISMEMBER", KEYS[3], ARGV[1]) == 0 then
+    return -1
+end
+local changed
+if ARGV[3] == "1" then
+    changed = redis.call("SADD", KEYS[1], ARGV[2])
+else
+    changed = redis.call("SREM", KEYS[1], ARGV[2])
+end
+if changed == 1 then
+    redis.call("ZINCRBY", KEYS[2], ARGV[3], ARGV[1])
+end
+return changed
+"""
+
+# The rooms every deployment starts with.
+DEFAULT_ROOMS = [
+    ChatRoom(id=1, topic="cats"),
+    ChatRoom(id=2, topic="dogs"),
+    ChatRoom(id=3, topic="birds"),
+]
+
+
+class RoomRegistry:
+    """Create, delete and list the chat rooms.
+
+    Pages of the id order start after the id of the cursor, so rooms created
+    or deleted while a client pages through them do not shift the others.
+    The activity and member orders change all the time, their cursors are
+    offsets: a room moving while a client pages may be listed twice or
+    skipped.
+
+    The methods named ``queue_*`` only add commands to a pipeline, and
+    ``*_args``/``make_page`` only build and parse commands, so that chat.aio
+    can run the same commands and scripts on an asyncio client.
+    """
+
+    def __init__(self, redis, replica=None, clock=time.time):
+        self.redis = redis
+        # Pages are read from the replica, which may lag behind.
+        self.replica = replica if replica is not None else redis
+        self.clock = clock
+        self._touched = {}
+        self._lock = threading.Lock()
+        if redis is not None:
+            self._create = redis.register_script(CREATE_ROOM_SCRIPT)
+            self._member = redis.register_script(MEMBER_SCRIPT)
+
+    def info_key(self, room_id):
+        return "room:%s:info" % room_id
+
+    def users_key(self, room_id):
+        return "room:%s:users" % room_id
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def queue_create(self, pipe, room, owner=None, members=0):
+        """Queue the commands registering ``room`` (a ChatRoom)."""
+        now = self.clock()
+        info = {"id": room.id, "topic": room.topic, "created": repr(now)}
+        if owner is not None:
+            info["owner"] = owner
+        pipe.hset(self.info_key(room.id), mapping=info)
+        pipe.zadd(SORTS["id"], {room.id: room.id})
+        pipe.zadd(SORTS["activity"], {room.id: now})
+        pipe.zadd(SORTS["members"], {room.id: members})
+        pipe.sadd("rooms_ids", room.id)
+
+    def queue_delete(self, pipe, room_id):
+        """Queue the commands removing a room, its members and index entries.
+
+        The result of the first command tells whether the room existed. Its
+        messages are left to the retention policies.
+        """
+        pipe.delete(self.info_key(room_id))
+        for key in SORTS.values():
+            pipe.zrem(key, room_id)
+        pipe.srem("rooms_ids", room_id)
+        pipe.delete(self.users_key(room_id))
+
+    def create_args(self, topic, owner=None):
+        """Return the keys and arguments of the script creating a room.
+
+        Raises:
+            ValidationError: The topic is invalid.
+
+        """
+        # The id is only assigned once the topic is known to be valid.
+        topic = ChatRoom(id=0, topic=topic).topic
+        keys = ["rooms:last_id", "rooms_ids"]
+        keys += [SORTS["id"], SORTS["activity"], SORTS["members"]]
+        return keys, [topic, repr(self.clock()), owner or ""]
+
+    def create(self, topic, owner=None):
+        """Create a room and return it as a dict.
+
+        Raises:
+            ValidationError: The topic is invalid.
+
+        """
+        keys, args = self.create_args(topic, owner)
+        room_id = self._create(keys=keys, args=args)
+        return ChatRoom(id=room_id, topic=args[0]).model_dump()
+
+    def delete(self, room_id):
+        """Delete a room, return whether it existed."""
+        pipe = self.redis.pipeline()
+        self.queue_delete(pipe, room_id)
+        return bool(pipe.execute()[0])
+
+    def ensure(self, rooms):
+        """Register the rooms (ChatRooms) that are not registered yet.
+
+        Costs one round trip when they all are, e.g. on every startup.
+
+        Returns:
+            The ids of the rooms registered.
+
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for room in rooms:
+            pipe.exists(self.info_key(room.id))
+            pipe.scard(self.users_key(room.id))
+        missing = self.missing(rooms, pipe.execute())
+        if missing:
+            pipe = self.redis.pipeline()
+            for room, members in missing:
+                self.queue_create(pipe, room, members=members)
+            pipe.execute()
+        return [room.id for room, _ in missing]
+
+    @staticmethod
+    def missing(rooms, results):
+        """Return the (room, members) not registered, from ensure's replies."""
+        return [
+            (room, members)
+            for room, exists, members in zip(rooms, results[::2], results[1::2])
+            if not exists
+        ]
+
+    def member_args(self, room_id, username, joined):
+        """Return the keys and arguments of the script changing a member.
+
+        ``joined`` tells whether to add or remove it, member_changed reads
+        the reply.
+        """
+        keys = [self.users_key(room_id), SORTS["members"], "rooms_ids"]
+        return keys, [room_id, username, 1 if joined else -1]
+
+    @staticmethod
+    def member_changed(reply):
+        """Return whether the members changed, or None if the room is gone."""
+        return None if reply < 0 else bool(reply)
+
+    def add_member(self, room_id, username):
+        """Add a user to a room.
+
+        Returns:
+            Whether it was not a member yet, or None if the room does not
+            exist.
+
+        """
+        keys, args = self.member_args(room_id, username, True)
+        return self.member_changed(self._member(keys=keys, args=args))
+
+    def remove_member(self, room_id, username):
+        """Remove a user from a room.
+
+        Returns:
+            Whether it was a member, or None if the room does not exist.
+
+        """
+        keys, args = self.member_args(room_id, username, False)
+        return self.member_changed(self._member(keys=keys, args=args))
+
+    def activity_due(self, room_id, timestamp):
+        """Return whether this worker should record activity in a room now."""
+        with self._lock:
+            if timestamp - self._touched.get(room_id, 0) < ACTIVITY_INTERVAL:
+                return False
+            self._touched[room_id] = timestamp
+            return True
+
+    def touch(self, room_id, timestamp):
+        """Record that a message was sent to a room at ``timestamp``."""
+        self.queue_touch(self.redis, room_id, timestamp)
+
+    def queue_touch(self, pipe, room_id, timestamp):
+        """Queue the command of touch() on ``pipe``, if activity is due."""
+        if self.activity_due(room_id, timestamp):
+            # XX: a deleted room does not come back into the index.
+            pipe.zadd(SORTS["activity"], {room_id: timestamp}, xx=True)
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def parse_cursor(sort, cursor):
+        """Return the position a page starts from, or raise ValueError."""
+        if sort not in SORTS:
+            raise ValueError("Unknown room order: %s" % sort)
+        if cursor is None or cursor == "":
+            return None if sort == "id" else 0
+        position = int(cursor)
+        if position < 0:
+            raise ValueError("Negative room cursor: %s" % cursor)
+        return position
+
+    @staticmethod
+    def range_args(sort, start, limit):
+        """Return the command and arguments reading the ids of a page.
+
+        One more id than ``limit`` is read to know whether a page follows.
+        """
+        if sort == "id":
+            low = "-inf" if start is None else "(%d" % start
+            return "zrangebyscore", (SORTS["id"], low, "+inf"), {
+                "start": 0,
+                "num": limit + 1,
+            }
+        return "zrevrange", (SORTS[sort], start, start + limit), {}
+
+    def make_page(self, sort, start, limit, ids, infos):
+        """Return the page of rooms read by range_args and get_info.
+
+        Returns:
+            A dict with the ``rooms``, as dicts with their id and topic, and
+            the ``next_cursor``, None on the last page.
+
+        """
+        rooms = [
+            {"id": int(info[b"id"]), "topic": info[b"topic"].decode("utf-8")}
+            # Rooms deleted since the index was read have no info left.
+            for info in infos
+            if info
+        ]
+        next_cursor = None
+        if len(ids) > limit:
+            next_cursor = int(ids[limit - 1]) if sort == "id" else start + limit
+        return {"rooms": rooms, "next_cursor": next_cursor}
+
+    def page(self, sort="id", cursor=None, limit=ROOMS_PAGE_SIZE):
+        """Return a page of rooms in ``sort`` order, see make_page.
+
+        Raises:
+            ValueError: The order or the cursor is invalid.
+
+        """
+        start = self.parse_cursor(sort, cursor)
+        command, args, kwargs = self.range_args(sort, start, limit)
+        ids = getattr(self.replica, command)(*args, **kwargs)
+        pipe = self.replica.pipeline(transaction=False)
+        for room_id in ids[:limit]:
+            pipe.hgetall(self.info_key(room_id.decode("utf-8")))
+        infos = pipe.execute() if ids else []
+        return self.make_page(sort, start, limit, ids, infos)
+
+    def get(self, room_id):
+        """Return the info hash of a room decoded, or None."""
+        info = self.redis.hgetall(self.info_key(room_id))
+        if not info:
+            return None
+        return {k.decode("utf-8"): v.decode("utf-8") for k, v in info.items()}
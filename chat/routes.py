@@ -1,17 +1,148 @@
-from flask import jsonify, request, Blueprint
-from redis import Redis
-from pydantic import ValidationError
+import hashlib
+import math
+import os
+
+from flask import Response, jsonify, request, url_for, Blueprint
+from redis import RedisError
 import json
-from .models import ChatRoom
 from .logger import logger
-from .api import ChatAPI
-from .errors import ChatAPIError
+from .api import ChatAPI, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, page_etag
+from .cache import MISSING, ChatCache
+from .compression import MIN_SIZE, compress, negotiate
+from .errors import ChatAPIError, RateLimitedError
+from .storage import make_store
+from .archive import SegmentArchive
+from .search import SearchIndex
+from .presence import PresenceTracker
+from .ratelimit import RateLimiter, parse_limit
+from .rooms import DEFAULT_ROOMS, MAX_ROOMS_PAGE_SIZE, ROOMS_PAGE_SIZE
+from .connection import CircuitBreaker, protect, redis_from_env
+from . import metrics
 
 bp = Blueprint("chat", __name__)
 
-redis = Redis(host="redis", port=6379)
-
-chat_api = ChatAPI(redis)
+# Number of messages written per chunk of a streamed history response.
+STREAM_CHUNK = 50
+
+# The Redis connection pool, timeouts and health checks are configured by the
+# REDIS_* variables (see chat.connection). After CHAT_BREAKER_THRESHOLD
+# consecutive connection errors or timeouts, requests fail at once with a 503
+# for CHAT_BREAKER_RESET seconds instead of each waiting on Redis.
+breaker = CircuitBreaker(
+    threshold=int(os.environ.get("CHAT_BREAKER_THRESHOLD", 5)),
+    reset_timeout=float(os.environ.get("CHAT_BREAKER_RESET", 5)),
+)
+redis = metrics.instrument_redis(protect(redis_from_env(), breaker))
+
+# History pages and the room list are read from the replica configured by the
+# REDIS_REPLICA_* variables when REDIS_REPLICA_HOST is set. It has a breaker
+# of its own, so that it can fail without failing the requests to the primary.
+replica = (
+    metrics.instrument_redis(
+        protect(
+            redis_from_env("REDIS_REPLICA"),
+            CircuitBreaker(breaker.threshold, breaker.reset_timeout),
+        )
+    )
+    if os.environ.get("REDIS_REPLICA_HOST")
+    else None
+)
+
+# CHAT_STORAGE selects where messages are kept: "zset" (default) or
+# "stream". CHAT_STREAM_MAXLEN caps the length of each room's stream.
+# CHAT_ENCODING selects how new messages are stored: "json" (default) or the
+# more compact "msgpack".
+store = make_store(
+    redis,
+    os.environ.get("CHAT_STORAGE", "zset"),
+    maxlen=int(os.environ["CHAT_STREAM_MAXLEN"])
+    if os.environ.get("CHAT_STREAM_MAXLEN")
+    else None,
+    encoding=os.environ.get("CHAT_ENCODING", "json"),
+    replica=replica,
+)
+
+# Messages trimmed by the retention policies are kept in gzip segment files
+# under CHAT_ARCHIVE_DIR, where history pages read them back from.
+archive = (
+    SegmentArchive(os.environ["CHAT_ARCHIVE_DIR"])
+    if os.environ.get("CHAT_ARCHIVE_DIR")
+    else None
+)
+
+# With CHAT_SEARCH=1 new messages are added to the search index, which costs a
+# second copy of each message in Redis. Capped streams prune it as they trim.
+index = SearchIndex(redis) if os.environ.get("CHAT_SEARCH") == "1" else None
+
+# The newest messages of recently read rooms are cached in each worker, in at
+# most CHAT_HISTORY_CACHE_BYTES bytes (0 disables the cache).
+cache = ChatCache(
+    redis, history_bytes=int(os.environ.get("CHAT_HISTORY_CACHE_BYTES", 64 << 20))
+)
+
+# JSON responses of at least CHAT_COMPRESS_MIN_BYTES bytes are compressed with
+# brotli or gzip for the clients accepting it, unless CHAT_COMPRESS=0.
+compress_responses = os.environ.get("CHAT_COMPRESS", "1") != "0"
+compress_min_bytes = int(os.environ.get("CHAT_COMPRESS_MIN_BYTES", MIN_SIZE))
+
+# The users online in each room are tracked with heartbeats (see
+# chat.presence), which every worker sends for its own sessions.
+presence = PresenceTracker(redis)
+
+# Sends are limited per user, per room and per client IP by the token buckets
+# of CHAT_RATE_LIMIT_USER, CHAT_RATE_LIMIT_ROOM and CHAT_RATE_LIMIT_IP, each
+# written COUNT/SECONDS (e.g. 20/10), and unlimited when unset.
+rate_limits = {
+    scope: parse_limit(os.environ.get("CHAT_RATE_LIMIT_%s" % scope.upper()))
+    for scope in ("user", "room", "ip")
+}
+limiter = RateLimiter(redis, **rate_limits) if any(rate_limits.values()) else None
+
+chat_api = metrics.instrument_api(
+    ChatAPI(
+        redis,
+        cache=cache,
+        store=store,
+        archive=archive,
+        index=index,
+        presence=presence,
+        limiter=limiter,
+        replica=replica,
+    )
+)
+
+
+def client_ip():
+    """Return the address of the client, as forwarded by nginx if it is."""
+    return request.headers.get("X-Real-IP", request.remote_addr)
+
+
+@bp.before_request
+def fail_fast():
+    """Answer 503 at once while Redis is known to be unavailable."""
+    retry_after = breaker.retry_after()
+    if retry_after > 0 and request.endpoint != "chat.get_metrics":
+        response = jsonify({"error": "Service unavailable"})
+        response.headers["Retry-After"] = str(math.ceil(retry_after))
+        return response, 503
+    return None
+
+
+@bp.after_request
+def add_retry_after(response):
+    """Tell when to retry a request that failed as the circuit opened."""
+    if response.status_code == 503 and "Retry-After" not in response.headers:
+        retry_after = breaker.retry_after()
+        if retry_after > 0:
+            response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
+@bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Expose the server metrics in the Prometheus text format."""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
 
 @bp.route("/register", methods=["POST"])
@@ -25,10 +156,10 @@ def register():
 
     try:
         chat_api.register_user(username, password)
-        logger.info("Registered user %s" % username)
+        logger.info("Registered user %s", username)
         return jsonify({"success": True}), 201
     except ChatAPIError as e:
-        logger.error("Error registering user: %s" % e)
+        logger.error("Error registering user: %s", e)
         return jsonify({"error": str(e)}), e.get_status_code()
 
 
@@ -43,29 +174,123 @@ def login():
 
     try:
         token = chat_api.login_user(username, password)
-        logger.info("User %s logged in" % username)
+        logger.info("User %s logged in", username)
         return jsonify({"token": token}), 200
     except ChatAPIError as e:
-        logger.error("Error logging in: %s" % e)
+        logger.error("Error logging in: %s", e)
+        return jsonify({"error": str(e)}), e.get_status_code()
+
+
+@bp.route("/logout", methods=["POST"])
+def logout():
+    """Revoke the token used to authenticate the request."""
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    try:
+        username = chat_api.verify_token(token)
+        chat_api.logout_user(token)
+        logger.info("User %s logged out", username)
+        return jsonify({"success": True}), 200
+    except ChatAPIError as e:
+        logger.error("Error logging out: %s", e)
         return jsonify({"error": str(e)}), e.get_status_code()
 
 
 @bp.route("/rooms", methods=["GET"])
 def get_rooms():
-    """Get all chat rooms.
+    """Get a page of chat rooms.
+
+    Query Parameters:
+        sort: "id" (default), "activity" (latest message first) or "members"
+            (most members first)
+        cursor: the cursor of the next page, from the Link header
+        limit: int, page size (default 100, at most 500)
 
     Returns:
-        A JSON object containing the chat rooms and a status code.
+        A JSON list of the rooms and a status code. When more rooms follow,
+        the Link header points at the next page (rel="next"). The weak ETag
+        of the page lets clients revalidate it with If-None-Match, and get a
+        304 without a body if it did not change.
 
     """
+    sort = request.args.get("sort", "id")
     try:
-        rooms = chat_api.get_rooms()
-        logger.info("Got %d chat rooms" % len(rooms))
-        return jsonify(rooms), 200
+        limit = int(request.args.get("limit", ROOMS_PAGE_SIZE))
+        if not 0 < limit <= MAX_ROOMS_PAGE_SIZE:
+            raise ValueError("limit out of range")
+    except ValueError as e:
+        logger.error("Invalid room list query: %s", e)
+        return jsonify({"error": "Invalid query parameters"}), 400
+
+    try:
+        page = chat_api.get_rooms_page(sort, request.args.get("cursor"), limit)
+        logger.info("Got %d chat rooms", len(page["rooms"]))
     except ChatAPIError as e:
-        logger.error("Error getting chat rooms: %s" % e)
+        logger.error("Error getting chat rooms: %s", e)
         return jsonify({"error": "Error getting chat rooms"}), e.get_status_code()
 
+    body = jsonify(page["rooms"]).get_data()
+    etag = hashlib.sha1(body).hexdigest()
+    response = _not_modified(etag)
+    if response is None:
+        response = _json_response(body, etag, ("rooms", etag))
+    if page["next_cursor"] is not None:
+        next_url = url_for(
+            "chat.get_rooms", sort=sort, cursor=page["next_cursor"], limit=limit
+        )
+        response.headers["Link"] = '<%s>; rel="next"' % next_url
+    return response
+
+
+@bp.route("/rooms", methods=["POST"])
+def create_room():
+    """Create a chat room, which only its creator can delete.
+
+    Payload:
+        {
+            "topic": str
+        }
+
+    Returns:
+        A JSON object containing the room id and topic, and a status code.
+
+    """
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    try:
+        topic = request.json["topic"]
+    except (KeyError, TypeError):
+        return jsonify({"error": "Invalid request"}), 400
+
+    try:
+        username = chat_api.verify_token(token)
+        room = chat_api.create_room(topic, username)
+        logger.info("User %s created room %s", username, room["id"])
+        return jsonify(room), 201
+    except ChatAPIError as e:
+        logger.error("Error creating room: %s", e)
+        return jsonify({"error": str(e)}), e.get_status_code()
+
+
+@bp.route("/rooms/<room_id>", methods=["DELETE"])
+def delete_room(room_id):
+    """Delete a chat room created by the authenticated user.
+
+    Args:
+        room_id: str
+
+    Returns:
+        A JSON object containing a success message and a status code.
+
+    """
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    try:
+        username = chat_api.verify_token(token)
+        chat_api.delete_room(room_id, username)
+        logger.info("User %s deleted room %s", username, room_id)
+        return jsonify({"success": True}), 200
+    except ChatAPIError as e:
+        logger.error("Error deleting room: %s", e)
+        return jsonify({"error": str(e)}), e.get_status_code()
+
 
 @bp.route("/rooms/<room_id>/users/<user_id>", methods=["POST"])
 def join_room(room_id, user_id):
@@ -85,13 +310,34 @@ def join_room(room_id, user_id):
         if authenticated != user_id:
             raise ChatAPIError("Unauthorized", 401)
         chat_api.join_room(room_id, user_id)
-        logger.info("User %s joined room %s" % (user_id, room_id))
+        logger.info("User %s joined room %s", user_id, room_id)
         return jsonify({"success": True}), 201
     except ChatAPIError as e:
-        logger.error("Error joining room: %s" % e)
+        logger.error("Error joining room: %s", e)
         return jsonify({"error": "Error joining room"}), e.get_status_code()
 
 
+@bp.route("/rooms/<room_id>/presence", methods=["GET"])
+def get_presence(room_id):
+    """Get the users online in a chat room.
+
+    Args:
+        room_id: str
+
+    Returns:
+        A JSON object containing the online users, with the time of their
+        last heartbeat, their count and a status code.
+
+    """
+    try:
+        presence = chat_api.get_presence(room_id)
+        logger.info("%d users online in room: %s", presence["count"], room_id)
+        return jsonify(presence), 200
+    except ChatAPIError as e:
+        logger.error("Error getting room presence: %s", e)
+        return jsonify({"error": str(e)}), e.get_status_code()
+
+
 @bp.route("/rooms/<room_id>/messages", methods=["POST"])
 def send_message(room_id):
     """Send a message to a chat room.
@@ -99,6 +345,10 @@ def send_message(room_id):
     Args:
         room_id: str
 
+    Headers:
+        Idempotency-Key: str, optional. Retries of a send with the same key
+            store the message only once and return the same id.
+
     Payload:
         {
             "sender_id": str,
@@ -106,66 +356,214 @@ def send_message(room_id):
         }
 
     Returns:
-        A JSON object containing the message id and a status code.
+        A JSON object containing the message id and a status code. A 429
+        response tells in ``retry_after`` and the Retry-After header how
+        many seconds to wait before sending again.
 
     """
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    idempotency_key = request.headers.get("Idempotency-Key")
     try:
         sender_id = request.json["sender_id"]
         message = request.json["message"]
     except (KeyError, TypeError) as e:
-        logger.error("Error getting message from request body: %s" % e)
+        logger.error("Error getting message from request body: %s", e)
         return jsonify({"error": "Invalid request body format"}), 400
 
     try:
         authenticated = chat_api.verify_token(token)
         if authenticated != sender_id:
             raise ChatAPIError("Unauthorized", 401)
-        message_id = chat_api.send_message(room_id, sender_id, message)
-        logger.info("Got message from: %s to room: %s" % (sender_id, room_id))
-        return jsonify(message_id), 200
+        message_id = chat_api.send_message(
+            room_id,
+            sender_id,
+            message,
+            idempotency_key=idempotency_key,
+            client_ip=client_ip(),
+        )
+        logger.info("Got message from: %s to room: %s", sender_id, room_id)
+        return jsonify({"id": message_id}), 200
+    except RateLimitedError as e:
+        logger.warning("Rate limited message from %s: %s", sender_id, e)
+        return (
+            jsonify({"error": str(e), "retry_after": e.retry_after}),
+            429,
+            {"Retry-After": str(math.ceil(e.retry_after))},
+        )
     except ChatAPIError as e:
-        logger.error("Error adding message to room: %s" % e)
+        logger.error("Error adding message to room: %s", e)
         return jsonify({"error": "Error sending message"}), e.get_status_code()
 
 
 @bp.route("/rooms/<room_id>/messages", methods=["GET"])
 def get_messages(room_id):
-    """Get all messages from a chat room.
+    """Get a page of messages from a chat room.
 
     Args:
         room_id: str
 
     Query Parameters:
-        timestamp: float
+        before: cursor, return messages older than this cursor
+        after: cursor, return messages newer than this cursor
+        timestamp: cursor, alias for ``after``
+        limit: int, page size (default 50, at most 200)
+
+    A cursor is the ``next_cursor`` of a previous page or a message
+    timestamp, which skips every message sent at that time. With the
+    stream storage backend a message id is a cursor too.
 
     Returns:
-        A JSON object containing the messages and a status code.
+        A JSON object containing the messages, the cursor for the next page
+        and a status code. The stored messages are streamed as they are,
+        unless the page is compressed. The weak ETag is a hash of the page:
+        a client sending it back in If-None-Match gets a 304 until the page
+        changes, without the page being sent again.
 
     """
+    before = request.args.get("before")
+    after = request.args.get("after", request.args.get("timestamp"))
     try:
-        messages = chat_api.get_messages(room_id)
-        logger.info("Got %d messages from room: %s" % (len(messages), room_id))
-        return jsonify(messages), 200
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError("limit out of range")
+    except ValueError as e:
+        logger.error("Invalid history query: %s", e)
+        return jsonify({"error": "Invalid query parameters"}), 400
+
+    try:
+        page = chat_api.get_messages_page_raw(room_id, before, after, limit)
+        logger.info("Got %d messages from room: %s", len(page["messages"]), room_id)
     except ChatAPIError as e:
-        logger.error("Error getting messages from room: %s" % e)
+        logger.error("Error getting messages from room: %s", e)
         return (
             jsonify({"error": "Error getting messages from room"}),
             e.get_status_code(),
         )
+    etag = page_etag(page)
+    response = _not_modified(etag)
+    if response is not None:
+        return response
+    coding = _coding()
+    if coding is None:
+        response = Response(_stream_page(page), 200, content_type="application/json")
+        return _validated(response, etag)
+    # Busy rooms keep their pages compressed for a while, under the hash of
+    # their content.
+    key = ("messages", etag)
+    compressed = chat_api.cache.compressed.get(key + (coding,))
+    if compressed is not MISSING:
+        return _compressed_response(compressed, coding, etag)
+    return _json_response(b"".join(_stream_page(page)), etag, key)
+
+
+def _coding():
+    """Return the coding to compress the response with, or None."""
+    if not compress_responses:
+        return None
+    return negotiate(request.headers.get("Accept-Encoding"))
+
+
+def _validated(response, etag):
+    """Add the weak ``etag`` and the caching headers to a response."""
+    response.set_etag(etag, weak=True)
+    # Cached copies must be revalidated, which costs a 304 if unchanged.
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def _not_modified(etag):
+    """Return a 304 response if the client has the ``etag`` version."""
+    if request.if_none_match.contains_weak(etag):
+        return _validated(Response(status=304), etag)
+    return None
+
+
+def _json_response(body, etag, key):
+    """Return a response sending the JSON ``body``.
+
+    Bodies of at least ``compress_min_bytes`` are compressed for the clients
+    accepting it, and kept compressed under ``key`` and the coding. The key
+    must change with the body.
+    """
+    coding = _coding()
+    if coding is None or len(body) < compress_min_bytes:
+        return _validated(Response(body, 200, content_type="application/json"), etag)
+    compressed = chat_api.cache.compressed.get(key + (coding,))
+    if compressed is MISSING:
+        compressed = compress(body, coding)
+        chat_api.cache.compressed.set(key + (coding,), compressed)
+    return _compressed_response(compressed, coding, etag)
+
+
+def _compressed_response(compressed, coding, etag):
+    response = Response(compressed, 200, content_type="application/json")
+    response.headers["Content-Encoding"] = coding
+    return _validated(response, etag)
+
+
+def _stream_page(page):
+    """Yield a page of JSON encoded messages as a JSON object, in chunks.
+
+    The stored messages are copied into the response as they are, without
+    being decoded and encoded again.
+    """
+    messages = page["messages"]
+    yield b'{"messages": ['
+    for start in range(0, len(messages), STREAM_CHUNK):
+        chunk = b", ".join(messages[start:start + STREAM_CHUNK])
+        yield chunk if start == 0 else b", " + chunk
+    yield b'], "next_cursor": %s}' % json.dumps(page["next_cursor"]).encode("utf-8")
+
+
+@bp.route("/rooms/<room_id>/search", methods=["GET"])
+def search_messages(room_id):
+    """Search the messages of a chat room.
+
+    Args:
+        room_id: str
+
+    Query Parameters:
+        q: str, words that the messages must all contain
+        sender: str, only return the messages of this sender
+        since: cursor, only return messages newer than this cursor
+        until: cursor, only return messages older than this cursor
+        limit: int, page size (default 50, at most 200)
+
+    Returns:
+        A JSON object containing the matching messages, newest first, the
+        ``until`` cursor of the next page and a status code.
+
+    """
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError("limit out of range")
+    except ValueError as e:
+        logger.error("Invalid search query: %s", e)
+        return jsonify({"error": "Invalid query parameters"}), 400
+
+    try:
+        page = chat_api.search_messages(
+            room_id,
+            request.args.get("q", ""),
+            sender=request.args.get("sender"),
+            since=request.args.get("since"),
+            until=request.args.get("until"),
+            limit=limit,
+        )
+        logger.info("Found %d messages in room: %s", len(page["messages"]), room_id)
+        return jsonify(page), 200
+    except ChatAPIError as e:
+        logger.error("Error searching messages in room: %s", e)
+        return jsonify({"error": str(e)}), e.get_status_code()
 
 
 def init_rooms():
-    """Initialize chat rooms."""
-    try:
-        rooms = [
-            ChatRoom(id=1, topic="cats"),
-            ChatRoom(id=2, topic="dogs"),
-            ChatRoom(id=3, topic="birds"),
-        ]
-        for room in rooms:
-            redis.sadd("rooms", json.dumps(room.dict()))
-            redis.sadd("rooms_ids", room.id)
+    """Register the default chat rooms, unless they already are."""
+    try:
+        if chat_api.rooms.ensure(DEFAULT_ROOMS):
+            chat_api.invalidate_rooms()
         logger.info("Initialized chat rooms")
-    except (ValidationError, json.JSONDecodeError) as e:
-        logger.error("Error initializing chat rooms: %s" % e)
+    except RedisError as e:
+        logger.error("Error initializing chat rooms: %s", e)
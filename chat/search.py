@@ -0,0 +1,231 @@
+import json
+import math
+import re
+import threading
+import uuid
+
+WORD_RE = re.compile(r"\w+")
+
+# Terms shorter than this are not indexed, longer ones are truncated.
+MIN_TERM_LEN = 2
+MAX_TERM_LEN = 32
+
+# A query matches the messages holding all of at most this many terms.
+MAX_QUERY_TERMS = 8
+
+# Seconds a temporary intersection is kept if the query fails half-way.
+TMP_TTL = 10
+
+# A worker prunes the index of a capped room at most once per this many
+# seconds, and drops at most this many messages per command.
+PRUNE_INTERVAL = 60
+PRUNE_BATCH = 1000
+
+
+def tokenize(text):
+    """Return the distinct search terms of ``text``."""
+    terms = []
+    for word in WORD_RE.findall(text.lower()):
+        word = word[:MAX_TERM_LEN]
+        if len(word) >= MIN_TERM_LEN and word not in terms:
+            terms.append(word)
+    return terms
+
+
+def _decode(member):
+    return member.decode("utf-8") if isinstance(member, bytes) else member
+
+
+def _sender_term(sender_id):
+    # "@" is not a word character, so this never collides with a word.
+    return "@" + sender_id.lower()
+
+
+class SearchIndex:
+    """Inverted index of the messages of each room, kept in Redis.
+
+    Every term of a room has a ``room:<id>:search:<term>`` sorted set of the
+    ids of the messages holding it, scored by timestamp, and the indexed
+    messages are kept in the ``room:<id>:search:docs`` hash, and their ids in
+    the ``room:<id>:search:ids`` sorted set by timestamp, for prune() to find
+    the oldest ones. The sender of a message is indexed as an extra term so
+    that it filters like one. A query intersects the sets of its terms, so
+    its cost grows with the number of messages holding its rarest term
+    rather than with the room size.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._pruned = {}
+        self._lock = threading.Lock()
+
+    def key(self, room_id, term):
+        return "room:%s:search:%s" % (room_id, term)
+
+    def docs_key(self, room_id):
+        return "room:%s:search:docs" % room_id
+
+    def ids_key(self, room_id):
+        return "room:%s:search:ids" % room_id
+
+    def _terms(self, message):
+        return tokenize(message["message"]) + [_sender_term(message["sender_id"])]
+
+    def add(self, room_id, messages):
+        """Index stored messages, given as dicts with their ids.
+
+        Messages stored without an id are skipped, see chat.migrate ids.
+        """
+        messages = [m for m in messages if m.get("id") is not None]
+        if not messages:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        self.queue_add(pipe, room_id, messages)
+        pipe.execute()
+
+    def queue_add(self, pipe, room_id, messages):
+        """Queue the commands of add() on ``pipe``."""
+        pipe.hset(
+            self.docs_key(room_id),
+            mapping={str(m["id"]): json.dumps(m) for m in messages},
+        )
+        pipe.zadd(
+            self.ids_key(room_id), {str(m["id"]): m["timestamp"] for m in messages}
+        )
+        for message in messages:
+            for term in self._terms(message):
+                pipe.zadd(
+                    self.key(room_id, term), {str(message["id"]): message["timestamp"]}
+                )
+
+    def remove(self, room_id, messages):
+        """Drop messages from the index."""
+        messages = [m for m in messages if m.get("id") is not None]
+        if not messages:
+            return
+        ids = [str(m["id"]) for m in messages]
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hdel(self.docs_key(room_id), *ids)
+        pipe.zrem(self.ids_key(room_id), *ids)
+        for message in messages:
+            for term in self._terms(message):
+                pipe.zrem(self.key(room_id, term), str(message["id"]))
+        pipe.execute()
+
+    def prune_due(self, room_id, now):
+        """Return whether this worker should prune the index of a room now."""
+        with self._lock:
+            if now - self._pruned.get(room_id, 0) < PRUNE_INTERVAL:
+                return False
+            self._pruned[room_id] = now
+            return True
+
+    def prune(self, room_id, before):
+        """Drop the messages sent before the timestamp ``before``.
+
+        Used for the rooms whose store drops old messages by itself, e.g.
+        capped streams, and returns the number of messages dropped.
+        """
+        pruned = 0
+        while True:
+            ids = self.redis.zrangebyscore(
+                self.ids_key(room_id), "-inf", "(%r" % before, start=0, num=PRUNE_BATCH
+            )
+            if not ids:
+                return pruned
+            docs = self.redis.hmget(self.docs_key(room_id), ids)
+            # Ids without a doc left only need their own entry removed.
+            self.redis.zrem(self.ids_key(room_id), *ids)
+            self.remove(room_id, [json.loads(doc) for doc in docs if doc])
+            pruned += len(ids)
+            if len(ids) < PRUNE_BATCH:
+                return pruned
+
+    @staticmethod
+    def parse_cursor(value):
+        """Return the ``until`` value of a cursor, or raise ValueError.
+
+        Cursors are returned as ``(timestamp, id)``, bare timestamps as
+        floats.
+        """
+        message_id = None
+        if isinstance(value, str) and ":" in value:
+            value, message_id = value.split(":", 1)
+            if not message_id:
+                raise ValueError("Cursor id must not be empty")
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError("Cursor must be finite")
+        return value if message_id is None else (value, message_id)
+
+    def search(self, room_id, query, sender=None, since=None, until=None, limit=20):
+        """Return the newest messages holding every term of ``query``.
+
+        Matches sent at the same time are ordered by id, like the index
+        orders them, so that pages never skip one of them.
+
+        Args:
+            room_id: str
+            query: str
+            sender: str, optional. Only return the messages of this sender.
+            since: float, optional. Only return messages sent after it.
+            until: float or tuple, optional. Only return messages sent
+                before it, or before the ``(timestamp, id)`` of a cursor.
+            limit: int
+
+        Returns:
+            A tuple of the messages, newest first, and the ``"timestamp:id"``
+            cursor of the next page, or None if there are no more messages.
+
+        Raises:
+            ValueError: The query has no searchable term.
+
+        """
+        terms = tokenize(query)[:MAX_QUERY_TERMS]
+        if sender:
+            terms.append(_sender_term(sender))
+        if not terms:
+            raise ValueError("Empty search query")
+        until_id = None
+        if isinstance(until, tuple):
+            until, until_id = until
+        high = "(%r" % until if until is not None else "+inf"
+        low = "(%r" % since if since is not None else "-inf"
+        # The matches sent at the time of a cursor, which may not all be
+        # on the previous page.
+        ties = until_id is not None and (since is None or until > since)
+
+        pipe = self.redis.pipeline(transaction=False)
+        if len(terms) == 1:
+            key = self.key(room_id, terms[0])
+        else:
+            key = "search:tmp:%s" % uuid.uuid4()
+            pipe.zinterstore(
+                key, [self.key(room_id, term) for term in terms], aggregate="MAX"
+            )
+            pipe.expire(key, TMP_TTL)
+        if ties:
+            pipe.zrevrangebyscore(key, repr(until), repr(until), withscores=True)
+        pipe.zrevrangebyscore(key, high, low, start=0, num=limit, withscores=True)
+        if len(terms) > 1:
+            pipe.delete(key)
+        results = pipe.execute()[2 if len(terms) > 1 else 0 :]
+
+        pairs = []
+        if ties:
+            pairs = [
+                (member, score)
+                for member, score in results.pop(0)
+                if _decode(member) < until_id
+            ]
+        pairs = (pairs + results[0])[:limit]
+        if not pairs:
+            return [], None
+        ids = [member for member, _ in pairs]
+        docs = self.redis.hmget(self.docs_key(room_id), ids)
+        messages = [json.loads(doc) for doc in docs if doc]
+        next_cursor = None
+        if len(pairs) == limit:
+            member, score = pairs[-1]
+            next_cursor = "%r:%s" % (score, _decode(member))
+        return messages, next_cursor
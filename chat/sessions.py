@@ -0,0 +1,69 @@
+import json
+
+# Sessions of a worker that dies without running its disconnect handlers are
+# dropped from Redis after this many seconds.
+SESSION_TTL = 24 * 60 * 60
+
+
+class SessionStore:
+    """Map a WebSocket session ID to the user and room that it joined.
+
+    The mapping lives in Redis rather than in process memory so that any
+    worker or node can look up and clean up a session, and so that the
+    number of sessions in a room is known cluster-wide.
+    """
+
+    def __init__(self, redis, ttl=SESSION_TTL):
+        self.redis = redis
+        self.ttl = ttl
+
+    def set(self, sid, username, room):
+        """Record that session ``sid`` joined ``room`` as ``username``."""
+        previous = self.get(sid)
+        pipe = self.redis.pipeline()
+        if previous is not None:
+            pipe.srem("room:%s:sessions" % previous["room"], sid)
+        pipe.set(
+            "session:%s" % sid,
+            json.dumps({"username": username, "room": room}),
+            ex=self.ttl,
+        )
+        pipe.sadd("room:%s:sessions" % room, sid)
+        pipe.expire("room:%s:sessions" % room, self.ttl)
+        pipe.execute()
+
+    def get(self, sid):
+        """Return the user and room of session ``sid``, or None."""
+        info = self.redis.get("session:%s" % sid)
+        return json.loads(info) if info else None
+
+    def pop(self, sid, default=None):
+        """Forget session ``sid`` and return what it was mapped to."""
+        pipe = self.redis.pipeline()
+        pipe.get("session:%s" % sid)
+        pipe.delete("session:%s" % sid)
+        info, _ = pipe.execute()
+        if not info:
+            return default
+        info = json.loads(info)
+        self.redis.srem("room:%s:sessions" % info["room"], sid)
+        return info
+
+    def count(self, room):
+        """Return the number of sessions currently joined to ``room``."""
+        return self.redis.scard("room:%s:sessions" % room)
+
+    def counts(self, rooms=None):
+        """Return the number of sessions of each room, by room id.
+
+        The rooms (default: every room) are counted in one pipelined round
+        trip, whatever their number.
+        """
+        if rooms is None:
+            rooms = sorted(
+                room.decode("utf-8") for room in self.redis.smembers("rooms_ids")
+            )
+        pipe = self.redis.pipeline(transaction=False)
+        for room in rooms:
+            pipe.scard("room:%s:sessions" % room)
+        return dict(zip(rooms, pipe.execute()))
@@ -1,17 +1,125 @@
-from flask_socketio import emit, join_room, leave_room, send
-from flask import request
+import os
+import threading
 
-from .routes import chat_api
+from flask_socketio import emit, join_room, leave_room
+from flask import current_app, request
+
+from .routes import chat_api, client_ip, presence, redis
+from .sessions import SessionStore
+from .batching import MessageBatcher
+from .delivery import StreamTailer
+from .connection import redis_from_env
+from .storage import StreamMessageStore
 from .logger import logger
-from .errors import ChatAPIError
+from .errors import ChatAPIError, RateLimitedError
+from .metrics import BROADCAST_LATENCY
+from .codec import available_encodings
+from .presence import summarize
+from .fanout import FanoutScheduler, send_message
+
+# Number of messages sent to a client when it joins a room.
+JOIN_BACKFILL = 50
+
+# Opt-in write batching: messages are stored together with one pipelined
+# write per CHAT_WRITE_BATCH_MS window, or as soon as CHAT_WRITE_BATCH_SIZE
+# messages are waiting.
+batcher = None
+if int(os.environ.get("CHAT_WRITE_BATCH_MS", 0)) > 0:
+    batcher = MessageBatcher(
+        chat_api,
+        window=int(os.environ["CHAT_WRITE_BATCH_MS"]) / 1000,
+        max_batch=int(os.environ.get("CHAT_WRITE_BATCH_SIZE", 100)),
+    )
+    batcher.start()
+
+# Seconds a socket handler waits for the batching writer to store a message
+# before giving up on acknowledging it.
+ACK_TIMEOUT = 5
+
+# Most messages a client can send with one ``messages`` event.
+MAX_SEND_BATCH = 100
+
+# Map a WebSocket session ID to the user and room that it joined. Kept in
+# Redis so that every worker and node shares it.
+user_sessions = SessionStore(redis)
+
+# Set by start_stream_delivery when new messages reach clients by tailing the
+# room streams instead of being broadcast by the worker that received them.
+stream_tailer = None
+
+# Set by start_fanout when the broadcasts to a room are sent in micro-batches.
+fanout = None
+
+
+def start_fanout(socketio, window, max_pending):
+    """Coalesce the broadcasts to each room into batches (see chat.fanout)."""
+    global fanout
+    fanout = FanoutScheduler(socketio, window=window, max_pending=max_pending)
+    fanout.start()
+
+
+def live(msg):
+    """Return the ``meta`` broadcast with a stored Message, see broadcast."""
+    return {"id": msg.id, "timestamp": msg.timestamp}
+
+
+def broadcast(socketio, room, text, meta=None):
+    """Send ``text`` to every client in ``room``.
 
-# Map a WebSocket session ID to the user and room that it joined.
-user_sessions = {}
+    The ``message`` event of a stored message carries ``meta``, its id and
+    timestamp, as a second argument, so that clients can resume after the
+    last message they got. Notices only have the text.
+    """
+    if fanout is not None:
+        fanout.send(room, text, meta)
+        return
+    with BROADCAST_LATENCY.time():
+        send_message(socketio, room, text, meta)
+
+
+def start_stream_delivery(socketio):
+    """Push new messages to this worker's clients from the room streams."""
+    global stream_tailer
+    if not isinstance(chat_api.store, StreamMessageStore):
+        raise RuntimeError("Stream delivery requires CHAT_STORAGE=stream")
+    # Every worker sends each message to its room: through a message queue,
+    # the clients would get it once per worker.
+    if socketio.server_options.get("message_queue"):
+        raise RuntimeError("Stream delivery cannot use SOCKETIO_MESSAGE_QUEUE")
+
+    def deliver(room_id, message):
+        text = message["sender_id"] + ": " + message["message"]
+        meta = {"id": message["id"], "timestamp": message["timestamp"]}
+        broadcast(socketio, room_id, text, meta)
+
+    # XREAD blocks for longer than the socket timeout of the shared client.
+    reader = redis_from_env(socket_timeout=None, max_connections=1)
+    stream_tailer = StreamTailer(reader, chat_api.store, deliver)
+    stream_tailer.start()
+
+
+def start_presence(socketio):
+    """Announce who joins and leaves each room, a batch at a time."""
+
+    def notify(room_id, joined, left):
+        socketio.emit(
+            "presence", {"room": room_id, "joined": joined, "left": left}, to=room_id
+        )
+        # Busy rooms only get the presence event, not the summaries.
+        for usernames, action in ((joined, "entered"), (left, "left")):
+            if not usernames:
+                continue
+            if fanout is not None:
+                fanout.send_notice(room_id, summarize(usernames, action))
+            else:
+                socketio.send(summarize(usernames, action), to=room_id)
+
+    presence.start(notify)
 
 
 def handle_connect():
-    logger.info("Client connected")
     """Handle a new socket connection."""
+    logger.info("Client connected")
     emit("connected", {"data": "Connected"})
 
 
@@ -19,47 +127,211 @@ def handle_disconnect():
     """Handle a socket disconnection."""
     info = user_sessions.pop(request.sid, None)
     if info:
-        room = info["room"]
-        username = info["username"]
-        leave_room(room)
-        send(username + ' has left the room.', to=room)
+        leave_room(info["room"])
+    presence.leave(request.sid)
     logger.info("Client disconnected")
 
 
 def on_join(data):
-    logger.info(f"Received join request: {data}")
+    logger.debug("Received join request: %s", data)
     username = data['username']
-    room = data['room']
+    room = str(data['room'])
     join_room(room)
     # Track which user/room are associated with this connection
-    user_sessions[request.sid] = {
-        "username": username,
-        "room": room,
-    }
-    send(username + ' has entered the room.', to=room)
+    user_sessions.set(request.sid, username, room)
+    # The join is announced with the others of the same second, and not at
+    # all if the user was still online, e.g. when it reconnects.
+    presence.join(request.sid, room, username)
+    # Send only the latest messages, or the ones the client has not seen yet
+    # if it tells us the last message it received: the cursor of its id and
+    # timestamp, or its timestamp alone.
+    since = data.get("since")
     try:
-        messages = chat_api.get_messages(room)
-        emit("batch", {"data": messages})
-    except ChatAPIError as e:
+        if data.get("last_id") is not None:
+            since = chat_api.store.cursor({"id": data["last_id"], "timestamp": since})
+        payload = _page_payload(data, room, after=since, limit=JOIN_BACKFILL)
+        payload["direction"] = "after" if since is not None else "before"
+        emit("batch", payload)
+    except (ChatAPIError, TypeError, ValueError) as e:
         emit("error", {"data": str(e)})
 
 
+def _page_payload(data, room, **page):
+    """Return a page of history encoded as the client asked.
+
+    A client sending ``"encoding": "msgpack"`` gets the messages as one
+    binary msgpack array of chat.codec.FIELDS arrays, and one sending
+    ``"encoding": "json"`` as the binary JSON array served by the REST API,
+    both built from the stored bytes. Other clients, or clients asking for
+    an encoding the server does not support, get a list of message objects.
+    """
+    encoding = data.get("encoding")
+    if encoding in available_encodings():
+        page = chat_api.get_messages_page_encoded(room, encoding=encoding, **page)
+        return {
+            "data": page["data"],
+            "encoding": encoding,
+            "next_cursor": page["next_cursor"],
+        }
+    page = chat_api.get_messages_page(room, **page)
+    return {"data": page["messages"], "next_cursor": page["next_cursor"]}
+
+
 def on_leave(data):
-    username = data['username']
-    room = data['room']
+    room = str(data['room'])
     leave_room(room)
     # Remove the session mapping if it matches this connection
     user_sessions.pop(request.sid, None)
-    send(username + ' has left the room.', to=room)
+    presence.leave(request.sid)
 
 
 def handle_message(data):
-    logger.info(f"Received message: {data}")
-    room = data["room_id"]
+    """Store and broadcast a message.
+
+    A client that retries a send can pass the same ``idempotency_key``: the
+    retry is not stored nor broadcast again. The stored message id is
+    returned as the Socket.IO acknowledgement. A client sending too many
+    messages gets an ``error`` event with the seconds to wait in
+    ``retry_after``.
+    """
+    logger.debug("Received message: %s", data)
+    room = str(data["room_id"])
     username = data["username"]
     message = data["message"]
+    idempotency_key = data.get("idempotency_key")
+    if batcher is not None:
+        return _submit_message(room, username, message, idempotency_key)
+    # Stored like handle_messages does, to broadcast the timestamp too.
     try:
-        chat_api.send_message(room, username, message)
-        send(username + ": " + message, to=room, broadcast=True)
+        chat_api.check_rate(room, _rate_key(), client_ip())
+        msg = chat_api.new_message(username, message)
     except ChatAPIError as e:
-        emit("error", {"data": str(e)})
+        emit("error", _error_payload(e))
+        return None
+    keys = {room: [idempotency_key]} if idempotency_key is not None else None
+    errors, duplicates = chat_api.store_messages({room: [msg]}, keys)
+    if errors[room] is not None:
+        emit("error", _error_payload(errors[room]))
+        return None
+    if stream_tailer is None and not duplicates:
+        broadcast(
+            current_app.extensions["socketio"],
+            room,
+            username + ": " + message,
+            live(msg),
+        )
+    return {"id": msg.id}
+
+
+def handle_messages(data):
+    """Store and broadcast several messages of one sender to one room.
+
+    ``data["messages"]`` is a list of up to MAX_SEND_BATCH texts, stored in
+    order with one pipelined write. The acknowledgement lists the id of each
+    stored message; when a rate limit stops the batch part way, the messages
+    after it get no id and the client gets an ``error`` event.
+    """
+    logger.debug("Received messages: %s", data)
+    room = str(data["room_id"])
+    username = data["username"]
+    texts = data["messages"]
+    if not isinstance(texts, list) or len(texts) > MAX_SEND_BATCH:
+        emit("error", {"data": "Send at most %d messages at once" % MAX_SEND_BATCH})
+        return None
+    messages = []
+    try:
+        for text in texts:
+            chat_api.check_rate(room, _rate_key(), client_ip())
+            messages.append(chat_api.new_message(username, text))
+    except ChatAPIError as e:
+        emit("error", _error_payload(e))
+    if not messages:
+        return {"ids": [None] * len(texts)}
+    errors, _ = chat_api.store_messages({room: messages})
+    error = errors[room]
+    if error is not None:
+        emit("error", _error_payload(error))
+        return {"ids": [None] * len(texts)}
+    if stream_tailer is None:
+        socketio = current_app.extensions["socketio"]
+        for msg in messages:
+            broadcast(socketio, room, msg.sender_id + ": " + msg.message, live(msg))
+    ids = [msg.id for msg in messages]
+    return {"ids": ids + [None] * (len(texts) - len(ids))}
+
+
+def _rate_key():
+    """Return the rate limit key of the sending connection.
+
+    Socket events carry a username that is not authenticated, so limiting
+    per username would let a sender rotate names, or use up the limit of
+    someone else. The IP of the connection is limited on its own too.
+    """
+    return "sid:%s" % request.sid
+
+
+def _error_payload(error):
+    """Return the ``error`` event of a failed send."""
+    payload = {"data": str(error)}
+    if isinstance(error, RateLimitedError):
+        payload["retry_after"] = error.retry_after
+    return payload
+
+
+def _submit_message(room, username, message, idempotency_key):
+    """Queue a message for the batching writer and broadcast it once stored.
+
+    A retried message already stored with its ``idempotency_key`` is only
+    acknowledged, not broadcast again.
+    """
+    socketio = current_app.extensions["socketio"]
+    sid = request.sid
+    done = threading.Event()
+    ack = {}
+
+    def stored(msg, error, duplicate):
+        if error is not None:
+            socketio.emit("error", {"data": str(error)}, to=sid)
+        else:
+            if stream_tailer is None and not duplicate:
+                broadcast(socketio, room, username + ": " + message, live(msg))
+            ack["id"] = msg.id
+        done.set()
+
+    try:
+        batcher.submit(
+            room,
+            username,
+            message,
+            stored,
+            client_ip=client_ip(),
+            idempotency_key=idempotency_key,
+            rate_key=_rate_key(),
+        )
+    except ChatAPIError as e:
+        emit("error", _error_payload(e))
+        return None
+    done.wait(ACK_TIMEOUT)
+    return ack or None
+
+
+def on_history(data):
+    """Send a page of older (``before``) or newer (``after``) messages.
+
+    A request that fails is answered with an ``error`` in place of the page,
+    so that the client knows which of its requests failed.
+    """
+    room = str(data["room"])
+    direction = "after" if data.get("after") is not None else "before"
+    try:
+        payload = _page_payload(
+            data,
+            room,
+            before=data.get("before"),
+            after=data.get("after"),
+            limit=data.get("limit", JOIN_BACKFILL),
+        )
+    except (ChatAPIError, TypeError, ValueError) as e:
+        payload = {"error": str(e)}
+    payload["direction"] = direction
+    emit("history", payload)
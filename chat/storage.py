@@ -0,0 +1,695 @@
+import math
+import re
+from collections import Counter
+
+try:
+    from redis import RedisError
+except Exception:  # pragma: no cover - redis might not be installed
+    class RedisError(Exception):
+        pass
+
+from .codec import decode, get_model_encoder, split_id, with_id
+from .models import set_id
+
+# Stream entry ids look like "<milliseconds>-<sequence>".
+STREAM_ID_RE = re.compile(r"^\d+-\d+$")
+
+# Seconds during which a retried send with the same idempotency key is
+# recognised.
+IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# Stores messages in the sorted set of a room with the next ids of its
+# counter, atomically: the counter never holds the id of a message that is
+# not stored yet. A message whose idempotency key was already used is not
+# stored again.
+# KEYS: the id counter, the sorted set, then the idempotency key of each
+# message having one.
+# ARGV: the seconds idempotency keys are kept, then five values per message:
+# its score, its encoding before and after the id (see codec.split_id), "1"
+# if the id is packed with msgpack and "1" if the message has a key.
+# Returns the id of each message followed by 1 if it was stored, or by 0 if
+# its key had been used.
+ZSET_APPEND_SCRIPT = """
+local function pack_id(id)
+    if id < 128 then
+        return string.char(id)
+    end
+    local size, tag = 8, 0xcf
+    if id < 0x100 then
+        size, tag = 1, 0xcc
+    elseif id < 0x10000 then
+        size, tag = 2, 0xcd
+    elseif id < 0x100000000 then
+        size, tag = 4, 0xce
+    end
+    local packed = ""
+    for _ = 1, size do
+        packed = string.char(id % 256) .. packed
+        id = math.floor(id / 256)
+    end
+    return string.char(tag) .. packed
+end
+
+local replies = {}
+local next_key = 3
+for i = 2, #ARGV, 5 do
+    local key = nil
+    if ARGV[i + 4] == "1" then
+        key = KEYS[next_key]
+        next_key = next_key + 1
+    end
+    local existing = key and redis.call("GET", key)
+    if existing and existing ~= "" then
+        table.insert(replies, existing)
+        table.insert(replies, 0)
+    else
+        local id = redis.call("INCR", KEYS[1])
+        local encoded_id = tostring(id)
+        if ARGV[i + 3] == "1" then
+            encoded_id = pack_id(id)
+        end
+        local member = ARGV[i + 1] .. encoded_id .. ARGV[i + 2]
+        redis.call("ZADD", KEYS[2], "NX", ARGV[i], member)
+        if key then
+            redis.call("SET", key, id, "EX", ARGV[1])
+        end
+        table.insert(replies, id)
+        table.insert(replies, 1)
+    end
+end
+return replies
+"""
+
+# Adds messages to the stream of a room, skipping the ones whose idempotency
+# key was already used.
+# KEYS: the stream, then the idempotency key of each message having one.
+# ARGV: the seconds idempotency keys are kept, the approximate maximum length
+# of the stream ("" for none), then two values per message: its encoding and
+# "1" if it has a key.
+# Returns the id of each message followed by 1 if it was stored, or by 0 if
+# its key had been used.
+STREAM_APPEND_SCRIPT = """
+local replies = {}
+local next_key = 2
+for i = 3, #ARGV, 2 do
+    local key = nil
+    if ARGV[i + 1] == "1" then
+        key = KEYS[next_key]
+        next_key = next_key + 1
+    end
+    local existing = key and redis.call("GET", key)
+    if existing and existing ~= "" then
+        table.insert(replies, existing)
+        table.insert(replies, 0)
+    else
+        local id
+        if ARGV[2] == "" then
+            id = redis.call("XADD", KEYS[1], "*", "data", ARGV[i])
+        else
+            id = redis.call(
+                "XADD", KEYS[1], "MAXLEN", "~", ARGV[2], "*", "data", ARGV[i]
+            )
+        end
+        if key then
+            redis.call("SET", key, id, "EX", ARGV[1])
+        end
+        table.insert(replies, id)
+        table.insert(replies, 1)
+    end
+end
+return replies
+"""
+
+
+def idempotency_redis_key(room_id, sender_id, key):
+    """Return the Redis key recording a send made with idempotency ``key``."""
+    return "room:%s:idempotency:%s:%s" % (room_id, sender_id, key)
+
+
+# Message timestamps come from the web workers while stream entry ids come
+# from the Redis clock. Timestamp cursors are widened by this many
+# milliseconds on the stream and the edge is then filtered on the message
+# timestamps, so clock skew below it does not lose messages.
+STREAM_CLOCK_SKEW_MS = 1000
+
+
+def _parse_timestamp(value):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("Cursor must be finite")
+    return value
+
+
+def run_steps(redis, steps):
+    """Run a generator of pipelined commands, like page_steps(), on ``redis``.
+
+    Returns:
+        The value returned by the generator.
+
+    """
+    try:
+        commands = next(steps)
+        while True:
+            pipe = redis.pipeline(transaction=False)
+            for command, args, kwargs in commands:
+                getattr(pipe, command)(*args, **kwargs)
+            commands = steps.send(pipe.execute())
+    except StopIteration as e:
+        return e.value
+
+
+def _message_id(message):
+    """Return the id of a stored message, 0 for messages stored without one.
+
+    Messages stored before ids existed sort first among those sharing their
+    timestamp (see chat.migrate ids).
+    """
+    return message.get("id") or 0
+
+
+def _sort_pairs(pairs, reverse=False):
+    """Sort ``(member, score)`` pairs of a sorted set by score, then by id.
+
+    Only the members sharing their score with another one are decoded.
+    """
+    scores = Counter(score for _, score in pairs)
+
+    def position(pair):
+        member, score = pair
+        return score, _message_id(decode(member)) if scores[score] > 1 else 0
+
+    return sorted(pairs, key=position, reverse=reverse)
+
+
+def _set_ids(store, messages, reply):
+    """Set the ids of messages from the reply of an append script.
+
+    Returns:
+        The indexes of the messages not stored because their idempotency
+        key had been used.
+
+    """
+    duplicates = []
+    for index, msg in enumerate(messages):
+        set_id(msg, store.decode_id(reply[2 * index]))
+        if not reply[2 * index + 1]:
+            duplicates.append(index)
+    return duplicates
+
+
+def _append_many(store, batch, idempotency_keys):
+    """Run the append script of ``store`` once per room of ``batch``."""
+    idempotency_keys = idempotency_keys or {}
+    rooms = list(batch)
+    calls = [
+        store.append_args(room_id, batch[room_id], idempotency_keys.get(room_id))
+        for room_id in rooms
+    ]
+    if len(calls) == 1:
+        # A pipeline would first check that the script is loaded.
+        keys, args = calls[0]
+        try:
+            replies = [store.script(keys=keys, args=args)]
+        except RedisError as e:
+            replies = [e]
+    else:
+        pipe = store.redis.pipeline(transaction=False)
+        for keys, args in calls:
+            store.script(keys=keys, args=args, client=pipe)
+        replies = pipe.execute(raise_on_error=False)
+
+    errors = {}
+    duplicates = set()
+    for room_id, reply in zip(rooms, replies):
+        if isinstance(reply, Exception):
+            errors[room_id] = reply
+            continue
+        errors[room_id] = None
+        for index in _set_ids(store, batch[room_id], reply):
+            duplicates.add((room_id, index))
+    return errors, duplicates
+
+
+class ZSetMessageStore:
+    """Messages of a room in the ``room:<id>`` sorted set, scored by timestamp.
+
+    Message ids come from a per-room counter, incremented by the script
+    storing the messages. Messages are ordered by timestamp, then by id, and
+    cursors are ``"<timestamp>:<id>"`` positions in that order, so that
+    messages sharing a timestamp are neither skipped nor repeated across
+    pages. A bare timestamp is accepted as a cursor too, excluding every
+    message of that timestamp. Messages stored before ids existed count as
+    id 0: only those sharing their timestamp with another one can be
+    skipped. New messages are stored with ``encoding`` (see chat.codec).
+    Pages are read from ``replica`` when one is given.
+    """
+
+    # Sorted sets are never trimmed on append, unlike capped streams.
+    maxlen = None
+
+    def __init__(self, redis, encoding="json", replica=None):
+        self.redis = redis
+        self.replica = replica if replica is not None else redis
+        self.encode = get_model_encoder(encoding)
+        self.script = None
+        if redis is not None:
+            self.script = redis.register_script(ZSET_APPEND_SCRIPT)
+
+    def key(self, room_id):
+        return "room:%s" % room_id
+
+    def parse_cursor(self, value):
+        """Return a cursor usable by page(), or raise ValueError.
+
+        Cursors are returned as ``(timestamp, id)``, with an id of None for
+        bare timestamps.
+        """
+        if isinstance(value, str) and ":" in value:
+            timestamp, message_id = value.split(":", 1)
+            message_id = int(message_id)
+            if message_id < 0:
+                raise ValueError("Cursor id must not be negative")
+            return _parse_timestamp(timestamp), message_id
+        return _parse_timestamp(value), None
+
+    def decode_id(self, value):
+        return int(value)
+
+    def position(self, message):
+        """Return a key ordering ``message`` like the store does."""
+        return message["timestamp"], _message_id(message)
+
+    def cursor_position(self, cursor):
+        """Return the position() matching an ``after`` cursor, or None."""
+        timestamp, message_id = self.parse_cursor(cursor)
+        return timestamp, math.inf if message_id is None else message_id
+
+    def cursor(self, message):
+        """Return the cursor pointing at ``message``."""
+        return "%r:%d" % (message["timestamp"], _message_id(message))
+
+    def append(self, room_id, msg, idempotency_key=None):
+        """Store ``msg`` in ``room_id``, set its id and return it.
+
+        A message whose ``idempotency_key`` was already used is not stored
+        again, and gets the id of the message stored with it.
+        """
+        keys, args = self.append_args(room_id, [msg], [idempotency_key])
+        self.set_ids([msg], self.script(keys=keys, args=args))
+        return msg.id
+
+    def append_args(self, room_id, messages, idempotency_keys=None):
+        """Return the keys and arguments of the script storing ``messages``.
+
+        ``idempotency_keys`` lists the key of each message, or None.
+        """
+        keys = ["room:%s:last_id" % room_id, self.key(room_id)]
+        args = [IDEMPOTENCY_TTL]
+        for msg, key in zip(messages, idempotency_keys or [None] * len(messages)):
+            head, tail, packed = split_id(self.encode(msg))
+            args += [repr(msg.timestamp), head, tail, int(packed), int(bool(key))]
+            if key:
+                keys.append(idempotency_redis_key(room_id, msg.sender_id, key))
+        return keys, args
+
+    def set_ids(self, messages, reply):
+        """Set the ids of ``messages`` from the reply of the append script.
+
+        Returns:
+            The indexes of the messages that were not stored again.
+
+        """
+        return _set_ids(self, messages, reply)
+
+    def append_many(self, batch, idempotency_keys=None):
+        """Store the messages of several rooms in one pipelined round trip.
+
+        Each room gets one call of ZSET_APPEND_SCRIPT, which reserves the
+        ids of its messages and stores them at once.
+
+        Args:
+            batch: dict mapping a room id to a list of Messages in the order
+                they were sent. Their ids are set once they are stored.
+            idempotency_keys: optional dict mapping a room id to the
+                idempotency key of each of its messages, or None.
+
+        Returns:
+            A dict mapping each room id to None if its messages were stored,
+            or to the exception that prevented it, and the set of the
+            ``(room_id, index)`` of the messages not stored again because
+            their idempotency key was already used. Those get the id of the
+            message stored with the key.
+
+        """
+        return _append_many(self, batch, idempotency_keys)
+
+    def all(self, room_id):
+        """Return every message of a room, oldest first."""
+        members = self.redis.zrange(self.key(room_id), 0, -1)
+        return [decode(member) for member in members]
+
+    def count(self, room_id):
+        """Return the number of messages of a room."""
+        return self.redis.zcard(self.key(room_id))
+
+    def oldest(self, room_id, limit):
+        """Return up to ``limit`` ``(handle, message)`` pairs, oldest first.
+
+        The handles identify the messages to remove().
+        """
+        members = self.redis.zrange(self.key(room_id), 0, limit - 1)
+        return [(member, decode(member)) for member in members]
+
+    def remove(self, room_id, handles):
+        """Remove the messages returned by oldest()."""
+        if handles:
+            self.redis.zrem(self.key(room_id), *handles)
+
+    def page(self, room_id, before=None, after=None, limit=50):
+        """Return up to ``limit`` messages between two exclusive cursors.
+
+        With ``after`` the oldest matching messages are returned, otherwise
+        the newest ones. Messages are always in chronological order.
+
+        Returns:
+            A tuple of the messages and the cursor continuing in the same
+            direction, or None if there are no more messages.
+
+        """
+        raws, next_cursor = self.page_raw(room_id, before, after, limit)
+        return [decode(raw) for raw in raws], next_cursor
+
+    def page_raw(self, room_id, before=None, after=None, limit=50, primary=False):
+        """Like page(), with the messages as stored instead of decoded.
+
+        With ``primary`` the page is read from the primary even if there is
+        a replica, so that it holds every message stored so far.
+        """
+        redis = self.redis if primary else self.replica
+        return run_steps(redis, self.page_steps(room_id, before, after, limit))
+
+    def page_steps(self, room_id, before=None, after=None, limit=50):
+        """Read a page like page_raw(), as a generator of pipelined commands.
+
+        It yields lists of ``(command, args, kwargs)`` to run in one pipeline,
+        is sent their replies and returns the page, so that chat.aio reads
+        pages the same way on an asyncio client (see run_steps()).
+
+        The page is read with one round trip, along with the messages sharing
+        the timestamp of a ``"<timestamp>:<id>"`` cursor. A second one is
+        only needed when the page ends among messages sharing a timestamp
+        that were not all read.
+        """
+        key = self.key(room_id)
+        newer = after is not None
+        low = high = None
+        if after is not None:
+            timestamp, message_id = self.parse_cursor(after)
+            low = timestamp, math.inf if message_id is None else message_id
+        if before is not None:
+            timestamp, message_id = self.parse_cursor(before)
+            high = timestamp, -math.inf if message_id is None else message_id
+
+        # The messages at the timestamp of an exact cursor are read whole and
+        # filtered by id, the range itself excludes that timestamp.
+        ties = sorted(
+            {
+                bound[0]
+                for bound in (low, high)
+                if bound is not None and math.isfinite(bound[1])
+            }
+        )
+        commands = [
+            ("zrangebyscore", (key, score, score), {"withscores": True})
+            for score in ties
+        ]
+        min_score = "(%r" % low[0] if low is not None else "-inf"
+        max_score = "(%r" % high[0] if high is not None else "+inf"
+        page_args = {"start": 0, "num": limit + 1, "withscores": True}
+        if newer:
+            commands.append(("zrangebyscore", (key, min_score, max_score), page_args))
+        else:
+            commands.append(
+                ("zrevrangebyscore", (key, max_score, min_score), page_args)
+            )
+        replies = yield commands
+
+        pairs = []
+        for members in replies[:-1]:
+            for member, score in members:
+                position = score, _message_id(decode(member))
+                if low is not None and position <= low:
+                    continue
+                if high is None or position < high:
+                    pairs.append((member, score))
+        ranged = replies[-1]
+        pairs = _sort_pairs(pairs + ranged, reverse=not newer)
+        if len(ranged) > limit and pairs[limit - 1][1] == ranged[-1][1]:
+            # The page ends among messages sharing a timestamp, of which the
+            # range may only hold those sorting first as bytes.
+            score = ranged[-1][1]
+            (members,) = yield [
+                ("zrangebyscore", (key, score, score), {"withscores": True})
+            ]
+            pairs = _sort_pairs(
+                [pair for pair in pairs if pair[1] != score] + members,
+                reverse=not newer,
+            )
+
+        selected = pairs[:limit]
+        next_cursor = None
+        if len(pairs) > limit:
+            next_cursor = self.cursor(decode(selected[-1][0]))
+        members = [member for member, _ in selected]
+        if not newer:
+            members.reverse()
+        return members, next_cursor
+
+
+class StreamMessageStore:
+    """Messages of a room in the ``room:<id>:stream`` Redis Stream.
+
+    Message ids are the stream entry ids, which increase monotonically and
+    can be used as exact cursors to resume from. Timestamps are accepted as
+    cursors too. With ``maxlen`` the stream is trimmed (approximately) to
+    that many messages on every append. New messages are stored with
+    ``encoding`` (see chat.codec), without their id. Pages are read from
+    ``replica`` when one is given.
+    """
+
+    def __init__(self, redis, maxlen=None, encoding="json", replica=None):
+        self.redis = redis
+        self.replica = replica if replica is not None else redis
+        self.maxlen = maxlen
+        self.encode = get_model_encoder(encoding)
+        self.script = None
+        if redis is not None:
+            self.script = redis.register_script(STREAM_APPEND_SCRIPT)
+
+    def key(self, room_id):
+        return "room:%s:stream" % room_id
+
+    def parse_cursor(self, value):
+        """Return a cursor usable by page(), or raise ValueError.
+
+        Stream ids are returned as strings and timestamps as floats.
+        """
+        if isinstance(value, str) and STREAM_ID_RE.match(value):
+            return value
+        return _parse_timestamp(value)
+
+    def decode_id(self, value):
+        return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+    def position(self, message):
+        """Return a key ordering ``message`` like the store does."""
+        return tuple(int(part) for part in message["id"].split("-"))
+
+    def cursor_position(self, cursor):
+        """Return the position() matching a cursor, or None.
+
+        Timestamp cursors have none, messages are stored in id order.
+        """
+        cursor = self.parse_cursor(cursor)
+        if isinstance(cursor, str):
+            return tuple(int(part) for part in cursor.split("-"))
+        return None
+
+    def cursor(self, message):
+        """Return the cursor pointing at ``message``."""
+        return message["id"]
+
+    def _fields(self, msg):
+        return {"data": self.encode(msg, exclude={"id"})}
+
+    def decode_entry(self, entry_id, fields):
+        message = decode(fields[b"data"])
+        message["id"] = self.decode_id(entry_id)
+        return message
+
+    def raw_entry(self, entry_id, fields):
+        """Return an entry as an encoded message holding its id."""
+        return with_id(fields[b"data"], self.decode_id(entry_id))
+
+    def append(self, room_id, msg, idempotency_key=None):
+        """Store ``msg`` in ``room_id``, set its id and return it.
+
+        A message whose ``idempotency_key`` was already used is not stored
+        again, and gets the id of the message stored with it.
+        """
+        keys, args = self.append_args(room_id, [msg], [idempotency_key])
+        self.set_ids([msg], self.script(keys=keys, args=args))
+        return msg.id
+
+    def append_args(self, room_id, messages, idempotency_keys=None):
+        """Return the keys and arguments of the script storing ``messages``.
+
+        ``idempotency_keys`` lists the key of each message, or None.
+        """
+        keys = [self.key(room_id)]
+        args = [IDEMPOTENCY_TTL, self.maxlen or ""]
+        for msg, key in zip(messages, idempotency_keys or [None] * len(messages)):
+            args += [self._fields(msg)["data"], int(bool(key))]
+            if key:
+                keys.append(idempotency_redis_key(room_id, msg.sender_id, key))
+        return keys, args
+
+    def set_ids(self, messages, reply):
+        """Set the ids of ``messages`` from the reply of the append script.
+
+        Returns:
+            The indexes of the messages that were not stored again.
+
+        """
+        return _set_ids(self, messages, reply)
+
+    def append_many(self, batch, idempotency_keys=None):
+        """Store the messages of several rooms in one pipelined round trip.
+
+        Each room gets one call of STREAM_APPEND_SCRIPT.
+
+        Args:
+            batch: dict mapping a room id to a list of Messages in the order
+                they were sent. Their ids are set once they are stored.
+            idempotency_keys: optional dict mapping a room id to the
+                idempotency key of each of its messages, or None.
+
+        Returns:
+            Like ZSetMessageStore.append_many.
+
+        """
+        return _append_many(self, batch, idempotency_keys)
+
+    def all(self, room_id):
+        """Return every message of a room, oldest first."""
+        return [
+            self.decode_entry(entry_id, fields)
+            for entry_id, fields in self.redis.xrange(self.key(room_id))
+        ]
+
+    def count(self, room_id):
+        """Return the number of messages of a room."""
+        return self.redis.xlen(self.key(room_id))
+
+    def oldest(self, room_id, limit):
+        """Return up to ``limit`` ``(handle, message)`` pairs, oldest first.
+
+        The handles identify the messages to remove().
+        """
+        return [
+            (entry_id, self.decode_entry(entry_id, fields))
+            for entry_id, fields in self.redis.xrange(self.key(room_id), count=limit)
+        ]
+
+    def remove(self, room_id, handles):
+        """Remove the messages returned by oldest()."""
+        if handles:
+            self.redis.xdel(self.key(room_id), *handles)
+
+    def last_id(self, room_id):
+        """Return the id of the newest message of a room, or "0-0"."""
+        entries = self.redis.xrevrange(self.key(room_id), count=1)
+        return self.decode_id(entries[0][0]) if entries else "0-0"
+
+    def page(self, room_id, before=None, after=None, limit=50):
+        """Return up to ``limit`` messages between two exclusive cursors.
+
+        With ``after`` the oldest matching messages are returned, otherwise
+        the newest ones. Messages are always in chronological order.
+
+        Returns:
+            A tuple of the messages and the id continuing in the same
+            direction, or None if there are no more messages.
+
+        """
+        raws, next_cursor = self.page_raw(room_id, before, after, limit)
+        return [decode(raw) for raw in raws], next_cursor
+
+    def page_raw(self, room_id, before=None, after=None, limit=50, primary=False):
+        """Like page(), with the messages encoded as stored, with their ids.
+
+        With ``primary`` the page is read from the primary even if there is
+        a replica.
+        """
+        redis = self.redis if primary else self.replica
+        before = self.parse_cursor(before) if before is not None else None
+        after = self.parse_cursor(after) if after is not None else None
+
+        skew = STREAM_CLOCK_SKEW_MS
+
+        def keep(entry_id, fields):
+            # Only the entries stored within the clock skew of a timestamp
+            # cursor need their message timestamp checked.
+            ms = int(self.decode_id(entry_id).split("-")[0])
+            if isinstance(before, float) and ms >= before * 1000 - skew:
+                if decode(fields[b"data"])["timestamp"] >= before:
+                    return False
+            if isinstance(after, float) and ms <= after * 1000 + skew:
+                if decode(fields[b"data"])["timestamp"] <= after:
+                    return False
+            return True
+
+        low = self._bound(after, -STREAM_CLOCK_SKEW_MS, "-")
+        high = self._bound(before, STREAM_CLOCK_SKEW_MS, "+")
+        reverse = after is None
+        kept = []
+        while len(kept) < limit:
+            count = limit - len(kept)
+            if reverse:
+                entries = redis.xrevrange(self.key(room_id), high, low, count)
+            else:
+                entries = redis.xrange(self.key(room_id), low, high, count)
+            kept.extend(entry for entry in entries if keep(*entry))
+            if len(entries) < count:
+                break
+            last = "(" + self.decode_id(entries[-1][0])
+            if reverse:
+                high = last
+            else:
+                low = last
+        if reverse:
+            kept.reverse()
+
+        next_cursor = None
+        if len(kept) == limit:
+            next_cursor = self.decode_id(kept[-1 if after is not None else 0][0])
+        return [self.raw_entry(*entry) for entry in kept], next_cursor
+
+    @staticmethod
+    def _bound(cursor, margin_ms, default):
+        if cursor is None:
+            return default
+        if isinstance(cursor, str):
+            return "(" + cursor
+        return str(max(0, int(cursor * 1000) + margin_ms))
+
+
+def make_store(redis, backend="zset", maxlen=None, encoding="json", replica=None):
+    """Return the message store named ``backend`` ("zset" or "stream")."""
+    if backend == "zset":
+        return ZSetMessageStore(redis, encoding=encoding, replica=replica)
+    if backend == "stream":
+        return StreamMessageStore(
+            redis, maxlen=maxlen, encoding=encoding, replica=replica
+        )
+    raise ValueError("Unknown storage backend: %s" % backend)
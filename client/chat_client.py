@@ -1,40 +1,409 @@
-import socketio
+"""Chat client: a console client, and ChatClient to use from other programs.
+
+    python client/chat_client.py [--url http://localhost:5002] [--batch-ms 0]
+
+ChatClient connects one user to one room on asyncio, so that one process can
+run thousands of them, e.g. bots or the clients of a soak test:
+
+    client = ChatClient("http://localhost:5002", "alice", 1, on_message=print)
+    await client.connect()
+    message_id = await client.send("hello")
+"""
+import argparse
+import asyncio
+import json
+import sys
+import uuid
+from collections import deque
+from urllib.parse import urljoin
+
 import requests
-import threading
+import socketio
 
-sio = socketio.Client()
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-room = 0
-username = ""
+# History pages are sent as compact msgpack when the client can decode them,
+# otherwise as the JSON bytes stored by the server.
+ENCODING = "msgpack" if msgpack is not None else "json"
+MSGPACK_FIELDS = ("id", "sender_id", "timestamp", "message")
 
+# Seconds to wait for the server to answer a join or acknowledge a send.
+TIMEOUT = 10
 
-@sio.event
-def connect():
-    sio.emit('join', {'username': username, 'room': room})
+# Times a send is tried before giving up on it, across reconnections.
+SEND_ATTEMPTS = 3
 
+# Rooms listed at a time when choosing one.
+ROOMS_PAGE_SIZE = 20
 
-@sio.event
-def disconnect():
-    print("I'm disconnected!")
 
+def page_messages(data):
+    """Return the messages of a batch or history page."""
+    if data.get("encoding") == "msgpack":
+        return [dict(zip(MSGPACK_FIELDS, m)) for m in msgpack.unpackb(data["data"])]
+    if data.get("encoding") == "json":
+        return json.loads(data["data"])
+    return data["data"]
 
-@sio.event
-def message(data):
-    """Handle a new message from the server."""
-    print(data)
 
+class HistoryError(Exception):
+    """The server could not send a page of history."""
 
-@sio.event
-def batch(data):
-    """Handle a batch of messages from the server."""
-    for item in data["data"]:
-        print(f"{item['sender_id']}: {item['message']}")
 
+def parse_text(text, meta=None):
+    """Return a broadcast text as a message, without a sender for notices.
 
-@sio.event
-def error(data):
-    """Handle an error message from the server."""
-    print(f"Error: {data['data']}")
+    ``meta`` holds the id and timestamp broadcast with a stored message.
+    """
+    sender, separator, message = text.partition(": ")
+    if not separator or " " in sender:
+        sender, message = None, text
+    meta = meta or {}
+    return {
+        "id": meta.get("id"),
+        "sender_id": sender,
+        "timestamp": meta.get("timestamp"),
+        "message": message,
+    }
+
+
+def render(item):
+    """Return the line showing a message."""
+    if item["sender_id"] is None:
+        return item["message"]
+    return f"{item['sender_id']}: {item['message']}"
+
+
+class ChatClient:
+    """One user in one room, on a ``socketio.AsyncClient``.
+
+    Messages reach ``on_message(item)`` once each, in order, as dicts with the
+    keys of chat.codec.FIELDS (notices have no id, sender nor timestamp), and
+    the newest ``buffer_size`` of them stay in ``messages``. The client
+    reconnects on its own and resumes after the last stored message it saw,
+    live or not, instead of reloading the history: messages pushed
+    live while it catches up are held back until the stored ones before them
+    were passed on, and the ones it already got are not passed on twice.
+    When more than ``buffer_size`` arrived since that message, it reloads the
+    latest page instead of catching up on all of them.
+
+    With ``send_window`` (seconds), messages sent within the window of the
+    first one are sent together as one ``messages`` event of at most
+    ``max_batch`` messages, stored with one write.
+    """
+
+    def __init__(
+        self,
+        url,
+        username,
+        room,
+        on_message=None,
+        on_error=None,
+        buffer_size=1000,
+        send_window=0,
+        max_batch=100,
+        encoding=ENCODING,
+        transports=("websocket",),
+        **options,
+    ):
+        self.url = url
+        self.username = username
+        self.room = room
+        self.on_message = on_message
+        self.on_error = on_error
+        self.send_window = send_window
+        self.max_batch = max_batch
+        self.encoding = encoding
+        self.transports = list(transports)
+        self.messages = deque(maxlen=buffer_size)
+        # Timestamps bounding the stored messages seen so far, and the id of
+        # the newest one, which the server may resume from instead.
+        self.oldest_seen = None
+        self.last_seen = None
+        self.last_id = None
+        # Whether the last page of older messages reached the first one.
+        self.history_complete = False
+        # The server's cursor of the page preceding the oldest one received.
+        self._older_cursor = None
+        # Ids of the stored messages pushed live that no page matched yet.
+        self._live = deque(maxlen=buffer_size)
+        # Messages pushed live while catching up, passed on once it is done.
+        self._catching_up = False
+        self._held = deque(maxlen=buffer_size)
+        self._joined = asyncio.Event()
+        self._older = None
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self.sio = socketio.AsyncClient(**options)
+        events = ("connect", "disconnect", "message", "message_batch", "batch")
+        for event in events + ("history", "error"):
+            self.sio.on(event, getattr(self, "_on_" + event))
+
+    async def connect(self, timeout=TIMEOUT):
+        """Connect, join the room and wait for its latest messages."""
+        await self.sio.connect(self.url, transports=self.transports)
+        await asyncio.wait_for(self._joined.wait(), timeout)
+
+    async def wait(self):
+        """Wait until the client is disconnected for good."""
+        await self.sio.wait()
+
+    async def close(self):
+        """Send the messages still waiting for a batch, then disconnect."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.sio.disconnect()
+
+    async def send(self, text):
+        """Send a message.
+
+        Returns:
+            The id of the stored message, or None if it was not stored.
+
+        """
+        if not self.send_window:
+            data = {
+                "username": self.username,
+                "message": text,
+                "room_id": self.room,
+                # Lets the server drop the duplicate if this send is retried.
+                "idempotency_key": str(uuid.uuid4()),
+            }
+            ack = await self._call("message", data)
+            return ack.get("id") if ack else None
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self._pending = self._pending, []
+            self._spawn(self._send_batch(batch))
+        elif self._timer is None:
+            self._timer = self._spawn(self._flush_later())
+        return await future
+
+    async def flush(self):
+        """Send the messages waiting for a batch at once."""
+        batch, self._pending = self._pending, []
+        if batch:
+            await self._send_batch(batch)
+
+    async def _send_batch(self, batch):
+        data = {
+            "username": self.username,
+            "messages": [text for text, _ in batch],
+            "room_id": self.room,
+        }
+        # Batched messages have no idempotency key: a retry could store them
+        # twice.
+        ack = await self._call("messages", data, retry_unanswered=False)
+        ids = ack.get("ids", []) if ack else []
+        for n, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(ids[n] if n < len(ids) else None)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.send_window)
+        self._timer = None
+        await self.flush()
+
+    async def _call(self, event, data, retry_unanswered=True):
+        """Emit ``event`` once connected and return its acknowledgement.
+
+        An emit that got no answer is only sent again with
+        ``retry_unanswered``, as the server may have stored it.
+        """
+        for _ in range(SEND_ATTEMPTS):
+            try:
+                await asyncio.wait_for(self._joined.wait(), TIMEOUT)
+                return await self.sio.call(event, data, timeout=TIMEOUT)
+            except socketio.exceptions.TimeoutError:
+                if not retry_unanswered:
+                    return None
+            except (asyncio.TimeoutError, socketio.exceptions.SocketIOError):
+                # Disconnected: try again once reconnected.
+                pass
+        return None
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def more(self):
+        """Return the page of stored messages preceding the oldest one seen.
+
+        The page starts at the ``next_cursor`` of the oldest page received,
+        so that the messages sent at the same time as the oldest one are not
+        skipped.
+
+        Raises:
+            HistoryError: The server could not read the page.
+
+        """
+        if self._older is None or self._older.done():
+            self._older = asyncio.get_running_loop().create_future()
+            before = self._older_cursor
+            if before is None:
+                before = self.oldest_seen
+            await self._request_history(before=before)
+        return await asyncio.wait_for(asyncio.shield(self._older), TIMEOUT)
+
+    async def _request_history(self, **cursor):
+        await self.sio.emit(
+            "history", {"room": self.room, "encoding": self.encoding, **cursor}
+        )
+
+    # ------------------------------------------------------------------
+    # Socket.IO events
+    # ------------------------------------------------------------------
+
+    async def _on_connect(self):
+        since, last_id = self.last_seen, self.last_id
+        if len(self._live) == self._live.maxlen:
+            # Too much went by to catch up on: start over from the latest.
+            since = last_id = None
+            self._live.clear()
+        self._catching_up = since is not None
+        await self.sio.emit(
+            "join",
+            {
+                "username": self.username,
+                "room": self.room,
+                "since": since,
+                "last_id": last_id,
+                "encoding": self.encoding,
+            },
+        )
+
+    async def _on_disconnect(self):
+        self._joined.clear()
+
+    async def _on_message(self, text, meta=None):
+        if self._catching_up:
+            self._held.append((text, meta))
+            return
+        item = parse_text(text, meta)
+        if meta is not None:
+            self._live.append(item["id"])
+            self._track([item])
+        self._add(item)
+
+    async def _on_message_batch(self, data):
+        # The skipped messages come before the ones of the batch.
+        since = self.last_seen
+        metas = data.get("meta") or [None] * len(data["messages"])
+        for text, meta in zip(data["messages"], metas):
+            await self._on_message(text, meta)
+        if data.get("dropped") and since is not None:
+            # The server skipped messages to keep up: fetch them, and hold
+            # the next ones back until they are passed on.
+            self._catching_up = True
+            await self._request_history(after=since)
+
+    async def _on_batch(self, data):
+        await self._receive_page(data)
+        self._joined.set()
+
+    async def _on_history(self, data):
+        if "error" in data:
+            await self._history_failed(data)
+            return
+        if data["direction"] == "after":
+            await self._receive_page(data)
+            return
+        items = page_messages(data)
+        self._track_older(data, items)
+        self._track(items)
+        if self._older is not None and not self._older.done():
+            self._older.set_result(items)
+
+    async def _on_error(self, data):
+        if self.on_error is not None:
+            self.on_error(data)
+
+    async def _history_failed(self, data):
+        await self._on_error({"data": data["error"]})
+        if data.get("direction") == "after":
+            # Give up catching up rather than hold live messages forever.
+            await self._release_held()
+        elif self._older is not None and not self._older.done():
+            self._older.set_exception(HistoryError(data["error"]))
+
+    async def _receive_page(self, data):
+        """Pass on the messages of a page that were not already seen live."""
+        items = page_messages(data)
+        if data["direction"] == "before":
+            self._track_older(data, items)
+        self._track(items)
+        for item in items:
+            message_id = item.get("id")
+            if message_id is not None and message_id in self._live:
+                while self._live.popleft() != message_id:
+                    pass
+            else:
+                self._unhold(message_id)
+                self._add(item)
+        if data["direction"] == "after" and data.get("next_cursor") is not None:
+            # More messages were missed than fit in one page, keep catching up.
+            await self._request_history(after=data["next_cursor"])
+            return
+        await self._release_held()
+
+    def _unhold(self, message_id):
+        """Forget the held message of this id, passed on from a page instead."""
+        if message_id is None:
+            return
+        for held in self._held:
+            if held[1] is not None and held[1].get("id") == message_id:
+                self._held.remove(held)
+                return
+
+    async def _release_held(self):
+        """Stop catching up and pass on what was pushed live meanwhile."""
+        self._catching_up = False
+        while self._held:
+            await self._on_message(*self._held.popleft())
+
+    def _track_older(self, data, items):
+        """Remember the cursor of the page preceding a page of older messages,
+        unless older ones were already received."""
+        if self.oldest_seen is None or (
+            items and items[0]["timestamp"] <= self.oldest_seen
+        ):
+            self._older_cursor = data.get("next_cursor")
+            self.history_complete = self._older_cursor is None
+
+    def _track(self, items):
+        """Remember the time range of the stored messages received so far."""
+        if not items:
+            return
+        if self.oldest_seen is None or items[0]["timestamp"] < self.oldest_seen:
+            self.oldest_seen = items[0]["timestamp"]
+        if self.last_seen is None or items[-1]["timestamp"] > self.last_seen:
+            self.last_seen = items[-1]["timestamp"]
+            self.last_id = items[-1].get("id")
+
+    def _add(self, item):
+        self.messages.append(item)
+        if self.on_message is not None:
+            self.on_message(item)
+
+
+# ----------------------------------------------------------------------
+# Console client
+# ----------------------------------------------------------------------
 
 
 def get_username():
@@ -46,55 +415,106 @@ def get_username():
             return username
 
 
-def choose_room():
-    """Select a chat room on start. Send and see messages from this room."""
-    rooms_ids = []
+def list_rooms(url, rooms_ids):
+    """Print the page of rooms at ``url`` and return the url of the next one."""
     try:
-        response = requests.get("http://localhost:5002/rooms")
+        response = requests.get(url)
         response.raise_for_status()
 
-        for i, room in enumerate(response.json()):
+        for room in response.json():
             rooms_ids.append(room["id"])
-            print(f"{i + 1}. {room['topic']}")
+            print(f"{len(rooms_ids)}. {room['topic']}")
     except (requests.exceptions.JSONDecodeError, KeyError):
         print("Invalid response from server")
+        return None
+    next_page = response.links.get("next")
+    return urljoin(url, next_page["url"]) if next_page else None
+
 
+def choose_room(url):
+    """Select a chat room on start. Send and see messages from this room.
+
+    The most active rooms are listed first, ROOMS_PAGE_SIZE at a time.
+    """
+    rooms_ids = []
+    next_url = list_rooms(
+        url + "/rooms?sort=activity&limit=%d" % ROOMS_PAGE_SIZE, rooms_ids
+    )
     while True:
+        more = " (Enter for more rooms)" if next_url else ""
+        choice = input(f"Choose a chat room by entering its #{more}: ")
+        if not choice and next_url:
+            next_url = list_rooms(next_url, rooms_ids)
+            continue
         try:
-            room_id = int(input("Choose a chat room by entering its #: "))
-            return rooms_ids[room_id - 1]
+            return rooms_ids[int(choice) - 1]
         except (ValueError, IndexError):
             print("Invalid room id")
 
 
-def send_messages():
-    """Send messages to the server. Input is taken from the console."""
-    while True:
-        new_message = input("")
-        print("\033[A \033[A")  # clear the input line
-        data = {"username": username, "message": new_message, "room_id": room}
-        sio.emit("message", data)
+def print_error(data):
+    print(f"Error: {data['data']}")
 
 
-def main():
-    global username
-    global room
-    try:
-        username = get_username()
-        room = choose_room()
+async def chat(url, username, room, send_window):
+    """Print the messages of ``room`` and send the lines typed.
 
-        sio.connect("http://localhost:5002")
-        input_thread = threading.Thread(target=send_messages)
-        input_thread.daemon = True
-        input_thread.start()
+    Typing /more prints the page of messages preceding the oldest one shown.
+    """
+    sends = set()
+    client = ChatClient(
+        url,
+        username,
+        room,
+        on_message=lambda item: print(render(item)),
+        on_error=print_error,
+        send_window=send_window,
+    )
+    await client.connect()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            # Read from sys.stdin itself, which input() may have buffered.
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                break
+            new_message = line.rstrip("\n")
+            print("\033[A \033[A")  # clear the input line
+            if new_message == "/more":
+                try:
+                    items = await client.more()
+                except HistoryError:
+                    continue
+                print("--- older messages ---")
+                for item in items:
+                    print(render(item))
+                if client.history_complete:
+                    print("--- beginning of the room ---")
+                continue
+            # Keep reading lines while the message is being sent.
+            send = asyncio.ensure_future(client.send(new_message))
+            sends.add(send)
+            send.add_done_callback(sends.discard)
+    finally:
+        await client.close()
 
-        sio_thread = threading.Thread(target=sio.wait)
-        sio_thread.start()
 
-        input_thread.join()
-        sio_thread.join()
+def main():
+    parser = argparse.ArgumentParser(description="Chat console client")
+    parser.add_argument("--url", default="http://localhost:5002")
+    parser.add_argument(
+        "--batch-ms",
+        type=float,
+        default=0,
+        help="send the lines typed within this many milliseconds together",
+    )
+    args = parser.parse_args()
+    try:
+        username = get_username()
+        room = choose_room(args.url)
+        asyncio.run(chat(args.url, username, room, args.batch_ms / 1000))
     except KeyboardInterrupt:
-        sio.disconnect()
+        pass
 
 
 if __name__ == "__main__":
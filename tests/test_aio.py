@@ -0,0 +1,263 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+
+from chat import passwords
+from chat.api import ChatAPI
+from chat.cache import INVALIDATION_CHANNEL
+from chat.errors import ChatAPIError
+from chat.presence import PresenceTracker
+from chat.rooms import DEFAULT_ROOMS
+from chat.search import SearchIndex
+from test_chat_api import FakeRedis
+
+fakeredis = pytest.importorskip("fakeredis")
+aioredis = pytest.importorskip("fakeredis.aioredis")
+
+from chat.aio import AsyncChatAPI  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fast_password_hashing(monkeypatch):
+    monkeypatch.setattr(passwords, "ITERATIONS", 1000)
+
+
+@pytest.fixture
+def chat_api():
+    return AsyncChatAPI(aioredis.FakeRedis(server=fakeredis.FakeServer()))
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class TestAsyncChatAPI:
+    def test_register_and_login(self, chat_api):
+        async def scenario():
+            await chat_api.register_user("alice", "secret123")
+            with pytest.raises(ChatAPIError):
+                await chat_api.register_user("alice", "other123")
+            token = await chat_api.login_user("alice", "secret123")
+            assert await chat_api.verify_token(token) == "alice"
+            await chat_api.logout_user(token)
+            with pytest.raises(ChatAPIError) as e:
+                await chat_api.verify_token(token)
+            assert e.value.get_status_code() == 401
+
+        run(scenario())
+
+    def test_login_invalid_password(self, chat_api):
+        async def scenario():
+            await chat_api.register_user("alice", "secret123")
+            with pytest.raises(ChatAPIError):
+                await chat_api.login_user("alice", "wrong")
+
+        run(scenario())
+
+    def test_join_room(self, chat_api):
+        async def scenario():
+            await chat_api.redis.sadd("rooms_ids", 1)
+            await chat_api.join_room("1", "alice")
+            assert await chat_api.redis.smembers("room:1:users") == {b"alice"}
+            with pytest.raises(ChatAPIError) as e:
+                await chat_api.join_room("2", "alice")
+            assert e.value.get_status_code() == 404
+
+        run(scenario())
+
+    def test_rooms(self, chat_api):
+        async def scenario():
+            assert await chat_api.ensure_rooms(DEFAULT_ROOMS) == [1, 2, 3]
+            assert await chat_api.ensure_rooms(DEFAULT_ROOMS) == []
+            room = await chat_api.create_room("fish", "alice")
+            assert room == {"id": 4, "topic": "fish"}
+            await chat_api.join_room("4", "bob")
+            page = await chat_api.get_rooms_page(sort="members", limit=1)
+            assert page == {"rooms": [room], "next_cursor": 1}
+            with pytest.raises(ChatAPIError) as e:
+                await chat_api.delete_room("4", "bob")
+            assert e.value.get_status_code() == 403
+            await chat_api.delete_room("4", "alice")
+            assert [r["id"] for r in await chat_api.get_rooms()] == [1, 2, 3]
+
+        run(scenario())
+
+    def test_send_and_page(self, chat_api):
+        async def scenario():
+            ids = [
+                await chat_api.send_message("1", "alice", "hello %d" % i)
+                for i in range(5)
+            ]
+            assert ids == [1, 2, 3, 4, 5]
+            page = await chat_api.get_messages_page_raw("1", limit=3)
+            messages = [json.loads(raw) for raw in page["messages"]]
+            assert [m["message"] for m in messages] == [
+                "hello 2",
+                "hello 3",
+                "hello 4",
+            ]
+            assert page["next_cursor"] == "%r:3" % messages[0]["timestamp"]
+            older = await chat_api.get_messages_page_raw(
+                "1", before=page["next_cursor"], limit=3
+            )
+            assert len(older["messages"]) == 2
+            assert older["next_cursor"] is None
+
+        run(scenario())
+
+    def test_messages_readable_by_sync_api(self, chat_api):
+        async def scenario():
+            await chat_api.send_message("1", "alice", "hello")
+            return await chat_api.redis.zrange("room:1", 0, -1)
+
+        (raw,) = run(scenario())
+        assert json.loads(raw)["message"] == "hello"
+        assert json.loads(raw)["id"] == 1
+
+    def test_idempotent_send(self, chat_api):
+        async def scenario():
+            first = await chat_api.send_message(
+                "1", "alice", "hello", idempotency_key="k1"
+            )
+            retry = await chat_api.send_message(
+                "1", "alice", "hello", idempotency_key="k1"
+            )
+            assert first == retry
+            assert await chat_api.redis.zcard("room:1") == 1
+
+        run(scenario())
+
+    def test_store_messages_reports_retries(self, chat_api):
+        async def scenario():
+            sent = chat_api.new_message("alice", "hello")
+            await chat_api.store_messages("1", [sent], ["k1"])
+            messages = [chat_api.new_message("alice", t) for t in ("hello", "next")]
+            duplicates = await chat_api.store_messages("1", messages, ["k1", "k2"])
+            return sent, messages, duplicates
+
+        sent, messages, duplicates = run(scenario())
+        assert duplicates == [0]
+        assert [msg.id for msg in messages] == [sent.id, sent.id + 1]
+
+    def test_send_announced_to_eventlet_workers(self):
+        server = fakeredis.FakeServer()
+        chat_api = AsyncChatAPI(aioredis.FakeRedis(server=server), search=True)
+        pubsub = fakeredis.FakeRedis(server=server).pubsub(
+            ignore_subscribe_messages=True
+        )
+        pubsub.subscribe(INVALIDATION_CHANNEL)
+        assert pubsub.get_message() is None  # The subscription.
+
+        async def scenario():
+            await chat_api.ensure_rooms(DEFAULT_ROOMS)
+            messages = [chat_api.new_message("alice", t) for t in ("hello", "fish")]
+            assert await chat_api.store_messages("1", messages) == []
+            assert [msg.id for msg in messages] == [1, 2]
+
+        sync_redis = fakeredis.FakeRedis(server=server)
+        eventlet_api = ChatAPI(sync_redis)
+        assert eventlet_api.get_messages_page("1")["messages"] == []
+        run(scenario())
+        event = pubsub.get_message(timeout=1)["data"]
+        assert (json.loads(event)["cache"], json.loads(event)["key"]) == (
+            "history",
+            "1",
+        )
+        # The eventlet worker adds the messages to the room it caches.
+        eventlet_api.cache._apply(event)
+        sync_redis.delete("room:1")
+        messages = eventlet_api.get_messages_page("1")["messages"]
+        assert [m["message"] for m in messages] == ["hello", "fish"]
+        index = SearchIndex(sync_redis)
+        assert [m["id"] for m in index.search("1", "fish")[0]] == [2]
+        assert sync_redis.zscore("rooms:by_activity", "1") > 0
+
+    def test_invalid_cursor(self, chat_api):
+        with pytest.raises(ChatAPIError) as e:
+            run(chat_api.get_messages_page_raw("1", before="nope"))
+        assert e.value.get_status_code() == 400
+
+    def test_invalid_message(self, chat_api):
+        with pytest.raises(ChatAPIError) as e:
+            run(chat_api.send_message("1", "alice", ""))
+        assert e.value.get_status_code() == 422
+
+    def test_encoded_page(self, chat_api):
+        async def scenario():
+            await chat_api.send_message("1", "alice", "hello")
+            return await chat_api.get_messages_page_encoded("1", encoding="json")
+
+        page = run(scenario())
+        assert json.loads(page["data"])[0]["message"] == "hello"
+
+
+class TestASGIEvents:
+    @pytest.fixture
+    def server(self, chat_api, monkeypatch):
+        asgi = pytest.importorskip("asgi")
+        emitted = []
+
+        async def emit(event, data=None, to=None, **options):
+            emitted.append((event, data, to))
+
+        monkeypatch.setattr(asgi, "chat_api", chat_api)
+        monkeypatch.setattr(asgi.sio, "emit", emit)
+        return asgi, emitted
+
+    def test_retried_message_not_broadcast_again(self, server):
+        asgi, emitted = server
+        data = {"room_id": 1, "username": "alice", "message": "hi"}
+
+        async def scenario():
+            first = await asgi.message("sid1", dict(data, idempotency_key="k1"))
+            retry = await asgi.message("sid1", dict(data, idempotency_key="k1"))
+            return first, retry
+
+        first, retry = run(scenario())
+        assert first == retry == {"id": 1}
+        assert [event for event, _, _ in emitted] == ["message"]
+
+    def test_joins_announced_together(self, server, monkeypatch):
+        asgi, emitted = server
+        tracker = PresenceTracker(FakeRedis())
+        monkeypatch.setattr(asgi, "presence", tracker)
+        sessions = {}
+
+        def start(notify):
+            # Flushed by the test rather than by the thread.
+            tracker.notify = notify
+
+        async def get_session(sid):
+            return sessions.get(sid, {})
+
+        async def save_session(sid, session):
+            sessions[sid] = session
+
+        async def enter_room(sid, room):
+            pass
+
+        monkeypatch.setattr(tracker, "start", start)
+        monkeypatch.setattr(asgi.sio, "get_session", get_session)
+        monkeypatch.setattr(asgi.sio, "save_session", save_session)
+        monkeypatch.setattr(asgi.sio, "enter_room", enter_room)
+
+        async def scenario():
+            await asgi.start_presence()
+            for sid, username in (("sid1", "alice"), ("sid2", "bob")):
+                await asgi.join(sid, {"username": username, "room": 1})
+            await asgi.disconnect("sid1")
+            await asgi.join("sid3", {"username": "alice", "room": 1})
+            tracker.flush()
+            await asyncio.sleep(0.01)
+
+        run(scenario())
+        assert [(event, data) for event, data, to in emitted if to == "1"] == [
+            ("presence", {"room": "1", "joined": ["alice", "bob"], "left": []}),
+            ("message", "alice, bob have entered the room."),
+        ]
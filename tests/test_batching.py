@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+from chat.api import ChatAPI
+from chat.batching import MessageBatcher
+from chat.errors import ChatAPIError
+from test_chat_api import FakeRedis
+
+
+class TestMessageBatcher:
+    @pytest.fixture
+    def chat_api(self):
+        return ChatAPI(FakeRedis())
+
+    def test_flush_stores_in_order(self, chat_api):
+        batcher = MessageBatcher(chat_api)
+        acks = []
+        for room, text in [(1, "a"), (2, "b"), (1, "c")]:
+            batcher.submit(
+                room, "alice", text, lambda m, e, d: acks.append((m.message, e))
+            )
+        batcher.flush()
+        assert acks == [("a", None), ("b", None), ("c", None)]
+        assert [m["message"] for m in chat_api.get_messages(1)] == ["a", "c"]
+        assert [m["message"] for m in chat_api.get_messages(2)] == ["b"]
+        assert [m["id"] for m in chat_api.get_messages(1)] == [1, 2]
+
+    def test_invalid_message_rejected_on_submit(self, chat_api):
+        batcher = MessageBatcher(chat_api)
+        with pytest.raises(ChatAPIError):
+            batcher.submit(1, "alice", "", lambda m, e, d: None)
+
+    def test_idempotency_keys_deduped(self, chat_api):
+        batcher = MessageBatcher(chat_api)
+        acks = []
+
+        def ack(msg, error, duplicate):
+            acks.append((msg.id, error, duplicate))
+
+        batcher.submit(1, "alice", "hi", ack, idempotency_key="k1")
+        batcher.submit(1, "alice", "hi", ack, idempotency_key="k1")
+        batcher.submit(1, "alice", "other", ack)
+        batcher.flush()
+        batcher.submit(1, "alice", "hi", ack, idempotency_key="k1")
+        batcher.flush()
+        assert acks == [(1, None, False), (1, None, True), (2, None, False)] + [
+            (1, None, True)
+        ]
+        assert [m["message"] for m in chat_api.get_messages(1)] == ["hi", "other"]
+
+    def test_failure_reported_per_room(self, chat_api):
+        # The script storing the messages of room 2 fails on the wrong type.
+        chat_api.redis.set("room:2", "not a sorted set")
+        batcher = MessageBatcher(chat_api)
+        acks = {}
+        for room in (1, 2):
+            batcher.submit(
+                room, "alice", "hi", lambda m, e, d, room=room: acks.update({room: e})
+            )
+        batcher.flush()
+        assert acks[1] is None
+        assert isinstance(acks[2], ChatAPIError)
+
+    def test_background_writer(self, chat_api):
+        batcher = MessageBatcher(chat_api, window=0.001)
+        batcher.start()
+        done = []
+        batcher.submit(1, "alice", "hi", lambda m, e, d: done.append(e))
+        for _ in range(100):
+            if done:
+                break
+            time.sleep(0.01)
+        assert done == [None]
@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from chat.cache import ChatCache, HistoryCache, TTLCache, MISSING
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache:
+    def test_get_missing(self):
+        cache = TTLCache()
+        assert cache.get("a") is MISSING
+        assert cache.stats()["misses"] == 1
+
+    def test_falsy_values_are_cached(self):
+        cache = TTLCache()
+        cache.set("a", False)
+        assert cache.get("a") is False
+        assert cache.stats()["hits"] == 1
+
+    def test_expiry(self):
+        clock = FakeClock()
+        cache = TTLCache(ttl=10, clock=clock)
+        cache.set("a", 1)
+        clock.now = 9
+        assert cache.get("a") == 1
+        clock.now = 10
+        assert cache.get("a") is MISSING
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is MISSING
+        assert cache.get("a") == 1
+        assert cache.stats()["evictions"] == 1
+
+
+class TestChatCache:
+    def test_apply_remote_invalidation(self):
+        cache = ChatCache(redis=None)
+        cache.tokens.set("t1", "alice")
+        cache.tokens.set("t2", "bob")
+        cache._apply(json.dumps({"cache": "tokens", "key": "t1"}).encode())
+        assert cache.tokens.get("t1") is MISSING
+        assert cache.tokens.get("t2") == "bob"
+
+    def test_apply_ignores_garbage(self):
+        cache = ChatCache(redis=None)
+        cache._apply(b"not json")
+        cache._apply(json.dumps({"cache": "nope", "key": None}))
+
+
+def items(*positions):
+    return [(b"m%d" % p, p, float(p)) for p in positions]
+
+
+class TestHistoryCache:
+    def test_latest_page(self):
+        cache = HistoryCache(window=3)
+        cache.fill("1", 0, items(1, 2, 3, 4), complete=False)
+        assert cache.page("1", limit=2) == ([b"m3", b"m4"], 3.0)
+        assert cache.page("1", limit=4) is MISSING
+        assert cache.stats()["hits"] == 1
+
+    def test_complete_room(self):
+        cache = HistoryCache()
+        cache.fill("1", 0, items(1, 2), complete=True)
+        assert cache.page("1", limit=5) == ([b"m1", b"m2"], None)
+
+    def test_after(self):
+        cache = HistoryCache()
+        cache.fill("1", 0, items(2, 3, 4), complete=False)
+        assert cache.page("1", after=2, limit=1) == ([b"m3"], 3.0)
+        assert cache.page("1", after=1, limit=1) is MISSING
+
+    def test_stale_fill_dropped(self):
+        cache = HistoryCache()
+        generation = cache.generation("1")
+        cache.invalidate("1")
+        assert not cache.fill("1", generation, items(1), complete=True)
+        assert cache.page("1") is MISSING
+
+    def test_append(self):
+        cache = HistoryCache(window=3)
+        cache.fill("1", 0, items(1, 2), complete=True)
+        cache.append("1", items(3))
+        assert cache.page("1", limit=3) == ([b"m1", b"m2", b"m3"], 1.0)
+        cache.append("1", items(4))
+        assert cache.page("1", limit=4) is MISSING
+
+    def test_out_of_order_append_drops_room(self):
+        cache = HistoryCache()
+        cache.fill("1", 0, items(1, 3), complete=True)
+        cache.append("1", items(2))
+        assert cache.page("1") is MISSING
+
+    def test_lru_eviction_by_bytes(self):
+        cache = HistoryCache(max_bytes=250)
+        cache.fill("1", 0, items(1), complete=True)
+        cache.fill("2", 0, items(2), complete=True)
+        cache.page("1")
+        cache.fill("3", 0, items(3), complete=True)
+        assert cache.page("2") is MISSING
+        assert cache.page("1") is not MISSING
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["bytes"] <= 250
+
+    def test_expiry(self):
+        clock = FakeClock()
+        cache = HistoryCache(ttl=10, clock=clock)
+        cache.fill("1", 0, items(1), complete=True)
+        clock.now = 10
+        assert cache.page("1") is MISSING
+        assert cache.stats()["bytes"] == 0
+
+
+class TestChatCacheOrigin:
+    def test_own_invalidations_ignored(self):
+        cache = ChatCache(redis=None)
+        cache.history.fill("1", 0, items(1), complete=True)
+        event = {"cache": "history", "key": "1", "origin": cache.origin}
+        cache._apply(json.dumps(event))
+        assert cache.history.page("1") is not MISSING
+        cache._apply(json.dumps(dict(event, origin="other")))
+        assert cache.history.page("1") is MISSING
@@ -1,72 +1,52 @@
+import hashlib
 import json
 import os
 import sys
+import time
 import pytest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+from chat import passwords
 from chat.api import ChatAPI
+from chat.errors import ChatAPIError
+from chat.migrate import migrate_tokens
 from chat.models import ChatRoom
+from chat.rooms import DEFAULT_ROOMS, RoomRegistry
 
 
-class FakeRedis:
+fakeredis = pytest.importorskip("fakeredis")
+# The scripts of the chat run on fakeredis, which needs lupa to run Lua.
+pytest.importorskip("lupa")
+
+
+class FakeRedis(fakeredis.FakeRedis):
+    """An in-memory Redis of its own, running the Lua scripts for real.
+
+    The ``(channel, message)`` pairs published are listed in ``published``.
+    """
+
     def __init__(self):
-        self._sets = {}
-        self._zsets = {}
-
-    def flushdb(self):
-        self._sets.clear()
-        self._zsets.clear()
-
-    def _encode(self, value):
-        if isinstance(value, bytes):
-            return value
-        return str(value).encode("utf-8")
-
-    def sadd(self, key, *values):
-        s = self._sets.setdefault(key, set())
-        added = 0
-        for v in values:
-            ev = self._encode(v)
-            if ev not in s:
-                s.add(ev)
-                added += 1
-        return added
-
-    def smembers(self, key):
-        return set(self._sets.get(key, set()))
-
-    def sismember(self, key, value):
-        return self._encode(value) in self._sets.get(key, set())
-
-    def srem(self, key, *values):
-        s = self._sets.get(key, set())
-        removed = 0
-        for v in values:
-            ev = self._encode(v)
-            if ev in s:
-                s.remove(ev)
-                removed += 1
-        return removed
-
-    def zadd(self, key, mapping, nx=False):
-        z = self._zsets.setdefault(key, {})
-        added = 0
-        for member, score in mapping.items():
-            em = self._encode(member)
-            if nx and em in z:
-                continue
-            if em not in z:
-                added += 1
-            z[em] = score
-        return added
-
-    def zrange(self, key, start, end):
-        z = self._zsets.get(key, {})
-        sorted_members = [m for m, _ in sorted(z.items(), key=lambda kv: kv[1])]
-        if end == -1:
-            end = len(sorted_members) - 1
-        return [sorted_members[i] for i in range(start, min(end + 1, len(sorted_members)))]
+        super().__init__(server=fakeredis.FakeServer())
+        self._published = []
+        self._subscriber = self.pubsub()
+        self._subscriber.psubscribe("*")
+
+    @property
+    def published(self):
+        while True:
+            message = self._subscriber.get_message()
+            if message is None:
+                return self._published
+            if message["type"] == "pmessage":
+                self._published.append((message["channel"], message["data"]))
+
+    def xrevrange(self, name, max="+", min="-", count=None):
+        # fakeredis ignores the "(" of an exclusive end id.
+        if isinstance(max, str) and max.startswith("("):
+            ms, seq = map(int, max[1:].split("-"))
+            max = "%d-%d" % (ms, seq - 1) if seq else "%d-%d" % (ms - 1, 2**64 - 1)
+        return super().xrevrange(name, max, min, count)
 
 
 @pytest.fixture
@@ -74,6 +54,11 @@ def redis():
     return FakeRedis()
 
 
+@pytest.fixture(autouse=True)
+def fast_password_hashing(monkeypatch):
+    monkeypatch.setattr(passwords, "ITERATIONS", 1000)
+
+
 class TestChatAPI:
     @pytest.fixture
     def chat_api(self, redis):
@@ -114,12 +99,183 @@ class TestChatAPI:
         with pytest.raises(Exception):
             chat_api.register_user("carol", "pw")
 
-    def _init_rooms(self, redis):
-        rooms = [
-            ChatRoom(id=1, topic="cats"),
-            ChatRoom(id=2, topic="dogs"),
-            ChatRoom(id=3, topic="birds"),
+    def test_verify_token_cached(self, chat_api, redis):
+        chat_api.register_user("alice", "secret")
+        token = chat_api.login_user("alice", "secret")
+        assert chat_api.verify_token(token) == "alice"
+        redis.delete("token:%s" % token)
+        assert chat_api.verify_token(token) == "alice"
+        assert chat_api.cache_stats()["tokens"]["hits"] == 1
+
+    def test_passwords_are_salted(self, chat_api, redis):
+        chat_api.register_user("alice", "secret")
+        chat_api.register_user("bob", "secret")
+        alice = redis.hget("users", "alice")
+        assert alice.startswith(b"pbkdf2_sha256$")
+        assert alice != redis.hget("users", "bob")
+
+    def test_hashing_bounded_under_eventlet(self, monkeypatch):
+        eventlet = pytest.importorskip("eventlet")
+        from eventlet import patcher, tpool
+
+        monkeypatch.setattr(passwords, "HASH_WORKERS", 2)
+        monkeypatch.setattr(passwords, "_tpool_slots", None)
+        monkeypatch.setattr(patcher, "is_monkey_patched", lambda module: True)
+        # Hash on the calling greenlet, which lets the others run meanwhile.
+        monkeypatch.setattr(tpool, "execute", lambda func, *args: func(*args))
+        running = []
+        peak = []
+
+        def work(n):
+            running.append(n)
+            peak.append(len(running))
+            eventlet.sleep(0.01)
+            running.remove(n)
+            return n
+
+        pool = eventlet.GreenPool()
+        results = pool.imap(lambda n: passwords.run_blocking(work, n), range(6))
+        assert list(results) == list(range(6))
+        assert max(peak) == 2
+
+    def test_legacy_password_upgraded_on_login(self, chat_api, redis):
+        legacy = hashlib.sha256(b"secret").hexdigest()
+        redis.hset("users", "alice", legacy)
+        chat_api.login_user("alice", "secret")
+        assert redis.hget("users", "alice").startswith(b"pbkdf2_sha256$")
+        chat_api.login_user("alice", "secret")
+
+    def test_logout(self, chat_api):
+        chat_api.register_user("alice", "secret")
+        token = chat_api.login_user("alice", "secret")
+        chat_api.verify_token(token)
+        chat_api.logout_user(token)
+        with pytest.raises(ChatAPIError):
+            chat_api.verify_token(token)
+
+    def test_migrate_tokens(self, chat_api, redis):
+        redis.hset("tokens", "legacy-token", "alice")
+        assert migrate_tokens(redis) == 1
+        assert chat_api.verify_token("legacy-token") == "alice"
+        assert not redis.hexists("tokens", "legacy-token")
+
+    def test_get_rooms_cache_invalidation(self, chat_api, redis):
+        self._init_rooms(redis)
+        assert len(chat_api.get_rooms()) == 3
+        RoomRegistry(redis).ensure([ChatRoom(id=4, topic="fish")])
+        assert len(chat_api.get_rooms()) == 3
+        chat_api.invalidate_rooms()
+        assert len(chat_api.get_rooms()) == 4
+        assert redis.published
+
+    def test_join_room_missing_room_cached(self, chat_api, redis):
+        with pytest.raises(Exception):
+            chat_api.join_room(1, "valid-name")
+        self._init_rooms(redis)
+        chat_api.invalidate_rooms()
+        chat_api.join_room(1, "valid-name")
+
+    def test_send_message_ids_are_monotonic(self, chat_api):
+        ids = [chat_api.send_message(1, "alice", "same") for _ in range(3)]
+        assert ids == [1, 2, 3]
+        assert chat_api.send_message(2, "alice", "other room") == 1
+        assert [m["id"] for m in chat_api.get_messages(1)] == [1, 2, 3]
+
+    def test_send_message_idempotency_key(self, chat_api):
+        first = chat_api.send_message(1, "alice", "hi", idempotency_key="k1")
+        retry = chat_api.send_message(1, "alice", "hi", idempotency_key="k1")
+        assert first == retry
+        assert len(chat_api.get_messages(1)) == 1
+        other = chat_api.send_message(1, "alice", "hi", idempotency_key="k2")
+        assert other != first
+
+    def test_store_messages_idempotency_keys(self, chat_api):
+        first = chat_api.send_message(1, "alice", "hi", idempotency_key="k1")
+        msgs = [chat_api.new_message("alice", "m%d" % i) for i in range(3)]
+        errors, duplicates = chat_api.store_messages(
+            {1: msgs}, {1: ["k1", None, "k2"]}
+        )
+        assert errors == {1: None}
+        assert duplicates == {(1, 0)}
+        assert [m.id for m in msgs] == [first, 2, 3]
+        assert [m["message"] for m in chat_api.get_messages(1)] == ["hi", "m1", "m2"]
+
+    def test_get_messages_page_latest(self, chat_api):
+        self._send_messages(chat_api, 5)
+        page = chat_api.get_messages_page(1, limit=3)
+        assert [m["message"] for m in page["messages"]] == ["msg 2", "msg 3", "msg 4"]
+        assert page["next_cursor"] == "%r:3" % page["messages"][0]["timestamp"]
+
+    def test_get_messages_page_before(self, chat_api):
+        self._send_messages(chat_api, 5)
+        page = chat_api.get_messages_page(1, limit=3)
+        older = chat_api.get_messages_page(1, before=page["next_cursor"], limit=3)
+        assert [m["message"] for m in older["messages"]] == ["msg 0", "msg 1"]
+        assert older["next_cursor"] is None
+
+    def test_get_messages_page_after(self, chat_api):
+        self._send_messages(chat_api, 5)
+        first = chat_api.get_messages(1)[0]
+        page = chat_api.get_messages_page(1, after=first["timestamp"], limit=2)
+        assert [m["message"] for m in page["messages"]] == ["msg 1", "msg 2"]
+        page = chat_api.get_messages_page(1, after=page["next_cursor"], limit=2)
+        assert [m["message"] for m in page["messages"]] == ["msg 3", "msg 4"]
+
+    def test_get_messages_page_empty_room(self, chat_api):
+        page = chat_api.get_messages_page(1)
+        assert page == {"messages": [], "next_cursor": None}
+
+    def test_history_cache(self, chat_api, redis):
+        self._send_messages(chat_api, 3)
+        chat_api.get_messages_page(1)
+        redis.delete("room:1")
+        page = chat_api.get_messages_page(1, limit=2)
+        assert [m["message"] for m in page["messages"]] == ["msg 1", "msg 2"]
+        assert chat_api.cache_stats()["history"]["hits"] == 1
+
+    def test_history_cache_with_messages_without_ids(self, chat_api, redis):
+        # Stored by versions without message ids.
+        legacy = {"sender_id": "alice", "timestamp": 1.0, "message": "old"}
+        redis.zadd("room:1", {json.dumps(legacy): 1.0})
+        chat_api.send_message(1, "bob", "new")
+        page = chat_api.get_messages_page(1, limit=1)
+        assert [m["message"] for m in page["messages"]] == ["new"]
+        page = chat_api.get_messages_page(1, before=page["next_cursor"])
+        assert [m["message"] for m in page["messages"]] == ["old"]
+        page = chat_api.get_messages_page(1, after="0.5")
+        assert [m["message"] for m in page["messages"]] == ["old", "new"]
+        assert chat_api.cache_stats()["history"]["hits"] == 1
+
+    def test_history_cache_updated_on_send(self, chat_api, redis):
+        self._send_messages(chat_api, 2)
+        first = chat_api.get_messages_page(1)["messages"][0]
+        chat_api.send_message(1, "bob", "new")
+        assert [m["message"] for m in chat_api.get_messages_page(1)["messages"]] == [
+            "msg 0", "msg 1", "new"
         ]
-        for room in rooms:
-            redis.sadd("rooms", json.dumps(room.dict()))
-            redis.sadd("rooms_ids", room.id)
+        page = chat_api.get_messages_page(1, after=first["timestamp"])
+        assert [m["message"] for m in page["messages"]] == ["msg 1", "new"]
+        assert chat_api.cache_stats()["history"]["misses"] == 1
+        channel, event = redis.published[-1]
+        assert json.loads(event)["cache"] == "history"
+
+    def test_history_cache_updated_by_other_worker(self, chat_api, redis):
+        self._send_messages(chat_api, 2)
+        chat_api.get_messages_page(1)
+        other = ChatAPI(redis)
+        other.send_message(1, "bob", "elsewhere")
+        chat_api.cache._apply(redis.published[-1][1])
+        messages = chat_api.get_messages_page(1)["messages"]
+        assert [m["message"] for m in messages][-1] == "elsewhere"
+        # Served from the cache, which kept the room.
+        assert chat_api.cache_stats()["history"]["misses"] == 1
+        # Announced again, e.g. after a reload read it from Redis.
+        chat_api.cache._apply(redis.published[-1][1])
+        assert len(chat_api.get_messages_page(1)["messages"]) == 3
+
+    def _send_messages(self, chat_api, count):
+        for i in range(count):
+            chat_api.send_message(1, "alice", "msg %d" % i)
+
+    def _init_rooms(self, redis):
+        RoomRegistry(redis).ensure(DEFAULT_ROOMS)
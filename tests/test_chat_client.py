@@ -0,0 +1,240 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "client"))
+)
+
+import pytest
+
+socketio = pytest.importorskip("socketio")
+chat_client = pytest.importorskip("chat_client")
+
+
+class FakeSio:
+    """Record emits and answer calls like the server would."""
+
+    def __init__(self):
+        self.emitted = []
+        self.calls = []
+        self.next_id = 1
+
+    async def emit(self, event, data):
+        self.emitted.append((event, data))
+
+    async def call(self, event, data, timeout=None):
+        self.calls.append((event, data))
+        if event == "message":
+            self.next_id += 1
+            return {"id": self.next_id - 1}
+        ids = list(range(self.next_id, self.next_id + len(data["messages"])))
+        self.next_id += len(ids)
+        return {"ids": ids}
+
+
+def message(n, sender="alice"):
+    return {"id": n, "sender_id": sender, "timestamp": 100.0 + n, "message": "m%d" % n}
+
+
+def meta(n):
+    return {"id": n, "timestamp": 100.0 + n}
+
+
+def page(items, direction="before", next_cursor=None):
+    return {
+        "data": json.dumps(items).encode("utf-8"),
+        "encoding": "json",
+        "direction": direction,
+        "next_cursor": next_cursor,
+    }
+
+
+def make_client(**options):
+    received = []
+    client = chat_client.ChatClient(
+        "http://chat", "alice", 1, on_message=received.append, **options
+    )
+    client.sio = FakeSio()
+    return client, received
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_parse_text():
+    assert chat_client.parse_text("bob: hi: there")["sender_id"] == "bob"
+    assert chat_client.parse_text("bob: hi: there")["message"] == "hi: there"
+    notice = chat_client.parse_text("bob and ann have entered the room.")
+    assert notice["sender_id"] is None
+
+
+def test_resume_after_last_seen():
+    client, received = make_client()
+
+    async def scenario():
+        await client._on_connect()
+        await client._on_batch(page([message(1), message(2)]))
+        await client._on_message("alice: m3")
+        await client._on_disconnect()
+        await client._on_connect()
+
+    run(scenario())
+    assert [item["message"] for item in received] == ["m1", "m2", "m3"]
+    join = client.sio.emitted[-1][1]
+    assert join["since"] == 102.0
+    assert join["last_id"] == 2
+
+
+def test_catch_up_skips_messages_seen_live():
+    client, received = make_client()
+
+    async def scenario():
+        await client._on_batch(page([message(1)]))
+        await client._on_message("alice: m2", meta(2))
+        await client._on_disconnect()
+        await client._on_connect()
+        # Pushed live before the catch-up page: held back until it is done.
+        await client._on_message("bob has entered the room.")
+        await client._on_message("alice: m4", meta(4))
+        assert len(received) == 2
+        # m3 was stored while the client was away.
+        await client._on_batch(
+            page([message(2), message(3), message(4)], direction="after")
+        )
+
+    run(scenario())
+    assert [item["message"] for item in received] == [
+        "m1",
+        "m2",
+        "m3",
+        "m4",
+        "bob has entered the room.",
+    ]
+    assert client.last_seen == 104.0
+    assert not client._live
+    assert not client._held
+
+
+def test_catch_up_matches_messages_by_id():
+    client, received = make_client()
+    repeated = [dict(message(n), message="hi") for n in (1, 2, 3)]
+
+    async def scenario():
+        await client._on_batch(page(repeated[:1]))
+        await client._on_message("alice: hi", meta(2))
+        await client._on_disconnect()
+        await client._on_connect()
+        await client._on_message("alice: hi", meta(4))
+        await client._on_batch(page(repeated[1:], direction="after"))
+
+    run(scenario())
+    assert [item["id"] for item in received] == [1, 2, 3, 4]
+
+
+def test_catch_up_continues_until_complete():
+    client, _ = make_client()
+    run(client._on_batch(page([message(1)], direction="after", next_cursor=101.0)))
+    event, data = client.sio.emitted[-1]
+    assert event == "history"
+    assert data["after"] == 101.0
+
+
+def test_buffer_is_bounded():
+    client, _ = make_client(buffer_size=3)
+
+    async def scenario():
+        for n in range(5):
+            await client._on_message("alice: m%d" % n)
+        await client._on_connect()
+
+    run(scenario())
+    assert [item["message"] for item in client.messages] == ["m2", "m3", "m4"]
+    # More went by than the buffer holds: the client starts over.
+    assert client.sio.emitted[-1][1]["since"] is None
+
+
+def test_send_waits_for_the_id():
+    client, _ = make_client()
+    client._joined.set()
+    assert run(client.send("hello")) == 1
+    event, data = client.sio.calls[0]
+    assert event == "message"
+    assert data["idempotency_key"]
+
+
+def test_batched_sends():
+    client, _ = make_client(send_window=0.01, max_batch=3)
+
+    async def scenario():
+        client._joined.set()
+        return await asyncio.gather(*(client.send("m%d" % n) for n in range(4)))
+
+    assert run(scenario()) == [1, 2, 3, 4]
+    assert [(event, data["messages"]) for event, data in client.sio.calls] == [
+        ("messages", ["m0", "m1", "m2"]),
+        ("messages", ["m3"]),
+    ]
+
+
+def test_live_messages_move_the_cursor():
+    client, received = make_client()
+
+    async def scenario():
+        await client._on_batch(page([message(1)]))
+        await client._on_message("alice: m2", {"id": 2, "timestamp": 102.0})
+        await client._on_message("bob has entered the room.")
+        client.sio.emitted.clear()
+        await client._on_connect()
+
+    run(scenario())
+    assert received[1]["id"] == 2
+    join = client.sio.emitted[-1][1]
+    assert join["since"] == 102.0
+    assert join["last_id"] == 2
+
+
+def test_history_error():
+    errors = []
+    client, received = make_client(on_error=errors.append)
+
+    async def scenario():
+        await client._on_batch(page([message(5)]))
+        more = asyncio.ensure_future(client.more())
+        await asyncio.sleep(0)
+        await client._on_history({"error": "Timed out", "direction": "before"})
+        with pytest.raises(chat_client.HistoryError):
+            await more
+        client._catching_up = True
+        await client._on_message("alice: m6")
+        await client._on_history({"error": "Timed out", "direction": "after"})
+
+    run(scenario())
+    assert errors == [{"data": "Timed out"}, {"data": "Timed out"}]
+    assert [item["message"] for item in received] == ["m5", "m6"]
+
+
+def test_more_returns_older_page():
+    client, received = make_client()
+
+    async def scenario():
+        await client._on_batch(page([message(5)], next_cursor="105.0:5"))
+        assert not client.history_complete
+        more = asyncio.ensure_future(client.more())
+        await asyncio.sleep(0)
+        # The server's cursor, which keeps the messages sent at 105.0 too.
+        assert client.sio.emitted[-1][1]["before"] == "105.0:5"
+        await client._on_history(page([message(3), message(4)], next_cursor="103.0:3"))
+        assert await more == [message(3), message(4)]
+        more = asyncio.ensure_future(client.more())
+        await asyncio.sleep(0)
+        assert client.sio.emitted[-1][1]["before"] == "103.0:3"
+        await client._on_history(page([message(2)]))
+        return await more
+
+    assert [item["id"] for item in run(scenario())] == [2]
+    assert client.oldest_seen == 102.0
+    assert client.history_complete
+    assert len(received) == 1
@@ -0,0 +1,122 @@
+import json
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+msgpack = pytest.importorskip("msgpack")
+
+from chat import codec
+from chat.api import ChatAPI
+from chat.archive import SegmentArchive
+from chat.errors import ChatAPIError
+from chat.retention import RetentionTrimmer
+from chat.storage import StreamMessageStore, ZSetMessageStore
+from test_chat_api import FakeRedis
+
+MESSAGE = {"id": 3, "sender_id": "alice", "timestamp": 1.5, "message": "hi"}
+
+
+@pytest.fixture
+def redis():
+    return FakeRedis()
+
+
+def unpack(page):
+    return [dict(zip(codec.FIELDS, m)) for m in msgpack.unpackb(page["data"])]
+
+
+class TestCodec:
+    @pytest.mark.parametrize("encoding", ["json", "msgpack"])
+    def test_round_trip(self, encoding):
+        assert codec.decode(codec.get_encoder(encoding)(MESSAGE)) == MESSAGE
+
+    def test_msgpack_is_smaller(self):
+        assert len(codec.encode_msgpack(MESSAGE)) < len(codec.encode_json(MESSAGE))
+
+    @pytest.mark.parametrize("encoding", ["json", "msgpack"])
+    def test_with_id(self, encoding):
+        raw = codec.get_encoder(encoding)(
+            {k: v for k, v in MESSAGE.items() if k != "id"}
+        )
+        assert codec.decode(codec.with_id(raw, "5-0"))["id"] == "5-0"
+
+    def test_pack_list(self):
+        raws = [codec.encode_msgpack(dict(MESSAGE, id=i)) for i in range(20)]
+        assert [m[0] for m in msgpack.unpackb(codec.pack_list(raws))] == list(range(20))
+
+    def test_unknown_encoding(self):
+        with pytest.raises(ValueError):
+            codec.get_encoder("xml")
+
+
+class TestEncodedStorage:
+    @pytest.mark.parametrize("store_class", [ZSetMessageStore, StreamMessageStore])
+    def test_mixed_encodings(self, redis, store_class):
+        ChatAPI(redis, store=store_class(redis)).send_message(1, "alice", "old")
+        chat_api = ChatAPI(redis, store=store_class(redis, encoding="msgpack"))
+        new_id = chat_api.send_message(1, "bob", "new")
+        page = chat_api.get_messages_page(1)
+        assert [m["message"] for m in page["messages"]] == ["old", "new"]
+        assert page["messages"][1]["id"] == new_id
+        encoded = chat_api.get_messages_page_encoded(1)
+        assert unpack(encoded) == page["messages"]
+
+    def test_encoded_page_copies_stored_bytes(self, redis):
+        chat_api = ChatAPI(redis, store=ZSetMessageStore(redis, encoding="msgpack"))
+        chat_api.send_message(1, "alice", "hi")
+        stored = redis.zrange("room:1", 0, -1)
+        assert chat_api.get_messages_page_encoded(1)["data"] == b"\x91" + stored[0]
+
+    def test_encoded_page_cursor(self, redis):
+        chat_api = ChatAPI(redis, store=ZSetMessageStore(redis, encoding="msgpack"))
+        for i in range(3):
+            chat_api.send_message(1, "alice", "msg %d" % i)
+        page = chat_api.get_messages_page_encoded(1, limit=2)
+        older = chat_api.get_messages_page_encoded(1, before=page["next_cursor"])
+        assert [m["message"] for m in unpack(older)] == ["msg 0"]
+
+    def test_encoded_page_reads_archive(self, redis, tmp_path):
+        archive = SegmentArchive(str(tmp_path))
+        chat_api = ChatAPI(
+            redis, store=ZSetMessageStore(redis, encoding="msgpack"), archive=archive
+        )
+        for i in range(3):
+            chat_api.send_message(1, "alice", "msg %d" % i)
+        RetentionTrimmer(redis, chat_api.store, archive, {"max_count": 1}).trim_room(1)
+        page = chat_api.get_messages_page_encoded(1)
+        assert [m["message"] for m in unpack(page)] == ["msg 0", "msg 1", "msg 2"]
+
+    def test_unsupported_encoding(self, redis):
+        with pytest.raises(ChatAPIError) as e:
+            ChatAPI(redis).get_messages_page_encoded(1, encoding="xml")
+        assert e.value.get_status_code() == 400
+
+
+class TestRawPages:
+    @pytest.mark.parametrize("encoding", ["json", "msgpack"])
+    def test_json_page_matches_decoded_page(self, redis, encoding):
+        chat_api = ChatAPI(redis, store=ZSetMessageStore(redis, encoding=encoding))
+        for i in range(3):
+            chat_api.send_message(1, "alice", "msg %d" % i)
+        raw = chat_api.get_messages_page_raw(1, limit=2)
+        page = chat_api.get_messages_page(1, limit=2)
+        assert [codec.decode(m) for m in raw["messages"]] == page["messages"]
+        assert raw["next_cursor"] == page["next_cursor"]
+
+    def test_json_page_copies_stored_bytes(self, redis):
+        chat_api = ChatAPI(redis)
+        chat_api.send_message(1, "alice", "hi")
+        stored = redis.zrange("room:1", 0, -1)
+        assert chat_api.get_messages_page_raw(1)["messages"] == stored
+
+    def test_streamed_response(self, redis):
+        routes = pytest.importorskip("chat.routes")
+        chat_api = ChatAPI(redis)
+        for i in range(routes.STREAM_CHUNK + 2):
+            chat_api.send_message(1, "alice", "msg %d" % i)
+        page = chat_api.get_messages_page_raw(1, limit=routes.STREAM_CHUNK + 1)
+        body = json.loads(b"".join(routes._stream_page(page)))
+        assert body == chat_api.get_messages_page(1, limit=routes.STREAM_CHUNK + 1)
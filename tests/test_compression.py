@@ -0,0 +1,124 @@
+import gzip
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+
+from chat import compression
+from chat.api import ChatAPI, page_etag
+from chat.compression import compress, negotiate
+from chat.rooms import DEFAULT_ROOMS
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def gzip_only(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+
+
+@pytest.mark.parametrize(
+    "header, coding",
+    [
+        (None, None),
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("deflate, gzip;q=0.5", "gzip"),
+        ("gzip;q=0", None),
+        ("*", "gzip"),
+        ("*, gzip;q=0", None),
+        ("GZIP;q=abc, br", None),
+    ],
+)
+def test_negotiate(gzip_only, header, coding):
+    assert negotiate(header) == coding
+
+
+def test_negotiate_prefers_brotli():
+    if compression.brotli is None:
+        pytest.skip("brotli is not installed")
+    assert negotiate("gzip, br") == "br"
+    assert negotiate("gzip, br;q=0.5") == "gzip"
+
+
+def test_gzip_is_deterministic():
+    body = b'{"messages": []}' * 100
+    assert compress(body, "gzip") == compress(body, "gzip")
+    assert gzip.decompress(compress(body, "gzip")) == body
+
+
+@pytest.fixture
+def chat_api():
+    chat_api = ChatAPI(fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+    chat_api.rooms.ensure(DEFAULT_ROOMS)
+    return chat_api
+
+
+def test_etag_changes_with_the_page():
+    page = {"messages": [b'{"id": 1}'], "next_cursor": None}
+    assert page_etag(page) == page_etag(dict(page))
+    assert page_etag(page) != page_etag({"messages": [], "next_cursor": None})
+    assert page_etag(page) != page_etag({**page, "next_cursor": "1.0:1"})
+    # Message boundaries are part of the hash.
+    split = {"messages": [b'{"id"', b': 1}'], "next_cursor": None}
+    assert page_etag(page) != page_etag(split)
+
+
+class TestMessagesRoute:
+    @pytest.fixture
+    def app(self, chat_api, monkeypatch, gzip_only):
+        flask = pytest.importorskip("flask")
+        routes = pytest.importorskip("chat.routes")
+        monkeypatch.setattr(routes, "chat_api", chat_api)
+        monkeypatch.setattr(routes, "compress_min_bytes", 256)
+        app = flask.Flask(__name__)
+        app.register_blueprint(routes.bp)
+        return app, routes
+
+    def get(self, app, headers=None):
+        app, routes = app
+        with app.test_request_context("/rooms/1/messages", headers=headers):
+            response = routes.get_messages("1")
+            response.direct_passthrough = False
+            return response.status_code, response.headers, response.get_data()
+
+    def test_not_modified_until_sent(self, app, chat_api):
+        chat_api.send_message(1, "alice", "hi")
+        status, headers, body = self.get(app)
+        assert status == 200
+        etag = headers["ETag"]
+        assert etag == 'W/"%s"' % page_etag(chat_api.get_messages_page_raw(1))
+        assert headers["Cache-Control"] == "no-cache"
+        assert len(json.loads(body)["messages"]) == 1
+        status, _, body = self.get(app, {"If-None-Match": etag})
+        assert status == 304
+        chat_api.send_message(1, "alice", "hi again")
+        status, headers, _ = self.get(app, {"If-None-Match": etag})
+        assert status == 200
+        assert headers["ETag"] != etag
+
+    def test_compressed_above_threshold(self, app, chat_api):
+        chat_api.send_message(1, "alice", "hi")
+        _, headers, _ = self.get(app, {"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in headers
+        for i in range(20):
+            chat_api.send_message(1, "alice", "message %d" % i)
+        status, headers, body = self.get(app, {"Accept-Encoding": "gzip"})
+        assert status == 200
+        assert headers["Content-Encoding"] == "gzip"
+        assert headers["Vary"] == "Accept-Encoding"
+        assert len(json.loads(gzip.decompress(body))["messages"]) == 21
+        # The second request is served from the compressed cache.
+        assert self.get(app, {"Accept-Encoding": "gzip"})[2] == body
+
+    def test_compression_disabled(self, app, chat_api, monkeypatch):
+        monkeypatch.setattr(app[1], "compress_responses", False)
+        for i in range(20):
+            chat_api.send_message(1, "alice", "message %d" % i)
+        _, headers, body = self.get(app, {"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in headers
+        assert len(json.loads(body)["messages"]) == 20
@@ -0,0 +1,307 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+
+from chat.api import ChatAPI
+from chat.cache import ChatCache
+from chat.connection import (
+    CircuitBreaker,
+    CircuitOpenError,
+    PoolTimeoutError,
+    async_redis_from_env,
+    protect,
+    redis_from_env,
+    redis_settings,
+)
+from chat.errors import ChatAPIError
+from chat.models import ChatRoom
+from chat.rooms import RoomRegistry
+from chat.storage import ZSetMessageStore
+from test_chat_api import FakeRedis
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SlowRedisServer:
+    """A local server answering every command with PONG after ``delay``.
+
+    With ``delay=None`` it accepts connections and never answers.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.commands = 0
+        self._socket = socket.socket()
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.listen(16)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while conn.recv(65536):
+                self.commands += 1
+                if self.delay is None:
+                    continue
+                time.sleep(self.delay)
+                conn.sendall(b"+PONG\r\n")
+
+    def close(self):
+        self._socket.close()
+
+    def client(self, **settings):
+        environ = {"REDIS_HOST": "127.0.0.1", "REDIS_PORT": str(self.port)}
+        environ.update(
+            {"REDIS_%s" % name.upper(): str(value) for name, value in settings.items()}
+        )
+        return redis_from_env(environ=environ)
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(delay=0.0):
+        servers.append(SlowRedisServer(delay))
+        return servers[-1]
+
+    yield start
+    for s in servers:
+        s.close()
+
+
+class FailingRedis:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def execute_command(self, *args, **options):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return b"PONG"
+
+    def pipeline(self):
+        return FailingPipeline(self)
+
+
+class FailingPipeline:
+    def __init__(self, redis):
+        self.redis = redis
+
+    def execute(self):
+        return [FailingRedis.execute_command(self.redis, "PING")]
+
+
+def test_redis_settings():
+    settings = redis_settings(
+        "REDIS_REPLICA",
+        {"REDIS_REPLICA_HOST": "replica", "REDIS_REPLICA_SOCKET_TIMEOUT": "0.5"},
+    )
+    assert settings["HOST"] == "replica"
+    assert settings["PORT"] == 6379
+    assert settings["SOCKET_TIMEOUT"] == 0.5
+
+
+def test_async_client_settings():
+    redis = async_redis_from_env(
+        environ={"REDIS_MAX_CONNECTIONS": "7", "REDIS_SOCKET_TIMEOUT": "0.5"}
+    )
+    pool = redis.connection_pool
+    assert pool.max_connections == 7
+    assert pool.timeout == 1.0
+    assert pool.connection_kwargs["socket_timeout"] == 0.5
+    assert pool.connection_kwargs["health_check_interval"] == 30
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold(self):
+        clock = Clock()
+        breaker = CircuitBreaker(threshold=2, reset_timeout=5, clock=clock)
+        redis = protect(FailingRedis(ConnectionError("down")), breaker)
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                redis.execute_command("PING")
+        with pytest.raises(CircuitOpenError) as e:
+            redis.execute_command("PING")
+        assert e.value.retry_after == 5
+        assert breaker.retry_after() == 5
+        assert redis.calls == 2
+
+    def test_trial_call_closes(self):
+        clock = Clock()
+        breaker = CircuitBreaker(threshold=1, reset_timeout=5, clock=clock)
+        failing = FailingRedis(ConnectionError("down"))
+        redis = protect(failing, breaker)
+        with pytest.raises(ConnectionError):
+            redis.execute_command("PING")
+        clock.now += 5
+        assert breaker.retry_after() == 0
+        failing.error = None
+        assert redis.pipeline().execute() == [b"PONG"]
+        assert not breaker.is_open
+        assert redis.execute_command("PING") == b"PONG"
+
+    def test_failed_trial_reopens(self):
+        clock = Clock()
+        breaker = CircuitBreaker(threshold=3, reset_timeout=5, clock=clock)
+        redis = protect(FailingRedis(TimeoutError("slow")), breaker)
+        for _ in range(3):
+            with pytest.raises(TimeoutError):
+                redis.execute_command("PING")
+        clock.now += 5
+        with pytest.raises(TimeoutError):
+            redis.execute_command("PING")
+        with pytest.raises(CircuitOpenError):
+            redis.execute_command("PING")
+
+    def test_one_trial_at_a_time(self):
+        clock = Clock()
+        breaker = CircuitBreaker(threshold=1, reset_timeout=5, clock=clock)
+        breaker.failure()
+        clock.now += 5
+        breaker.before_call()
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+        assert breaker.is_open
+        breaker.success()
+        breaker.before_call()
+
+    def test_error_replies_do_not_count(self):
+        breaker = CircuitBreaker(threshold=1)
+        redis = protect(FailingRedis(ResponseError("WRONGTYPE")), breaker)
+        with pytest.raises(ResponseError):
+            redis.execute_command("GET", "key")
+        assert not breaker.is_open
+
+
+class TestTimeouts:
+    """A real client against a local server that answers slowly or never."""
+
+    def test_slow_reply_within_timeout(self, server):
+        redis = server(delay=0.05).client(socket_timeout=1)
+        assert redis.ping()
+
+    def test_read_timeout(self, server):
+        redis = server(delay=None).client(socket_timeout=0.1)
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            redis.ping()
+        assert time.monotonic() - start < 1
+
+    def test_pool_timeout(self, server):
+        redis = server(delay=0.0).client(max_connections=1, pool_timeout=0.1)
+        held = redis.connection_pool.get_connection("PING")
+        try:
+            start = time.monotonic()
+            with pytest.raises(PoolTimeoutError):
+                redis.ping()
+            assert time.monotonic() - start < 1
+        finally:
+            redis.connection_pool.release(held)
+        assert redis.ping()
+
+    def test_pool_timeouts_do_not_open_breaker(self, server):
+        breaker = CircuitBreaker(threshold=1)
+        redis = server(delay=0.0).client(max_connections=1, pool_timeout=0.05)
+        held = redis.connection_pool.get_connection("PING")
+        try:
+            protected = protect(redis, breaker)
+            for _ in range(3):
+                with pytest.raises(PoolTimeoutError):
+                    protected.ping()
+            assert not breaker.is_open
+        finally:
+            redis.connection_pool.release(held)
+
+    def test_breaker_fails_fast(self, server):
+        stalled = server(delay=None)
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        redis = protect(stalled.client(socket_timeout=0.1), breaker)
+        for _ in range(2):
+            with pytest.raises(TimeoutError):
+                redis.ping()
+        sent = stalled.commands
+        start = time.monotonic()
+        for _ in range(100):
+            with pytest.raises(CircuitOpenError):
+                redis.ping()
+        assert time.monotonic() - start < 0.1
+        assert stalled.commands == sent
+
+
+class TestReplicaRouting:
+    def test_pages_and_rooms_read_from_replica(self):
+        primary, replica = FakeRedis(), FakeRedis()
+        chat_api = ChatAPI(
+            primary,
+            cache=ChatCache(primary, history_bytes=0),
+            store=ZSetMessageStore(primary, replica=replica),
+            replica=replica,
+        )
+        chat_api.send_message(1, "alice", "hello")
+        assert primary.zcard("room:1") == 1
+        # The replica has not caught up yet.
+        assert chat_api.get_messages_page(1)["messages"] == []
+        RoomRegistry(replica).ensure([ChatRoom(id=1, topic="cats")])
+        assert chat_api.get_rooms() == [{"id": 1, "topic": "cats"}]
+
+    def test_history_cache_filled_from_primary(self):
+        primary, replica = FakeRedis(), FakeRedis()
+        chat_api = ChatAPI(
+            primary, store=ZSetMessageStore(primary, replica=replica), replica=replica
+        )
+        chat_api.send_message(1, "alice", "hello")
+        messages = chat_api.get_messages_page(1)["messages"]
+        assert [m["message"] for m in messages] == ["hello"]
+
+
+def test_open_circuit_mid_request_is_503():
+    error = ChatAPIError("Error getting messages", 422, CircuitOpenError(3))
+    assert error.get_status_code() == 503
+    try:
+        try:
+            raise CircuitOpenError(3)
+        except ConnectionError as e:
+            raise ChatAPIError("Error sending message", 422) from e
+    except ChatAPIError as e:
+        assert e.get_status_code() == 503
+    assert ChatAPIError("Error", 422, ConnectionError()).get_status_code() == 422
+
+
+def test_requests_fail_fast_while_open(monkeypatch):
+    flask = pytest.importorskip("flask")
+    routes = pytest.importorskip("chat.routes")
+    breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.failure()
+    monkeypatch.setattr(routes, "breaker", breaker)
+    app = flask.Flask(__name__)
+    app.register_blueprint(routes.bp)
+    with app.test_request_context("/rooms"):
+        response, status = routes.fail_fast()
+        assert status == 503
+        assert response.headers["Retry-After"] == "30"
+    with app.test_request_context("/metrics"):
+        assert routes.fail_fast() is None
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from chat.fanout import FanoutScheduler
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data, to=None):
+        self.sent.append(("message", data, to))
+
+    def emit(self, event, *data, to=None):
+        self.sent.append((event, *data, to))
+
+
+class TestFanoutScheduler:
+    def test_quiet_room_sends_at_once(self):
+        socketio = FakeSocketIO()
+        fanout = FanoutScheduler(socketio, window=60)
+        fanout.send("1", "alice: hi")
+        fanout.send("2", "bob: hi")
+        assert socketio.sent == [
+            ("message", "alice: hi", "1"),
+            ("message", "bob: hi", "2"),
+        ]
+
+    def test_busy_room_is_batched(self):
+        socketio = FakeSocketIO()
+        fanout = FanoutScheduler(socketio, window=60)
+        for i in range(4):
+            fanout.send("1", "alice: %d" % i)
+        assert len(socketio.sent) == 1
+        fanout.flush()
+        assert len(socketio.sent) == 1
+        fanout.flush(now=time.monotonic() + 60)
+        assert socketio.sent[1] == (
+            "message_batch",
+            {
+                "messages": ["alice: 1", "alice: 2", "alice: 3"],
+                "meta": [None, None, None],
+                "dropped": 0,
+            },
+            "1",
+        )
+
+    def test_single_queued_message_is_sent_alone(self):
+        socketio = FakeSocketIO()
+        fanout = FanoutScheduler(socketio, window=60)
+        fanout.send("1", "alice: 0")
+        fanout.send("1", "alice: 1")
+        fanout.flush(now=time.monotonic() + 60)
+        assert socketio.sent[-1] == ("message", "alice: 1", "1")
+
+    def test_overflow_drops_oldest(self):
+        socketio = FakeSocketIO()
+        fanout = FanoutScheduler(socketio, window=60, max_pending=2)
+        for i in range(5):
+            fanout.send("1", "alice: %d" % i, {"id": i})
+        fanout.flush(now=time.monotonic() + 60)
+        assert socketio.sent[-1][1] == {
+            "messages": ["alice: 3", "alice: 4"],
+            "meta": [{"id": 3}, {"id": 4}],
+            "dropped": 2,
+        }
+
+    def test_stored_message_sent_with_meta(self):
+        socketio = FakeSocketIO()
+        fanout = FanoutScheduler(socketio, window=60)
+        meta = {"id": 1, "timestamp": 100.0}
+        fanout.send("1", "alice: hi", meta)
+        assert socketio.sent == [("message", "alice: hi", meta, "1")]
+
+    def test_notice_skipped_in_busy_room(self):
+        socketio = FakeSocketIO()
+        fanout = FanoutScheduler(socketio, window=60)
+        fanout.send("1", "alice: 0")
+        fanout.send("1", "alice: 1")
+        fanout.send_notice("1", "bob has entered the room.")
+        fanout.send_notice("2", "bob has entered the room.")
+        fanout.flush(now=time.monotonic() + 60)
+        assert ("message", "bob has entered the room.", "1") not in socketio.sent
+        assert ("message", "bob has entered the room.", "2") in socketio.sent
+
+    def test_background_flush(self):
+        socketio = FakeSocketIO()
+        fanout = FanoutScheduler(socketio, window=0.01)
+        fanout.start()
+        fanout.send("1", "alice: 0")
+        fanout.send("1", "alice: 1")
+        fanout.send("1", "alice: 2")
+        deadline = time.monotonic() + 5
+        while len(socketio.sent) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert socketio.sent[1][0] == "message_batch"
+
+    def test_quiet_rooms_are_forgotten(self, monkeypatch):
+        monkeypatch.setattr("chat.fanout.PRUNE_INTERVAL", 0)
+        fanout = FanoutScheduler(FakeSocketIO(), window=0.01)
+        for room in range(100):
+            fanout.send(str(room), "alice: hi")
+        time.sleep(0.02)
+        fanout.send("1", "alice: hi again")
+        assert list(fanout._last_sent) == ["1"]
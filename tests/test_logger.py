@@ -0,0 +1,35 @@
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from chat.logger import JsonFormatter, SamplingFilter, _QueueHandler
+
+
+def make_record(level=logging.INFO, msg="hello %s", args=("world",)):
+    return logging.LogRecord("chat", level, __file__, 1, msg, args, None)
+
+
+class TestSamplingFilter:
+    def test_drops_info_at_zero_rate(self):
+        assert not SamplingFilter(0.0).filter(make_record())
+
+    def test_keeps_warnings(self):
+        assert SamplingFilter(0.0).filter(make_record(logging.WARNING))
+
+
+class TestJsonFormatter:
+    def test_format(self):
+        entry = json.loads(JsonFormatter().format(make_record()))
+        assert entry["message"] == "hello world"
+        assert entry["level"] == "INFO"
+
+
+class TestQueueHandler:
+    def test_prepare_merges_args_only(self):
+        handler = _QueueHandler(None)
+        record = handler.prepare(make_record())
+        assert record.msg == "hello world"
+        assert record.args is None
@@ -0,0 +1,70 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+pytest.importorskip("prometheus_client")
+from prometheus_client import REGISTRY
+
+from chat import metrics
+from chat.api import ChatAPI
+from chat.errors import ChatAPIError
+from test_chat_api import FakeRedis
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestInstrumentAPI:
+    @pytest.fixture
+    def chat_api(self):
+        redis = FakeRedis()
+        redis.sadd("rooms_ids", 1)
+        return metrics.instrument_api(ChatAPI(redis))
+
+    def test_latency_and_messages(self, chat_api):
+        count = sample("chat_api_latency_seconds_count", method="send_message")
+        messages = sample("chat_messages_total", room="1")
+        chat_api.send_message(1, "alice", "hello")
+        assert sample("chat_api_latency_seconds_count", method="send_message") == count + 1
+        assert sample("chat_messages_total", room="1") == messages + 1
+
+    def test_unknown_rooms_share_a_label(self, chat_api):
+        others = sample("chat_messages_total", room="other")
+        chat_api.send_message("01", "alice", "hello")
+        chat_api.send_message(99, "alice", "hello")
+        assert sample("chat_messages_total", room="other") == others + 2
+        assert sample("chat_messages_total", room="01") == 0
+
+    def test_errors_by_status_code(self, chat_api):
+        errors = sample("chat_api_errors_total", method="join_room", status_code="404")
+        with pytest.raises(ChatAPIError):
+            chat_api.join_room(2, "alice")
+        assert (
+            sample("chat_api_errors_total", method="join_room", status_code="404")
+            == errors + 1
+        )
+
+
+class TestInstrumentHandler:
+    def test_errors_counted_and_raised(self):
+        def on_boom(data):
+            raise KeyError("room")
+
+        errors = sample("chat_socket_handler_errors_total", event="boom")
+        with pytest.raises(KeyError):
+            metrics.instrument_handler("boom", on_boom)({})
+        assert sample("chat_socket_handler_errors_total", event="boom") == errors + 1
+
+    def test_rejects_arguments_it_does_not_take(self):
+        with pytest.raises(TypeError):
+            metrics.instrument_handler("connect", lambda: None)({"auth": 1})
+
+
+def test_room_sessions_collector():
+    collector = metrics.RoomSessionsCollector(lambda: {1: 3})
+    (family,) = collector.collect()
+    assert [(s.labels, s.value) for s in family.samples] == [({"room": "1"}, 3)]
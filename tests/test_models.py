@@ -0,0 +1,110 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from pydantic import ValidationError
+
+from chat.codec import available_encodings, decode, get_encoder, get_model_encoder
+from chat.models import Message, User, new_message, set_id, validate_username
+
+USERNAMES = [
+    "alice",
+    "bob_the-2nd",
+    "abc",
+    "a" * 16,
+    "ab",
+    "a" * 17,
+    "",
+    "alice\n",
+    "\nalice",
+    "al ice",
+    "al.ice",
+    "élise",
+    "ａｌｉｃｅ",
+    "alice\x00",
+    b"alice",
+    b"al ice",
+    12345,
+    None,
+    ["alice"],
+]
+
+
+def outcome(validate, *args):
+    try:
+        return ("ok", validate(*args))
+    except ValidationError as e:
+        return ("error", [error["type"] for error in e.errors()])
+
+
+@pytest.mark.parametrize("name", USERNAMES)
+def test_validate_username_matches_model(name):
+    expected = outcome(lambda n: User(name=n).name, name)
+    assert outcome(validate_username, name) == expected
+    # Once more, from the cache.
+    assert outcome(validate_username, name) == expected
+
+
+MESSAGES = ["hi", "x" * 144, "x" * 145, "", "héllo ✓", b"bytes", 42, None]
+
+
+@pytest.mark.parametrize("text", MESSAGES)
+def test_new_message_matches_model(text):
+    def model(sender_id, message, timestamp):
+        user = User(name=sender_id)
+        return Message(sender_id=user.name, timestamp=timestamp, message=message)
+
+    assert outcome(new_message, "alice", text, 1.5) == outcome(
+        model, "alice", text, 1.5
+    )
+
+
+def test_set_id_matches_setattr():
+    fast, model = new_message("alice", "hi", 1.5), new_message("alice", "hi", 1.5)
+    set_id(fast, 7)
+    model.id = 7
+    assert fast == model
+    assert fast.model_fields_set == model.model_fields_set
+    assert fast.model_dump(exclude_unset=True) == model.model_dump(exclude_unset=True)
+
+
+def test_set_id_validates_when_the_model_does(monkeypatch):
+    class Validated(Message):
+        model_config = {"validate_assignment": True}
+
+    msg = Validated(sender_id="alice", timestamp=1.5, message="hi")
+    set_id(msg, "1-0")
+    assert msg.id == "1-0"
+    with pytest.raises(ValidationError):
+        set_id(msg, 1.5)
+    monkeypatch.setattr("chat.models._FAST_SET_ID", False)
+    plain = new_message("alice", "hi", 1.5)
+    set_id(plain, 7)
+    assert plain.id == 7 and "id" in plain.model_fields_set
+
+
+@pytest.mark.parametrize("encoding", available_encodings())
+def test_model_encoder(encoding):
+    encode = get_model_encoder(encoding)
+    msg = new_message("alice", "héllo ✓", 1792351076.291216)
+    msg.id = 7
+    encode_dict = get_encoder(encoding)
+    assert decode(encode(msg)) == decode(encode_dict(msg.model_dump()))
+    assert decode(encode(msg, exclude={"id"})) == decode(
+        encode_dict(msg.model_dump(exclude={"id"}))
+    )
+
+
+def test_json_encoder_writes_bytes():
+    msg = new_message("alice", "hi", 1.5)
+    raw = get_model_encoder("json")(msg)
+    assert isinstance(raw, bytes)
+    assert json.loads(raw) == {
+        "id": None,
+        "sender_id": "alice",
+        "timestamp": 1.5,
+        "message": "hi",
+    }
@@ -0,0 +1,162 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+
+from chat.api import ChatAPI
+from chat.errors import ChatAPIError
+from chat.presence import PresenceTracker, summarize
+from test_chat_api import FakeRedis
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def notifications():
+    return []
+
+
+@pytest.fixture
+def presence(clock, notifications):
+    redis = FakeRedis()
+    redis.sadd("rooms_ids", 1, 2)
+    tracker = PresenceTracker(redis, ttl=30, grace=5, clock=clock)
+    tracker.notify = lambda room, joined, left: notifications.append(
+        (room, joined, left)
+    )
+    return tracker
+
+
+def usernames(presence, room):
+    return [user["username"] for user in presence.online(room)]
+
+
+class TestPresenceTracker:
+    def test_join_and_online(self, presence, clock):
+        presence.join("sid1", "1", "alice")
+        clock.now += 1
+        presence.join("sid2", "1", "bob")
+        assert usernames(presence, "1") == ["bob", "alice"]
+        assert presence.online("1")[0]["last_seen"] == clock.now
+        assert presence.online("2") == []
+
+    def test_joins_are_coalesced(self, presence, notifications):
+        for i in range(5):
+            presence.join("sid%d" % i, "1", "user%d" % i)
+        presence.flush()
+        assert notifications == [
+            ("1", ["user0", "user1", "user2", "user3", "user4"], [])
+        ]
+        presence.flush()
+        assert len(notifications) == 1
+
+    def test_leave_expires_after_grace(self, presence, clock, notifications):
+        presence.join("sid1", "1", "alice")
+        presence.flush()
+        presence.leave("sid1")
+        assert usernames(presence, "1") == ["alice"]
+        assert presence.sweep() == {}
+        clock.now += 6
+        assert presence.sweep() == {"1": ["alice"]}
+        assert usernames(presence, "1") == []
+        presence.flush()
+        assert notifications[-1] == ("1", [], ["alice"])
+
+    def test_reconnect_is_not_announced(self, presence, clock, notifications):
+        presence.join("sid1", "1", "alice")
+        presence.flush()
+        presence.leave("sid1")
+        clock.now += 2
+        presence.join("sid2", "1", "alice")
+        clock.now += 10
+        assert presence.sweep() == {}
+        presence.flush()
+        assert notifications == [("1", ["alice"], [])]
+
+    def test_user_online_while_a_session_remains(self, presence, clock):
+        presence.join("sid1", "1", "alice")
+        presence.join("sid2", "1", "alice")
+        presence.leave("sid1")
+        clock.now += 10
+        presence.heartbeat()
+        clock.now += 25
+        assert presence.sweep() == {}
+        assert usernames(presence, "1") == ["alice"]
+
+    def test_dead_worker_sessions_expire(self, presence, clock):
+        other = PresenceTracker(presence.redis, ttl=30, clock=clock)
+        other.join("sid1", "1", "alice")
+        presence.join("sid2", "1", "bob")
+        clock.now += 20
+        presence.heartbeat()
+        clock.now += 15
+        assert presence.sweep() == {"1": ["alice"]}
+        assert usernames(presence, "1") == ["bob"]
+        # Another worker sweeping at the same time does not announce it again.
+        assert other.sweep() == {}
+
+    def test_join_and_leave_cancel_out(self, presence, clock, notifications):
+        presence.join("sid1", "1", "alice")
+        presence.leave("sid1")
+        clock.now += 6
+        presence.sweep()
+        presence.flush()
+        assert notifications == []
+
+    def test_rejoin_before_sweep(self, clock):
+        redis = FakeRedis()
+        presence = PresenceTracker(redis, ttl=30, grace=5, clock=clock)
+        presence.join("sid1", "1", "alice")
+        presence.join("sid2", "1", "bob")
+        presence.leave("sid1")
+        clock.now += 6
+        # Back after the grace, but before any sweep: she stays online.
+        presence.join("sid3", "1", "alice")
+        assert presence.sweep(["1"]) == {}
+        assert redis.hget(presence.conns_key("1"), "alice") == b"1"
+        presence.leave("sid3")
+        presence.leave("sid2")
+        clock.now += 6
+        assert presence.sweep(["1"]) == {"1": ["alice", "bob"]}
+        assert not redis.exists(presence.key("1"), presence.conns_key("1"))
+
+    def test_summarize(self):
+        assert summarize(["alice"], "entered") == "alice has entered the room."
+        assert summarize(["a", "b"], "left") == "a, b have left the room."
+        assert (
+            summarize(["a", "b", "c", "d", "e"], "entered")
+            == "a, b, c and 2 others have entered the room."
+        )
+
+
+class TestGetPresence:
+    def test_get_presence(self, presence):
+        chat_api = ChatAPI(presence.redis, presence=presence)
+        presence.join("sid1", "1", "alice")
+        result = chat_api.get_presence("1")
+        assert result["count"] == 1
+        assert result["online"][0]["username"] == "alice"
+
+    def test_unknown_room(self, presence):
+        chat_api = ChatAPI(presence.redis, presence=presence)
+        with pytest.raises(ChatAPIError) as e:
+            chat_api.get_presence("9")
+        assert e.value.get_status_code() == 404
+
+    def test_disabled(self):
+        with pytest.raises(ChatAPIError):
+            ChatAPI(FakeRedis()).get_presence("1")
@@ -0,0 +1,131 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from redis.exceptions import ConnectionError, ResponseError
+
+from chat.api import ChatAPI
+from chat.batching import MessageBatcher
+from chat.errors import RateLimitedError
+from chat.ratelimit import Limit, RateLimiter, parse_limit
+from test_chat_api import FakeRedis
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class StubLimiter:
+    def __init__(self, wait=0, error=None):
+        self.wait = wait
+        self.error = error
+        self.hits = []
+
+    def hit(self, user=None, room=None, ip=None):
+        self.hits.append((user, room, ip))
+        if self.error is not None:
+            raise self.error
+        return self.wait
+
+
+def test_parse_limit():
+    assert parse_limit("20/10") == Limit(rate=2.0, burst=20)
+    assert parse_limit("5") == Limit(rate=5.0, burst=5)
+    assert parse_limit("") is None
+    with pytest.raises(ValueError):
+        parse_limit("0/10")
+
+
+class TestRateLimiter:
+    @pytest.fixture
+    def redis(self):
+        return FakeRedis()
+
+    @pytest.fixture
+    def clock(self):
+        return Clock()
+
+    def test_burst_then_refill(self, redis, clock):
+        limiter = RateLimiter(redis, user=Limit(rate=1.0, burst=3), clock=clock)
+        assert [limiter.hit(user="alice") for _ in range(3)] == [0, 0, 0]
+        assert limiter.hit(user="alice") == pytest.approx(1.0)
+        assert limiter.hit(user="bob") == 0
+        clock.now += 1
+        assert limiter.hit(user="alice") == 0
+
+    def test_local_precheck(self, redis, clock):
+        limiter = RateLimiter(redis, user=Limit(rate=1.0, burst=1), clock=clock)
+        limiter.hit(user="alice")
+        assert limiter.hit(user="alice") > 0
+        redis.delete(limiter.key("user", "alice"))
+        # Rejected from the remembered wait, without asking Redis.
+        clock.now += 0.5
+        assert limiter.hit(user="alice") == pytest.approx(0.5)
+
+    def test_all_buckets_or_none(self, redis, clock):
+        limiter = RateLimiter(
+            redis,
+            user=Limit(rate=1.0, burst=5),
+            room=Limit(rate=1.0, burst=1),
+            clock=clock,
+        )
+        assert limiter.hit(user="alice", room="1") == 0
+        assert limiter.hit(user="alice", room="1") > 0
+        # The rejected message took no token from alice's bucket.
+        tokens = float(redis.hget(limiter.key("user", "alice"), "tokens"))
+        assert tokens == pytest.approx(4)
+        assert limiter.hit(user="alice", room="2") == 0
+
+    def test_scopes_without_limit(self, redis, clock):
+        limiter = RateLimiter(redis, ip=Limit(rate=1.0, burst=1), clock=clock)
+        assert limiter.hit(user="alice", room="1") == 0
+        assert limiter.hit(user="alice", room="1") == 0
+        assert limiter.hit(user="alice", ip="10.0.0.1") == 0
+        assert limiter.hit(user="bob", ip="10.0.0.1") > 0
+
+
+class TestChatAPIRateLimits:
+    def test_send_message_rate_limited(self):
+        redis = FakeRedis()
+        limiter = StubLimiter(wait=2.5)
+        chat_api = ChatAPI(redis, limiter=limiter)
+        with pytest.raises(RateLimitedError) as e:
+            chat_api.send_message("1", "alice", "hi", client_ip="10.0.0.1")
+        assert e.value.get_status_code() == 429
+        assert e.value.retry_after == 2.5
+        assert limiter.hits == [("alice", "1", "10.0.0.1")]
+        assert redis.zcard("room:1") == 0
+
+    def test_send_message_allowed(self):
+        redis = FakeRedis()
+        chat_api = ChatAPI(redis, limiter=StubLimiter())
+        assert chat_api.send_message("1", "alice", "hi") is not None
+
+    def test_rate_key_replaces_sender(self):
+        limiter = StubLimiter()
+        chat_api = ChatAPI(FakeRedis(), limiter=limiter)
+        chat_api.send_message(
+            "1", "alice", "hi", client_ip="10.0.0.1", rate_key="sid:a"
+        )
+        assert limiter.hits == [("sid:a", "1", "10.0.0.1")]
+
+    def test_fails_open_only_while_redis_is_down(self):
+        limiter = StubLimiter(error=ConnectionError("down"))
+        chat_api = ChatAPI(FakeRedis(), limiter=limiter)
+        assert chat_api.send_message("1", "alice", "hi") is not None
+        limiter.error = ResponseError("NOSCRIPT")
+        with pytest.raises(ResponseError):
+            chat_api.send_message("1", "alice", "hi")
+
+    def test_batcher_checks_rate(self):
+        chat_api = ChatAPI(FakeRedis(), limiter=StubLimiter(wait=1))
+        batcher = MessageBatcher(chat_api)
+        with pytest.raises(RateLimitedError):
+            batcher.submit("1", "alice", "hi", lambda msg, error, duplicate: None)
@@ -0,0 +1,136 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from chat.api import ChatAPI
+from chat.archive import SegmentArchive
+from chat.retention import RetentionTrimmer, set_policy
+from chat.storage import StreamMessageStore
+from test_chat_api import FakeRedis
+
+
+@pytest.fixture
+def redis():
+    redis = FakeRedis()
+    redis.sadd("rooms_ids", 1)
+    return redis
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return SegmentArchive(str(tmp_path))
+
+
+def send(chat_api, count):
+    for i in range(count):
+        chat_api.send_message(1, "alice", "msg %d" % i)
+
+
+def texts(messages):
+    return [m["message"] for m in messages]
+
+
+class TestSegmentArchive:
+    def test_page(self, archive):
+        messages = [{"id": i, "timestamp": float(i), "message": "m"} for i in range(6)]
+        archive.write(1, messages[:3])
+        archive.write(1, messages[3:])
+        assert [m["id"] for m in archive.page(1, limit=4)] == [2, 3, 4, 5]
+        assert [m["id"] for m in archive.page(1, before=4.0, limit=2)] == [2, 3]
+        assert [m["id"] for m in archive.page(1, after=1.0, limit=3)] == [2, 3, 4]
+        assert archive.page(2) == []
+
+    def test_duplicates_dropped(self, archive):
+        messages = [{"id": i, "timestamp": float(i), "message": "m"} for i in range(3)]
+        archive.write(1, messages)
+        archive.write(1, messages)
+        assert [m["id"] for m in archive.page(1)] == [0, 1, 2]
+
+
+class TestRetentionTrimmer:
+    @pytest.fixture
+    def chat_api(self, redis, archive):
+        return ChatAPI(redis, archive=archive)
+
+    def test_max_count(self, chat_api, redis, archive):
+        send(chat_api, 5)
+        trimmer = RetentionTrimmer(redis, chat_api.store, archive, {"max_count": 2})
+        assert trimmer.trim() == {"1": 3}
+        assert texts(chat_api.get_messages(1)) == ["msg 3", "msg 4"]
+        assert texts(archive.page(1)) == ["msg 0", "msg 1", "msg 2"]
+        assert trimmer.trim() == {"1": 0}
+
+    def test_max_age(self, chat_api, redis, archive):
+        send(chat_api, 3)
+        newest = chat_api.get_messages(1)[-1]["timestamp"]
+        trimmer = RetentionTrimmer(redis, chat_api.store, archive, {"max_age": 10})
+        assert trimmer.trim_room(1, now=newest + 5) == 0
+        assert trimmer.trim_room(1, now=newest + 20) == 3
+
+    def test_room_policy_overrides_default(self, chat_api, redis, archive):
+        send(chat_api, 4)
+        set_policy(redis, 1, max_count=3)
+        trimmer = RetentionTrimmer(redis, chat_api.store, archive, {"max_count": 1})
+        assert trimmer.trim_room(1) == 1
+        set_policy(redis, 1)
+        assert trimmer.trim_room(1) == 2
+
+    def test_locked_room_skipped(self, chat_api, redis, archive):
+        send(chat_api, 3)
+        redis.set("room:1:trim_lock", "other")
+        trimmer = RetentionTrimmer(redis, chat_api.store, archive, {"max_count": 1})
+        assert trimmer.trim_room(1) == 0
+
+    def test_stream_store(self, redis, archive):
+        chat_api = ChatAPI(redis, store=StreamMessageStore(redis), archive=archive)
+        send(chat_api, 4)
+        trimmer = RetentionTrimmer(redis, chat_api.store, archive, {"max_count": 1})
+        assert trimmer.trim_room(1) == 3
+        assert texts(chat_api.get_messages(1)) == ["msg 3"]
+        page = chat_api.get_messages_page(1, limit=3)
+        assert texts(page["messages"]) == ["msg 1", "msg 2", "msg 3"]
+
+
+class TestReadThrough:
+    @pytest.fixture
+    def chat_api(self, redis, archive):
+        chat_api = ChatAPI(redis, archive=archive)
+        send(chat_api, 6)
+        RetentionTrimmer(redis, chat_api.store, archive, {"max_count": 2}).trim()
+        return chat_api
+
+    def test_latest_page_continues_in_archive(self, chat_api):
+        page = chat_api.get_messages_page(1, limit=3)
+        assert texts(page["messages"]) == ["msg 3", "msg 4", "msg 5"]
+        older = chat_api.get_messages_page(1, before=page["next_cursor"], limit=3)
+        assert texts(older["messages"]) == ["msg 0", "msg 1", "msg 2"]
+        oldest = chat_api.get_messages_page(1, before=older["next_cursor"], limit=3)
+        assert oldest == {"messages": [], "next_cursor": None}
+
+    def test_after_cursor_in_archive(self, chat_api):
+        first = chat_api.get_messages_page(1, limit=6)["messages"][0]
+        page = chat_api.get_messages_page(1, after=first["timestamp"], limit=4)
+        assert texts(page["messages"]) == ["msg 1", "msg 2", "msg 3", "msg 4"]
+        rest = chat_api.get_messages_page(1, after=page["next_cursor"], limit=4)
+        assert texts(rest["messages"]) == ["msg 5"]
+        assert rest["next_cursor"] is None
+
+    def test_archive_read_only_for_archived_rooms(self, chat_api, redis, archive):
+        redis.sadd("rooms_ids", 2)
+        chat_api.send_message(2, "alice", "hi")
+        listed = []
+        segments = archive.segments
+        archive.segments = lambda room_id: listed.append(room_id) or segments(room_id)
+        assert texts(chat_api.get_messages_page(2, after=0.0)["messages"]) == ["hi"]
+        page = chat_api.get_messages_page(1, after=0.0, limit=2)
+        assert texts(page["messages"]) == ["msg 0", "msg 1"]
+        assert listed == [1]
+
+    def test_existing_archives_marked(self, redis, archive):
+        archive.write(3, [{"id": 1, "timestamp": 1.0, "message": "old"}])
+        chat_api = ChatAPI(redis, archive=archive)
+        RetentionTrimmer(redis, chat_api.store, archive, {"max_count": 2}).trim([])
+        assert texts(chat_api.get_messages_page(3)["messages"]) == ["old"]
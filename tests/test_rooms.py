@@ -0,0 +1,229 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from pydantic import ValidationError
+
+from chat.api import ChatAPI
+from chat.errors import ChatAPIError
+from chat.migrate import migrate_rooms
+from chat.models import ChatRoom
+from chat.rooms import ACTIVITY_INTERVAL, DEFAULT_ROOMS, SORTS, RoomRegistry
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+@pytest.fixture
+def rooms(redis):
+    return RoomRegistry(redis, clock=Clock())
+
+
+def topics(page):
+    return [room["topic"] for room in page["rooms"]]
+
+
+class TestRoomRegistry:
+    def test_pages_in_id_order(self, rooms):
+        rooms.ensure(DEFAULT_ROOMS)
+        first = rooms.page(limit=2)
+        assert topics(first) == ["cats", "dogs"]
+        assert first["next_cursor"] == 2
+        last = rooms.page(cursor=first["next_cursor"], limit=2)
+        assert topics(last) == ["birds"]
+        assert last["next_cursor"] is None
+
+    def test_ensure_only_registers_missing_rooms(self, rooms, redis):
+        redis.sadd("room:2:users", "alice", "bob")
+        assert rooms.ensure(DEFAULT_ROOMS) == [1, 2, 3]
+        assert rooms.ensure(DEFAULT_ROOMS) == []
+        assert redis.zscore(SORTS["members"], 2) == 2
+
+    def test_create_skips_fixed_ids(self, rooms):
+        rooms.ensure(DEFAULT_ROOMS)
+        assert rooms.create("fish", owner="alice") == {"id": 4, "topic": "fish"}
+        assert rooms.get(4)["owner"] == "alice"
+
+    def test_create_invalid_topic(self, rooms, redis):
+        with pytest.raises(ValidationError):
+            rooms.create("no spaces allowed")
+        assert not redis.exists("rooms:last_id")
+
+    def test_delete_removes_indexes(self, rooms, redis):
+        rooms.ensure(DEFAULT_ROOMS)
+        rooms.add_member(2, "alice")
+        assert rooms.delete(2)
+        assert not rooms.delete(2)
+        assert topics(rooms.page()) == ["cats", "birds"]
+        for key in SORTS.values():
+            assert redis.zscore(key, 2) is None
+        assert not redis.sismember("rooms_ids", 2)
+        assert not redis.exists("room:2:users")
+
+    def test_members_of_deleted_room(self, rooms, redis):
+        rooms.ensure(DEFAULT_ROOMS)
+        rooms.add_member(2, "alice")
+        rooms.delete(2)
+        # A join racing the delete does not put the room back in the index.
+        assert rooms.add_member(2, "bob") is None
+        assert rooms.remove_member(2, "alice") is None
+        assert redis.zscore(SORTS["members"], 2) is None
+        assert not redis.exists("room:2:users")
+
+    def test_sort_by_members(self, rooms):
+        rooms.ensure(DEFAULT_ROOMS)
+        for name in ("alice", "bob", "carol"):
+            rooms.add_member(3, name)
+        rooms.add_member(1, "alice")
+        rooms.add_member(1, "alice")
+        rooms.remove_member(3, "carol")
+        page = rooms.page(sort="members", limit=2)
+        assert topics(page) == ["birds", "cats"]
+        assert topics(rooms.page(sort="members", cursor=page["next_cursor"])) == [
+            "dogs"
+        ]
+
+    def test_sort_by_activity_is_throttled(self, rooms):
+        rooms.ensure(DEFAULT_ROOMS)
+        rooms.touch(1, 2000.0)
+        rooms.touch(2, 2001.0)
+        assert topics(rooms.page(sort="activity"))[:2] == ["dogs", "cats"]
+        rooms.touch(1, 2002.0)
+        assert topics(rooms.page(sort="activity"))[:2] == ["dogs", "cats"]
+        rooms.touch(1, 2000.0 + ACTIVITY_INTERVAL)
+        assert topics(rooms.page(sort="activity"))[:2] == ["cats", "dogs"]
+
+    def test_touch_does_not_revive_deleted_room(self, rooms, redis):
+        rooms.ensure(DEFAULT_ROOMS)
+        rooms.delete(1)
+        rooms.touch(1, 2000.0)
+        assert redis.zscore(SORTS["activity"], 1) is None
+
+    def test_invalid_queries(self, rooms):
+        with pytest.raises(ValueError):
+            rooms.page(sort="topic")
+        with pytest.raises(ValueError):
+            rooms.page(cursor="-1")
+
+
+class TestChatAPIRooms:
+    @pytest.fixture
+    def chat_api(self, redis):
+        chat_api = ChatAPI(redis)
+        chat_api.rooms.ensure(DEFAULT_ROOMS)
+        return chat_api
+
+    def test_pages_cached_until_created(self, chat_api):
+        assert len(chat_api.get_rooms_page()["rooms"]) == 3
+        chat_api.rooms.ensure([ChatRoom(id=7, topic="fish")])
+        assert len(chat_api.get_rooms_page()["rooms"]) == 3
+        chat_api.create_room("lizards", "alice")
+        assert topics(chat_api.get_rooms_page())[-2:] == ["lizards", "fish"]
+
+    def test_get_rooms_reads_every_page(self, chat_api, monkeypatch):
+        monkeypatch.setattr("chat.api.MAX_ROOMS_PAGE_SIZE", 2)
+        assert [room["id"] for room in chat_api.get_rooms()] == [1, 2, 3]
+
+    def test_delete_only_by_owner(self, chat_api):
+        room = chat_api.create_room("lizards", "alice")
+        with pytest.raises(ChatAPIError) as e:
+            chat_api.delete_room(room["id"], "bob")
+        assert e.value.get_status_code() == 403
+        with pytest.raises(ChatAPIError) as e:
+            chat_api.delete_room(1, "alice")
+        assert e.value.get_status_code() == 403
+        chat_api.delete_room(room["id"], "alice")
+        with pytest.raises(ChatAPIError) as e:
+            chat_api.join_room(room["id"], "alice")
+        assert e.value.get_status_code() == 404
+        with pytest.raises(ChatAPIError) as e:
+            chat_api.delete_room(room["id"], "alice")
+        assert e.value.get_status_code() == 404
+
+    def test_join_counts_members(self, chat_api, redis):
+        chat_api.join_room(2, "alice")
+        chat_api.join_room(2, "alice")
+        assert topics(chat_api.get_rooms_page(sort="members"))[0] == "dogs"
+        chat_api.leave_room(2, "alice")
+        assert redis.zscore(SORTS["members"], 2) == 0
+
+    def test_send_records_activity(self, chat_api):
+        chat_api.send_message(2, "alice", "hi")
+        assert topics(chat_api.get_rooms_page(sort="activity"))[0] == "dogs"
+
+    def test_invalid_query(self, chat_api):
+        with pytest.raises(ChatAPIError) as e:
+            chat_api.get_rooms_page(cursor="abc")
+        assert e.value.get_status_code() == 400
+
+
+def test_migrate_rooms(redis):
+    redis.sadd("rooms", json.dumps({"id": 5, "topic": "fish"}))
+    redis.sadd("rooms", json.dumps({"id": 1, "topic": "cats"}))
+    assert migrate_rooms(redis) == [1, 5]
+    assert migrate_rooms(redis) == []
+    assert topics(RoomRegistry(redis).page()) == ["cats", "fish"]
+
+
+class TestRoomsRoute:
+    @pytest.fixture
+    def app(self, redis, monkeypatch):
+        flask = pytest.importorskip("flask")
+        routes = pytest.importorskip("chat.routes")
+        chat_api = ChatAPI(redis)
+        chat_api.rooms.ensure(DEFAULT_ROOMS)
+        monkeypatch.setattr(routes, "chat_api", chat_api)
+        app = flask.Flask(__name__)
+        app.register_blueprint(routes.bp)
+        return app, routes
+
+    def test_link_to_next_page(self, app):
+        app, routes = app
+        with app.test_request_context("/rooms?limit=2"):
+            response = routes.get_rooms()
+            assert response.status_code == 200
+            assert [room["id"] for room in response.get_json()] == [1, 2]
+            assert response.headers["Link"] == (
+                '</rooms?sort=id&cursor=2&limit=2>; rel="next"'
+            )
+        with app.test_request_context("/rooms?sort=id&cursor=2&limit=2"):
+            response = routes.get_rooms()
+            assert [room["id"] for room in response.get_json()] == [3]
+            assert "Link" not in response.headers
+
+    def test_not_modified(self, app):
+        flask = pytest.importorskip("flask")
+        app, routes = app
+        with app.test_request_context("/rooms"):
+            etag = routes.get_rooms().headers["ETag"]
+        with app.test_request_context("/rooms", headers={"If-None-Match": etag}):
+            response = routes.get_rooms()
+            assert response.status_code == 304
+            body = response.get_app_iter(flask.request.environ)
+            assert b"".join(body) == b""
+        routes.chat_api.create_room("fish", "alice")
+        with app.test_request_context("/rooms", headers={"If-None-Match": etag}):
+            response = routes.get_rooms()
+            assert response.status_code == 200
+            assert response.headers["ETag"] != etag
+
+    def test_invalid_limit(self, app):
+        app, routes = app
+        with app.test_request_context("/rooms?limit=0"):
+            _, status = routes.get_rooms()
+            assert status == 400
@@ -0,0 +1,147 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from chat.api import ChatAPI
+from chat.errors import ChatAPIError
+from chat.migrate import index_room
+from chat.retention import RetentionTrimmer
+from chat.search import SearchIndex, tokenize
+from chat.storage import StreamMessageStore
+from test_chat_api import FakeRedis
+
+
+@pytest.fixture
+def redis():
+    return FakeRedis()
+
+
+@pytest.fixture
+def chat_api(redis):
+    chat_api = ChatAPI(redis, index=SearchIndex(redis))
+    chat_api.send_message(1, "alice", "The cat sat on the mat")
+    chat_api.send_message(1, "bob", "My cat is hungry")
+    chat_api.send_message(1, "alice", "Dogs are loud")
+    chat_api.send_message(2, "alice", "A cat in another room")
+    return chat_api
+
+
+def texts(page):
+    return [m["message"] for m in page["messages"]]
+
+
+def test_tokenize():
+    assert tokenize("The cat, the CAT and a dog!") == ["the", "cat", "and", "dog"]
+
+
+class TestSearch:
+    def test_single_term(self, chat_api):
+        page = chat_api.search_messages(1, "cat")
+        assert texts(page) == ["My cat is hungry", "The cat sat on the mat"]
+        assert page["next_cursor"] is None
+
+    def test_all_terms_must_match(self, chat_api):
+        assert texts(chat_api.search_messages(1, "Cat mat")) == [
+            "The cat sat on the mat"
+        ]
+        assert texts(chat_api.search_messages(1, "cat dogs")) == []
+
+    def test_sender_filter(self, chat_api):
+        assert texts(chat_api.search_messages(1, "cat", sender="bob")) == [
+            "My cat is hungry"
+        ]
+        assert len(chat_api.search_messages(1, "", sender="alice")["messages"]) == 2
+
+    def test_time_range_and_pages(self, chat_api):
+        page = chat_api.search_messages(1, "cat", limit=1)
+        assert texts(page) == ["My cat is hungry"]
+        older = chat_api.search_messages(1, "cat", until=page["next_cursor"])
+        assert texts(older) == ["The cat sat on the mat"]
+        newer = chat_api.search_messages(
+            1, "cat", since=older["messages"][0]["timestamp"]
+        )
+        assert texts(newer) == ["My cat is hungry"]
+
+    @pytest.mark.parametrize("terms", ["cat", "cat food"])
+    def test_pages_of_matches_sent_together(self, redis, terms):
+        chat_api = ChatAPI(redis, index=SearchIndex(redis))
+        chat_api.index.add(
+            1,
+            [
+                {
+                    "id": i,
+                    "sender_id": "alice",
+                    "message": "cat food %d" % i,
+                    "timestamp": 1000.0 if i > 2 else 999.0,
+                }
+                for i in range(1, 13)
+            ],
+        )
+        found = []
+        cursor = None
+        while True:
+            page = chat_api.search_messages(1, terms, until=cursor, limit=3)
+            found += [m["id"] for m in page["messages"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert sorted(found) == list(range(1, 13))
+        assert found[-2:] == [2, 1]
+        older = chat_api.search_messages(1, "cat", until="1000.0", limit=20)
+        assert [m["id"] for m in older["messages"]] == [2, 1]
+
+    def test_invalid_cursor(self, chat_api):
+        for cursor in ["1000.0:", "inf:1", "nan"]:
+            with pytest.raises(ChatAPIError) as e:
+                chat_api.search_messages(1, "cat", until=cursor)
+            assert e.value.get_status_code() == 400
+
+    def test_empty_query(self, chat_api):
+        with pytest.raises(ChatAPIError) as e:
+            chat_api.search_messages(1, "?")
+        assert e.value.get_status_code() == 400
+
+    def test_disabled(self, redis):
+        with pytest.raises(ChatAPIError) as e:
+            ChatAPI(redis).search_messages(1, "cat")
+        assert e.value.get_status_code() == 404
+
+    def test_batched_messages_indexed(self, chat_api):
+        msgs = [chat_api.new_message("carol", "batched cat")]
+        chat_api.store_messages({1: msgs})
+        assert texts(chat_api.search_messages(1, "batched")) == ["batched cat"]
+
+    def test_stream_store(self, redis):
+        chat_api = ChatAPI(
+            redis, store=StreamMessageStore(redis), index=SearchIndex(redis)
+        )
+        message_id = chat_api.send_message(1, "alice", "streamed cat")
+        page = chat_api.search_messages(1, "cat")
+        assert [m["id"] for m in page["messages"]] == [message_id]
+
+    def test_trimmed_messages_removed(self, chat_api, redis):
+        RetentionTrimmer(
+            redis, chat_api.store, default={"max_count": 1}, index=chat_api.index
+        ).trim_room(1)
+        assert texts(chat_api.search_messages(1, "cat")) == []
+
+    def test_index_existing_messages(self, redis):
+        ChatAPI(redis).send_message(1, "alice", "old cat")
+        chat_api = ChatAPI(redis, index=SearchIndex(redis))
+        assert index_room(redis, chat_api.store, 1) == 1
+        assert texts(chat_api.search_messages(1, "cat")) == ["old cat"]
+
+    def test_capped_stream_pruned(self, redis, monkeypatch):
+        monkeypatch.setattr("chat.api.STREAM_CLOCK_SKEW_MS", 0)
+        monkeypatch.setattr("chat.search.PRUNE_INTERVAL", 0)
+        chat_api = ChatAPI(
+            redis, store=StreamMessageStore(redis, maxlen=2), index=SearchIndex(redis)
+        )
+        for text in ("first cat", "second cat", "third cat"):
+            chat_api.send_message(1, "alice", text)
+        assert texts(chat_api.search_messages(1, "cat")) == ["third cat", "second cat"]
+        assert redis.zcard("room:1:search:ids") == 2
+        assert len(redis.hgetall("room:1:search:docs")) == 2
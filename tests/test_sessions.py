@@ -0,0 +1,39 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from chat.sessions import SessionStore
+from test_chat_api import FakeRedis
+
+
+class TestSessionStore:
+    def test_set_and_pop(self):
+        sessions = SessionStore(FakeRedis())
+        sessions.set("sid1", "alice", 1)
+        assert sessions.get("sid1") == {"username": "alice", "room": 1}
+        assert sessions.count(1) == 1
+        assert sessions.pop("sid1") == {"username": "alice", "room": 1}
+        assert sessions.get("sid1") is None
+        assert sessions.count(1) == 0
+
+    def test_pop_unknown(self):
+        sessions = SessionStore(FakeRedis())
+        assert sessions.pop("nope") is None
+
+    def test_counts(self):
+        redis = FakeRedis()
+        redis.sadd("rooms_ids", 1, 2)
+        sessions = SessionStore(redis)
+        sessions.set("sid1", "alice", 1)
+        sessions.set("sid2", "bob", 1)
+        assert sessions.counts() == {"1": 2, "2": 0}
+        assert sessions.counts(["2"]) == {"2": 0}
+
+    def test_rejoin_moves_session(self):
+        sessions = SessionStore(FakeRedis())
+        sessions.set("sid1", "alice", 1)
+        sessions.set("sid1", "alice", 2)
+        assert sessions.count(1) == 0
+        assert sessions.count(2) == 1
@@ -0,0 +1,255 @@
+import json
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from chat.api import ChatAPI
+from chat.delivery import StreamTailer
+from chat.errors import ChatAPIError
+from chat.migrate import assign_message_ids, index_room, migrate_room_to_stream
+from chat.models import new_message
+from chat.retention import RetentionTrimmer
+from chat.search import SearchIndex
+from chat.storage import StreamMessageStore, ZSetMessageStore, make_store
+from test_chat_api import FakeRedis
+
+
+@pytest.fixture
+def redis():
+    return FakeRedis()
+
+
+class TestZSetMessageStore:
+    @pytest.fixture
+    def store(self, redis):
+        store = ZSetMessageStore(redis)
+        # Ids from 8 to 14: "10" sorts before "9" as bytes, not as an id.
+        redis.set("room:1:last_id", 7)
+        timestamps = [1.0, 2.0, 2.0, 2.0, 2.0, 2.0, 3.0]
+        msgs = [new_message("alice", "m%d" % i, ts) for i, ts in enumerate(timestamps)]
+        store.append_many({1: msgs})
+        return store
+
+    @pytest.mark.parametrize("limit", [1, 2, 3, 4, 10])
+    def test_pages_split_equal_timestamps(self, store, limit):
+        texts = ["m%d" % i for i in range(7)]
+        seen, cursor = [], None
+        while True:
+            page, cursor = store.page(1, before=cursor, limit=limit)
+            seen = [m["message"] for m in page] + seen
+            if cursor is None:
+                break
+        assert seen == texts
+        seen, cursor = [], "0"
+        while cursor is not None:
+            page, cursor = store.page(1, after=cursor, limit=limit)
+            seen += [m["message"] for m in page]
+        assert seen == texts
+
+    def test_cursors(self, store):
+        page, cursor = store.page(1, limit=2)
+        assert [m["id"] for m in page] == [13, 14]
+        assert cursor == "2.0:13"
+        assert store.page(1, after="2.0:10", before=cursor)[0][0]["id"] == 11
+        # A bare timestamp skips every message sent at that time.
+        assert [m["id"] for m in store.page(1, after=2.0)[0]] == [14]
+        with pytest.raises(ValueError):
+            store.page(1, after="2.0:-1")
+
+
+class TestStreamMessageStore:
+    @pytest.fixture
+    def chat_api(self, redis):
+        return ChatAPI(redis, store=StreamMessageStore(redis))
+
+    def test_ids_are_stream_ids(self, chat_api):
+        ids = [chat_api.send_message(1, "alice", "hi") for _ in range(3)]
+        assert all(isinstance(i, str) for i in ids)
+        assert ids == sorted(ids, key=lambda i: tuple(map(int, i.split("-"))))
+        assert [m["id"] for m in chat_api.get_messages(1)] == ids
+
+    def test_page_with_id_cursors(self, chat_api):
+        for i in range(5):
+            chat_api.send_message(1, "alice", "msg %d" % i)
+        page = chat_api.get_messages_page(1, limit=2)
+        assert [m["message"] for m in page["messages"]] == ["msg 3", "msg 4"]
+        older = chat_api.get_messages_page(1, before=page["next_cursor"], limit=3)
+        assert [m["message"] for m in older["messages"]] == ["msg 0", "msg 1", "msg 2"]
+        newer = chat_api.get_messages_page(1, after=older["messages"][0]["id"])
+        assert [m["message"] for m in newer["messages"]] == [
+            "msg 1", "msg 2", "msg 3", "msg 4"
+        ]
+
+    def test_page_with_timestamp_cursor(self, chat_api):
+        for i in range(4):
+            chat_api.send_message(1, "alice", "msg %d" % i)
+        second = chat_api.get_messages(1)[1]
+        page = chat_api.get_messages_page(1, after=second["timestamp"])
+        assert [m["message"] for m in page["messages"]] == ["msg 2", "msg 3"]
+        page = chat_api.get_messages_page(1, before=second["timestamp"])
+        assert [m["message"] for m in page["messages"]] == ["msg 0"]
+
+    def test_invalid_cursor(self, chat_api):
+        with pytest.raises(ChatAPIError) as e:
+            chat_api.get_messages_page(1, before="nope")
+        assert e.value.get_status_code() == 400
+
+    def test_idempotent_send_returns_stream_id(self, chat_api):
+        first = chat_api.send_message(1, "alice", "hi", idempotency_key="k")
+        assert chat_api.send_message(1, "alice", "hi", idempotency_key="k") == first
+
+    def test_store_messages(self, chat_api):
+        msgs = [chat_api.new_message("alice", "m%d" % i) for i in range(3)]
+        assert chat_api.store_messages({1: msgs}) == ({1: None}, set())
+        assert [m["id"] for m in chat_api.get_messages(1)] == [m.id for m in msgs]
+
+    def test_maxlen(self, redis):
+        chat_api = ChatAPI(redis, store=StreamMessageStore(redis, maxlen=2))
+        for i in range(4):
+            chat_api.send_message(1, "alice", "msg %d" % i)
+        assert [m["message"] for m in chat_api.get_messages(1)] == ["msg 2", "msg 3"]
+
+
+class TestAppendScripts:
+    @pytest.mark.parametrize("encoding", ["json", "msgpack"])
+    @pytest.mark.parametrize("last_id", [0, 127, 255, 65535, 2**32 - 1])
+    def test_zset_members_hold_their_ids(self, redis, encoding, last_id):
+        if encoding == "msgpack":
+            pytest.importorskip("msgpack")
+        store = ZSetMessageStore(redis, encoding=encoding)
+        chat_api = ChatAPI(redis, store=store)
+        redis.set("room:1:last_id", last_id)
+        msgs = [chat_api.new_message("alice", "m%d" % i) for i in range(2)]
+        assert store.append_many({1: msgs}) == ({1: None}, set())
+        assert [m.id for m in msgs] == [last_id + 1, last_id + 2]
+        # The script writes the same bytes as the encoder would.
+        assert redis.zrange("room:1", 0, -1) == [store.encode(m) for m in msgs]
+        assert int(redis.get("room:1:last_id")) == last_id + 2
+
+    @pytest.mark.parametrize("backend", ["zset", "stream"])
+    def test_idempotency_keys(self, redis, backend):
+        store = make_store(redis, backend, maxlen=10)
+        chat_api = ChatAPI(redis, store=store)
+        first = chat_api.send_message(1, "alice", "hi", idempotency_key="k1")
+        assert chat_api.send_message(1, "alice", "hi", idempotency_key="k1") == first
+        msgs = [chat_api.new_message("alice", "m%d" % i) for i in range(3)]
+        errors, duplicates = chat_api.store_messages(
+            {1: msgs}, {1: ["k2", "k1", "k2"]}
+        )
+        assert errors == {1: None}
+        assert duplicates == {(1, 1), (1, 2)}
+        assert msgs[1].id == first and msgs[2].id == msgs[0].id
+        assert [m["message"] for m in chat_api.get_messages(1)] == ["hi", "m0"]
+        assert redis.ttl("room:1:idempotency:alice:k2") > 0
+
+
+class TestStreamTailer:
+    def test_delivers_new_messages_only(self, redis):
+        store = StreamMessageStore(redis)
+        chat_api = ChatAPI(redis, store=store)
+        redis.sadd("rooms_ids", 1)
+        chat_api.send_message(1, "alice", "old")
+        delivered = []
+        tailer = StreamTailer(redis, store, lambda r, m: delivered.append((r, m)))
+        tailer.poll()
+        chat_api.send_message(1, "alice", "new")
+        tailer.poll()
+        assert [(r, m["message"]) for r, m in delivered] == [("1", "new")]
+
+
+class TestMigrateToStream:
+    def test_copies_messages_in_order(self, redis):
+        zset_api = ChatAPI(redis)
+        for i in range(3):
+            zset_api.send_message(1, "alice", "msg %d" % i)
+        assert migrate_room_to_stream(redis, 1, batch=2) == 3
+        stream_api = ChatAPI(redis, store=StreamMessageStore(redis))
+        messages = stream_api.get_messages(1)
+        assert [m["message"] for m in messages] == ["msg 0", "msg 1", "msg 2"]
+        assert migrate_room_to_stream(redis, 1) is None
+
+    def test_same_millisecond_messages(self, redis):
+        for i in range(2):
+            member = {"sender_id": "alice", "timestamp": 1.0, "message": "m%d" % i}
+            redis.zadd("room:1", {json.dumps(member): 1.0})
+        assert migrate_room_to_stream(redis, 1) == 2
+        ids = [m["id"] for m in StreamMessageStore(redis).all(1)]
+        assert ids == ["1000-0", "1000-1"]
+
+
+def add_legacy(redis, timestamps, room_id=1):
+    """Store messages like versions without message ids did."""
+    for i, ts in enumerate(timestamps):
+        member = {"sender_id": "alice", "timestamp": ts, "message": "old %d" % i}
+        redis.zadd("room:%s" % room_id, {json.dumps(member): ts})
+
+
+class TestLegacyMessages:
+    @pytest.mark.parametrize("limit", [1, 2, 3, 10])
+    def test_pages_mixed_with_new_messages(self, redis, limit):
+        add_legacy(redis, [1.0, 2.0, 3.0])
+        store = ZSetMessageStore(redis)
+        for i, ts in enumerate([2.0, 3.0, 4.0]):
+            store.append(1, new_message("bob", "new %d" % i, ts))
+        texts = ["old 0", "old 1", "new 0", "old 2", "new 1", "new 2"]
+        seen, cursor = [], None
+        while True:
+            page, cursor = store.page(1, before=cursor, limit=limit)
+            seen = [m["message"] for m in page] + seen
+            if cursor is None:
+                break
+        assert seen == texts
+        seen, cursor = [], "0"
+        while cursor is not None:
+            page, cursor = store.page(1, after=cursor, limit=limit)
+            seen += [m["message"] for m in page]
+        assert seen == texts
+
+    def test_cursors_of_messages_without_ids(self, redis):
+        add_legacy(redis, [2.0])
+        store = ZSetMessageStore(redis)
+        store.append(1, new_message("bob", "new", 2.0))
+        page, cursor = store.page(1, after="1.0", limit=1)
+        assert [m["message"] for m in page] == ["old 0"]
+        assert cursor == "2.0:0"
+        assert store.position(page[0]) == (2.0, 0)
+        assert [m["message"] for m in store.page(1, after=cursor)[0]] == ["new"]
+        assert store.page(1, before=cursor)[0] == []
+
+    def test_pages_without_ids(self, redis):
+        add_legacy(redis, [1.0, 2.0, 3.0, 4.0, 5.0])
+        chat_api = ChatAPI(redis)
+        page = chat_api.get_messages_page(1, before=6.0, limit=2)
+        assert [m["message"] for m in page["messages"]] == ["old 3", "old 4"]
+        assert page["next_cursor"] == "4.0:0"
+        older = chat_api.get_messages_page(1, before=page["next_cursor"], limit=2)
+        assert [m["message"] for m in older["messages"]] == ["old 1", "old 2"]
+        newer = chat_api.get_messages_page(1, after="1.0", limit=2)
+        assert [m["message"] for m in newer["messages"]] == ["old 1", "old 2"]
+        assert newer["next_cursor"] == "3.0:0"
+
+    def test_migrate_ids(self, redis):
+        add_legacy(redis, [1.0, 2.0, 2.0])
+        store = ZSetMessageStore(redis)
+        store.append(1, new_message("bob", "new", 2.0))
+        assert assign_message_ids(redis, 1, batch=2) == 3
+        assert assign_message_ids(redis, 1) == 0
+        messages = store.all(1)
+        assert sorted(m["id"] for m in messages) == [1, 2, 3, 4]
+        page, cursor = store.page(1, limit=2)
+        assert cursor == "2.0:%d" % page[0]["id"]
+        assert store.append(1, new_message("bob", "newer", 3.0)) == 5
+
+    def test_trim_and_index_without_ids(self, redis):
+        add_legacy(redis, [1.0, 2.0])
+        index = SearchIndex(redis)
+        assert index_room(redis, ZSetMessageStore(redis), 1) == 0
+        chat_api = ChatAPI(redis, index=index)
+        chat_api.send_message(1, "alice", "old news")
+        trimmer = RetentionTrimmer(redis, chat_api.store, default={"max_count": 1})
+        assert trimmer.trim_room(1) == 2
+        found = chat_api.search_messages(1, "old")["messages"]
+        assert [m["message"] for m in found] == ["old news"]